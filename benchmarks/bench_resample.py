@@ -0,0 +1,74 @@
+"""
+Benchmark of the downsampling engines in ecogvis.signal_processing.resample:
+FFT resampling of power of 2 padded signals (the previous default) against
+polyphase FIR resampling, on synthetic recordings.
+
+Usage:
+    python benchmarks/bench_resample.py --minutes 10 60 --channels 4
+"""
+import argparse
+import time
+
+import numpy as np
+
+from ecogvis.signal_processing.resample import resample
+
+
+def synthetic_recording(minutes, n_channels, rate, seed=0):
+    """
+    Sum of in-band sines plus white noise, dimensions (n_channels, n_bins).
+    Returns the signal and the clean in-band part as a function of time.
+    """
+    rng = np.random.RandomState(seed)
+    n_bins = int(minutes * 60 * rate)
+    t = np.arange(n_bins) / rate
+    freqs = np.array([7., 37., 113.])
+
+    def clean(tt):
+        return np.sin(2 * np.pi * freqs[:, None] * tt).sum(axis=0)
+
+    X = clean(t)[None, :] + rng.randn(n_channels, n_bins)
+    return X, clean
+
+
+def fft_padded(X, new_rate, rate):
+    n_bins = X.shape[-1]
+    extra = 2 ** int(np.ceil(np.log2(n_bins))) - n_bins
+    Xp = np.concatenate((X, np.zeros((X.shape[0], extra))), axis=-1)
+    Y = resample(Xp, new_rate, rate, kind=1)
+    return Y[:, :int(np.ceil(n_bins * new_rate / rate))]
+
+
+def polyphase(X, new_rate, rate):
+    return resample(X, new_rate, rate, kind='polyphase')
+
+
+def run(minutes, n_channels, rate, new_rate):
+    X, clean = synthetic_recording(minutes, n_channels, rate)
+    print('{} min, {} channels, {} Hz -> {} Hz ({} samples per channel)'
+          .format(minutes, n_channels, rate, new_rate, X.shape[1]))
+    for name, func in [('fft (power of 2 padded)', fft_padded),
+                       ('polyphase', polyphase)]:
+        start = time.time()
+        Y = func(X, new_rate, rate)
+        elapsed = time.time() - start
+
+        # Error of the in-band sines, away from the signal edges; the noise
+        # term is removed by resampling it separately
+        N = func(X - clean(np.arange(X.shape[1]) / rate), new_rate, rate)
+        t = np.arange(Y.shape[1]) / new_rate
+        edge = int(new_rate)
+        err = np.abs(Y - N - clean(t))[:, edge:-edge].max()
+        print('    {:<25} {:8.2f} s   max in-band error {:.2e}'.format(
+            name, elapsed, err))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--minutes', type=float, nargs='+', default=[10, 60])
+    parser.add_argument('--channels', type=int, default=1)
+    parser.add_argument('--rate', type=float, default=3051.7578125)
+    parser.add_argument('--new-rate', type=float, default=400.)
+    args = parser.parse_args()
+    for minutes in args.minutes:
+        run(minutes, args.channels, args.rate, args.new_rate)
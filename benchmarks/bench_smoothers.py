@@ -0,0 +1,50 @@
+"""
+Benchmark of the envelope smoothers of
+ecogvis.signal_processing.detect_events, as a function of the window length,
+on the squared derivative of a synthetic downsampled audio recording.
+
+Usage:
+    python benchmarks/bench_smoothers.py --minutes 60 --rate 1000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from ecogvis.signal_processing.detect_events import SMOOTHERS, smooth_envelope
+
+
+def synthetic_envelope(minutes, rate, seed=0):
+    """
+    Squared derivative of noise bursts of 0.5 s every 2 s, plus noise.
+    """
+    rng = np.random.RandomState(seed)
+    n_bins = int(minutes * 60 * rate)
+    t = np.arange(n_bins) / rate
+    X = rng.randn(n_bins) * (1 + 10 * ((t % 2) < .5))
+    return np.diff(np.append(X, X[-1])) ** 2
+
+
+def run(minutes, rate, widths):
+    X = synthetic_envelope(minutes, rate)
+    print('{} min at {} Hz ({} samples)'.format(minutes, rate, X.shape[0]))
+    print('    {:<12}'.format('width (s)') +
+          ''.join('{:>10}'.format(kind) for kind in SMOOTHERS))
+    for width in widths:
+        times = []
+        for kind in SMOOTHERS:
+            start = time.time()
+            smooth_envelope(X, width * rate, kind)
+            times.append(time.time() - start)
+        print('    {:<12}'.format(width) +
+              ''.join('{:>9.2f}s'.format(t) for t in times))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--minutes', type=float, default=60)
+    parser.add_argument('--rate', type=float, default=1000.)
+    parser.add_argument('--widths', type=float, nargs='+',
+                        default=[.1, .4, 1., 2.])
+    args = parser.parse_args()
+    run(args.minutes, args.rate, args.widths)
@@ -75,10 +75,12 @@ class Application(QMainWindow):
         """Before exiting, checks if there are any unsaved changes and inform the user."""
         w = ExitDialog(self)
         if w.value == -1: #just exit
+            self.model.stop_threads()
             event.accept()
         elif w.value == 1: #save and exit
             self.AnnotationSave()
             self.IntervalSave()
+            self.model.stop_threads()
             event.accept()
         elif w.value == 0: #ignore
             event.ignore()
@@ -440,7 +442,8 @@ class Application(QMainWindow):
             self.win1.clear()
             self.win2.clear()
             self.win3.clear()
-            # Rebuild the model
+            # Stops reading the previous file, and rebuilds the model
+            self.model.stop_threads()
             self.model = TimeSeriesPlotter(self)
 
 
@@ -0,0 +1,154 @@
+"""
+Memory-bounded caches of computed arrays and of signals read from disk,
+shared by the GUI windows.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ArrayCache:
+    """
+    Least recently used cache of arrays, or tuples of arrays, bounded by their
+    total size in memory. Adding an entry evicts the least recently used ones
+    until the total fits in max_bytes. Entries larger than max_bytes are not
+    stored.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Maximum total size (bytes) of the cached arrays.
+    """
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        """Value of key, marked as the most recently used, or default."""
+        if key not in self._items:
+            return default
+        self._items.move_to_end(key)
+        return self._items[key][0]
+
+    def put(self, key, value):
+        """Stores value under key, evicting the least recently used entries."""
+        self.pop(key)
+        nbytes = _nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+        while self._items and self.nbytes + nbytes > self.max_bytes:
+            self.pop(next(iter(self._items)))
+        self._items[key] = (value, nbytes)
+        self.nbytes += nbytes
+
+    def pop(self, key, default=None):
+        """Removes key and returns its value, or default."""
+        if key not in self._items:
+            return default
+        value, nbytes = self._items.pop(key)
+        self.nbytes -= nbytes
+        return value
+
+    def invalidate(self, predicate):
+        """Removes the entries whose key satisfies predicate(key)."""
+        for key in [k for k in self._items if predicate(k)]:
+            self.pop(key)
+
+    def clear(self):
+        self._items.clear()
+        self.nbytes = 0
+
+
+def _nbytes(value):
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    return np.asarray(value).nbytes
+
+
+class TileCache:
+    """
+    Cache of the signals of a dataset, in tiles of tile_len time samples by
+    block_size channels, aligned to multiples of their size. Tiles are stored
+    decoded to float32 in an ArrayCache of max_bytes, and reads of any window
+    are assembled from them, so that overlapping windows (scrolling, rescaling)
+    only read the tiles they do not share.
+
+    Parameters
+    ----------
+    source : h5py.Dataset or array
+        Signals, dimensions (n_timePoints, n_channels).
+    tile_len : int
+        Number of time samples per tile.
+    block_size : int
+        Number of channels per tile.
+    max_bytes : int
+        Maximum total size (bytes) of the cached tiles.
+    """
+    def __init__(self, source, tile_len=2**14, block_size=16,
+                 max_bytes=256 * 2**20):
+        self.source = source
+        self.tile_len = tile_len
+        self.block_size = block_size
+        self.tiles = ArrayCache(max_bytes=max_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    def keys(self, start, end, channels):
+        """Keys (time tile, channel block) of the tiles covering samples
+        [start, end) of channels."""
+        blocks = np.unique(self._channels(channels) // self.block_size)
+        return [(t, b) for t in range(start // self.tile_len,
+                                      -(-end // self.tile_len))
+                for b in blocks]
+
+    def missing(self, start, end, channels):
+        """Keys of the tiles of a window that are not cached."""
+        return [key for key in self.keys(start, end, channels)
+                if key not in self.tiles]
+
+    def load(self, key):
+        """Reads tile key from source, without caching it."""
+        t, b = key
+        return np.asarray(self.source[t * self.tile_len:
+                                      (t + 1) * self.tile_len,
+                                      b * self.block_size:
+                                      (b + 1) * self.block_size],
+                          dtype='float32')
+
+    def put(self, key, tile):
+        self.tiles.put(key, tile)
+
+    def _channels(self, channels):
+        return np.asarray(channels, dtype='int') % self.source.shape[1]
+
+    def read(self, start, end, channels):
+        """
+        Samples [start, end) of channels, dimensions (n_samples, n_channels),
+        from the cached tiles, reading the missing ones. Negative channels
+        count from the last one.
+        """
+        channels = self._channels(channels)
+        out = np.empty((end - start, len(channels)), dtype='float32')
+        for t in range(start // self.tile_len, -(-end // self.tile_len)):
+            t0 = max(start, t * self.tile_len)
+            t1 = min(end, (t + 1) * self.tile_len)
+            for b in np.unique(channels // self.block_size):
+                tile = self.tiles.get((t, b))
+                if tile is None:
+                    tile = self.load((t, b))
+                    self.put((t, b), tile)
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                cols = np.where(channels // self.block_size == b)[0]
+                out[t0 - start:t1 - start, cols] = tile[
+                    t0 - t * self.tile_len:t1 - t * self.tile_len,
+                    channels[cols] - b * self.block_size]
+        return out
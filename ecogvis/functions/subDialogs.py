@@ -13,13 +13,18 @@ from PyQt5.QtWidgets import (QTableWidgetItem, QGridLayout, QGroupBox,
                              QHBoxLayout, QComboBox, QScrollArea,
                              QFileDialog, QHeaderView, QMainWindow, QCheckBox)
 from ecogvis.signal_processing import bands as default_bands
-from ecogvis.signal_processing.detect_events import detect_events
+from ecogvis.signal_processing.detect_events import (detect_events,
+                                                      event_times,
+                                                      normalized_envelope,
+                                                      read_downsampled)
+from ecogvis.signal_processing.erp import erp
 from ecogvis.signal_processing.periodogram import psd_estimate
 from ecogvis.signal_processing.processing_data import processing_data
 from pynwb import NWBHDF5IO
 from pynwb.epoch import TimeIntervals
 
 from .FS_colorLUT import get_lut
+from .caching import ArrayCache
 
 # from threading import Event, Thread
 
@@ -1692,14 +1697,12 @@ class ERPDialog(QMainWindow):
         self.interval_type = 'speaker'
         self.grid_order = np.arange(256)
         self.transparent = []
-        self.Y_start_speaker_mean = {}
-        self.Y_start_speaker_sem = {}
-        self.Y_stop_speaker_mean = {}
-        self.Y_stop_speaker_sem = {}
-        self.Y_start_mic_mean = {}
-        self.Y_start_mic_sem = {}
-        self.Y_stop_mic_mean = {}
-        self.Y_stop_mic_sem = {}
+        # ERPs of all channels, (Y_mean, Y_sem, X), see erp_key
+        self.erps = ArrayCache(max_bytes=256 * 2**20)
+        # ERPs being calculated, (Y_mean, Y_sem, X, calculated channels)
+        self.erp_partial = {}
+        self.erp_worker = None
+        self.grid_index = {}
         self.X = []
         self.Yscale = {}
 
@@ -1927,15 +1930,6 @@ class ERPDialog(QMainWindow):
         self.draw_erp()
 
     def set_width(self):
-        self.Y_start_speaker_mean = {}
-        self.Y_start_speaker_sem = {}
-        self.Y_stop_speaker_mean = {}
-        self.Y_stop_speaker_sem = {}
-        self.Y_start_mic_mean = {}
-        self.Y_start_mic_sem = {}
-        self.Y_stop_mic_mean = {}
-        self.Y_stop_mic_sem = {}
-        self.X = []
         self.draw_erp()
 
     def rearrange_grid(self, angle):
@@ -1993,96 +1987,102 @@ class ERPDialog(QMainWindow):
                     p.setYRange(self.Yscale[curr_txt][0],
                                 self.Yscale[curr_txt][1])
                 else:
-                    if (self.alignment == 'start_time') and (
-                            self.interval_type == 'speaker'):
-                        yrng = max(abs(self.Y_start_speaker_mean[str(ch)]))
-                    elif (self.alignment == 'start_time') and (
-                            self.interval_type == 'mic'):
-                        yrng = max(abs(self.Y_start_mic_mean[str(ch)]))
-                    elif (self.alignment == 'stop_time') and (
-                            self.interval_type == 'speaker'):
-                        yrng = max(abs(self.Y_stop_speaker_mean[str(ch)]))
-                    elif (self.alignment == 'stop_time') and (
-                            self.interval_type == 'mic'):
-                        yrng = max(abs(self.Y_stop_mic_mean[str(ch)]))
+                    erp_ch = self.get_erp(ch=ch)
+                    if erp_ch is None:  # not calculated yet
+                        continue
+                    Y_mean = erp_ch[0]
+                    yrng = max(abs(Y_mean - np.mean(Y_mean)))
                     p.setYRange(-yrng, yrng)
 
-    def get_erp(self, ch):
-        if (self.alignment == 'start_time') and (
-                self.interval_type == 'speaker'):
-            if str(
-                    ch) in self.Y_start_speaker_mean:  # If it was
-                # calculated already
-                return self.Y_start_speaker_mean[str(ch)], \
-                       self.Y_start_speaker_sem[str(ch)], self.X
-            else:  # If it isn't calculated yet
-                Y_mean, Y_sem, X = self.calc_erp(ch=ch)
-                self.Y_start_speaker_mean[str(ch)] = Y_mean
-                self.Y_start_speaker_sem[str(ch)] = Y_sem
-                self.X = X
-                return self.Y_start_speaker_mean[str(ch)], \
-                       self.Y_start_speaker_sem[str(ch)], self.X
-        if (self.alignment == 'start_time') and (self.interval_type == 'mic'):
-            if str(ch) in self.Y_start_mic_mean:  # If it was calculated
-                # already
-                return self.Y_start_mic_mean[str(ch)], self.Y_start_mic_sem[
-                    str(ch)], self.X
-            else:  # If it isn't calculated yet
-                Y_mean, Y_sem, X = self.calc_erp(ch=ch)
-                self.Y_start_mic_mean[str(ch)] = Y_mean
-                self.Y_start_mic_sem[str(ch)] = Y_sem
-                self.X = X
-                return self.Y_start_mic_mean[str(ch)], self.Y_start_mic_sem[
-                    str(ch)], self.X
-        if (self.alignment == 'stop_time') and (
-                self.interval_type == 'speaker'):
-            if str(
-                    ch) in self.Y_stop_speaker_mean:  # If it was calculated
-                # already
-                return self.Y_stop_speaker_mean[str(ch)], \
-                       self.Y_stop_speaker_sem[str(ch)], self.X
-            else:  # If it isn't calculated yet
-                Y_mean, Y_sem, X = self.calc_erp(ch=ch)
-                self.Y_stop_speaker_mean[str(ch)] = Y_mean
-                self.Y_stop_speaker_sem[str(ch)] = Y_sem
-                self.X = X
-                return self.Y_stop_speaker_mean[str(ch)], \
-                       self.Y_stop_speaker_sem[str(ch)], self.X
-        if (self.alignment == 'stop_time') and (self.interval_type == 'mic'):
-            if str(ch) in self.Y_stop_mic_mean:  # If it was calculated already
-                return self.Y_stop_mic_mean[str(ch)], self.Y_stop_mic_sem[
-                    str(ch)], self.X
-            else:  # If it isn't calculated yet
-                Y_mean, Y_sem, X = self.calc_erp(ch=ch)
-                self.Y_stop_mic_mean[str(ch)] = Y_mean
-                self.Y_stop_mic_sem[str(ch)] = Y_sem
-                self.X = X
-                return self.Y_stop_mic_mean[str(ch)], self.Y_stop_mic_sem[
-                    str(ch)], self.X
+    def erp_key(self, alignment=None, interval_type=None):
+        """Cache key of the current ERPs, or of other alignments/intervals."""
+        return (alignment or self.alignment,
+                interval_type or self.interval_type,
+                float(self.qline2.text()), self.source.name)
+
+    def get_ref_times(self, alignment, interval_type):
+        if (alignment == 'start_time') and (interval_type == 'speaker'):
+            return self.speaker_start_times
+        if (alignment == 'stop_time') and (interval_type == 'speaker'):
+            return self.speaker_stop_times
+        if (alignment == 'start_time') and (interval_type == 'mic'):
+            return self.mic_start_times
+        if (alignment == 'stop_time') and (interval_type == 'mic'):
+            return self.mic_stop_times
 
-    def calc_erp(self, ch):
-        if (self.alignment == 'start_time') and (
-                self.interval_type == 'speaker'):
-            ref_times = self.speaker_start_times
-        if (self.alignment == 'stop_time') and (
-                self.interval_type == 'speaker'):
-            ref_times = self.speaker_stop_times
-        if (self.alignment == 'start_time') and (self.interval_type == 'mic'):
-            ref_times = self.mic_start_times
-        if (self.alignment == 'stop_time') and (self.interval_type == 'mic'):
-            ref_times = self.mic_stop_times
-        ref_bins = (ref_times * self.fs).astype('int')
-        nBinsTr = int(float(self.qline2.text()) * self.fs / 2)
-        start_bins = ref_bins - nBinsTr
-        stop_bins = ref_bins + nBinsTr
-        nTrials = len(ref_times)
-        Y = np.zeros((nTrials, 2 * nBinsTr)) + np.nan
-        for tr in np.arange(nTrials):
-            Y[tr, :] = self.source[start_bins[tr]:stop_bins[tr], ch]
-        Y_mean = np.nanmean(Y, 0)
-        Y_sem = np.nanstd(Y, 0) / np.sqrt(Y.shape[0])
-        X = np.arange(0, 2 * nBinsTr) / self.fs
-        return Y_mean, Y_sem, X
+    def get_erp(self, ch):
+        """
+        ERP of channel ch, or None if it isn't calculated yet. ERPs are
+        calculated in the background by start_erp_worker.
+        """
+        key = self.erp_key()
+        erps = self.erps.get(key)
+        if erps is not None:
+            Y_mean, Y_sem, self.X = erps
+            return Y_mean[ch].copy(), Y_sem[ch], self.X
+        if key in self.erp_partial:
+            Y_mean, Y_sem, X, done = self.erp_partial[key]
+            if done[ch]:
+                return Y_mean[ch].copy(), Y_sem[ch], X
+        return None
+
+    def start_erp_worker(self):
+        """
+        Calculates, in the background, the ERPs of the current alignment and
+        interval, and then those of the other alignments and intervals, with
+        one pass over the signals of all channels each. Results are sent and
+        drawn by rows of the grid, then the other channels follow (see
+        erp_block_ready).
+        """
+        self.stop_erp_worker()
+        combinations = [(self.alignment, self.interval_type)] + [
+            (a, i) for a in ['start_time', 'stop_time']
+            for i in ['speaker', 'mic']
+            if (a, i) != (self.alignment, self.interval_type)]
+        width = float(self.qline2.text())
+        tasks = [(self.erp_key(a, i), self.get_ref_times(a, i), width)
+                 for a, i in combinations if self.erp_key(a, i) not in
+                 self.erps]
+        if len(tasks) == 0:
+            return
+        # Rows of the grid first, then the other channels
+        others = np.setdiff1d(np.arange(self.source.shape[1]),
+                              self.grid_order)
+        channel_blocks = [self.grid_order[r:r + self.nCols]
+                          for r in range(0, len(self.grid_order), self.nCols)]
+        channel_blocks += [others[r:r + self.nCols]
+                           for r in range(0, len(others), self.nCols)]
+        self.erp_worker = ERPCalcFunction(self.source, self.fs, tasks,
+                                          channel_blocks)
+        self.erp_worker.block_ready.connect(self.erp_block_ready)
+        self.erp_worker.start()
+
+    def stop_erp_worker(self):
+        if self.erp_worker is not None:
+            self.erp_worker.stop()
+            self.erp_worker.wait()
+            self.erp_worker = None
+
+    def erp_block_ready(self, key, channels, Y_mean, Y_sem, X):
+        """Stores the ERPs of a block of channels, and draws them."""
+        if key in self.erps:
+            return
+        if key not in self.erp_partial:
+            nCh = self.source.shape[1]
+            self.erp_partial[key] = (np.full((nCh, len(X)), np.nan),
+                                     np.full((nCh, len(X)), np.nan), X,
+                                     np.zeros(nCh, dtype=bool))
+        partial = self.erp_partial[key]
+        partial[0][channels] = Y_mean
+        partial[1][channels] = Y_sem
+        partial[3][channels] = True
+        if partial[3].all():
+            self.erps.put(key, partial[:3])
+            del self.erp_partial[key]
+        if key == self.erp_key():
+            for ch in channels:
+                if ch in self.grid_index:
+                    self.plot_erp(self.grid_index[ch], ch)
 
     def draw_erp(self):
         self.push1_0.setEnabled(True)
@@ -2101,72 +2101,86 @@ class ERPDialog(QMainWindow):
         self.push5_5.setEnabled(True)
         self.combo1.setCurrentIndex(self.combo1.findText('individual'))
         self.set_grid()
-        cmap = get_lut()
-        ymin, ymax = 0, 0
-        ystd = 0
+        # scale limits, updated as ERPs are drawn
+        self.Yscale['global max'] = [0, 0]
+        self.Yscale['global std'] = [0, 0]
+        self.grid_index = {ch: ind for ind, ch in enumerate(self.grid_order)}
         for ind, ch in enumerate(self.grid_order):
-            if ch in self.transparent:  # if it should be made transparent
-                elem_alpha = 30
-            else:
-                elem_alpha = 255
-            Y_mean, Y_sem, X = self.get_erp(ch=ch)
-            dc = np.mean(Y_mean)
-            Y_mean -= dc
-            ymax = max(max(Y_mean), ymax)
-            ymin = min(min(Y_mean), ymin)
-            ystd = max(np.std(Y_mean), ystd)
-            # Include items
-            row = np.floor(ind / self.nCols).astype('int')
-            col = int(ind % self.nCols)
-            p = self.win.getItem(row=row, col=col)
-            if p == None:
-                vb = CustomViewBox(self, ch)
-                p = self.win.addPlot(row=row, col=col, viewBox=vb)
-            p.hideAxis('left')
-            p.hideAxis('bottom')
-            p.clear()
-            p.setMouseEnabled(x=False, y=False)
-            p.setToolTip('Ch ' + str(ch + 1) + '\n' + str(
-                self.parent.model.nwb.electrodes['location'][ch]))
-            # Background
-            loc = 'ctx-lh-' + self.parent.model.nwb.electrodes['location'][ch]
-            vb = p.getViewBox()
-            color = tuple(cmap.get(loc, cmap['Unknown']))
-            vb.setBackgroundColor(
-                (*color, min(elem_alpha, 70)))  # append alpha to color tuple
-            # Main plots
-            mean = p.plot(x=X, y=Y_mean, pen=pg.mkPen((50, 50, 50, min(
-                elem_alpha, 255)), width=1.))
-            semp = p.plot(x=X, y=Y_mean + Y_sem,
-                          pen=pg.mkPen((100, 100, 100, min(elem_alpha, 100)),
-                                       width=.1))
-            semm = p.plot(x=X, y=Y_mean - Y_sem,
-                          pen=pg.mkPen((100, 100, 100, min(elem_alpha, 100)),
-                                       width=.1))
-            fill = pg.FillBetweenItem(semm, semp, pg.mkBrush(100, 100, 100,
-                                                             min(elem_alpha,
-                                                                 100)))
-            p.addItem(fill)
-            p.hideButtons()
-            p.setXRange(X[0], X[-1])
-            yrng = max(abs(Y_mean))
-            p.setYRange(-yrng, yrng)
-            xref = [X[int(len(X) / 2)], X[int(len(X) / 2)]]
-            yref = [-1000 * yrng, 1000 * yrng]
-            p.plot(x=xref, y=yref,
-                   pen=(0, 0, 0, min(elem_alpha, 255)))  # reference mark
-            p.plot(x=X, y=np.zeros(len(X)),
-                   pen=(0, 0, 0, min(elem_alpha, 255)))  # Zero line
-            # Axis control
-            left = p.getAxis('left')
-            left.setStyle(showValues=False)
-            left.setTicks([])
-            bottom = p.getAxis('bottom')
-            bottom.setStyle(showValues=False)
-            bottom.setTicks([])
-        # store scale limits
-        self.Yscale['global max'] = [ymin, ymax]
+            self.plot_erp(ind, ch)
+        if self.erp_key() not in self.erps:
+            self.start_erp_worker()
+
+    def plot_erp(self, ind, ch):
+        """Draws the ERP of channel ch, if calculated, in grid position ind."""
+        cmap = get_lut()
+        if ch in self.transparent:  # if it should be made transparent
+            elem_alpha = 30
+        else:
+            elem_alpha = 255
+        # Include items
+        row = np.floor(ind / self.nCols).astype('int')
+        col = int(ind % self.nCols)
+        p = self.win.getItem(row=row, col=col)
+        if p == None:
+            vb = CustomViewBox(self, ch)
+            p = self.win.addPlot(row=row, col=col, viewBox=vb)
+        p.hideAxis('left')
+        p.hideAxis('bottom')
+        p.clear()
+        p.setMouseEnabled(x=False, y=False)
+        p.setToolTip('Ch ' + str(ch + 1) + '\n' + str(
+            self.parent.model.nwb.electrodes['location'][ch]))
+        # Background
+        loc = 'ctx-lh-' + self.parent.model.nwb.electrodes['location'][ch]
+        vb = p.getViewBox()
+        color = tuple(cmap.get(loc, cmap['Unknown']))
+        vb.setBackgroundColor(
+            (*color, min(elem_alpha, 70)))  # append alpha to color tuple
+        p.hideButtons()
+        erp_ch = self.get_erp(ch=ch)
+        if erp_ch is None:  # not calculated yet
+            return
+        Y_mean, Y_sem, X = erp_ch
+        dc = np.mean(Y_mean)
+        Y_mean -= dc
+        ymin, ymax = self.Yscale['global max']
+        self.Yscale['global max'] = [min(min(Y_mean), ymin),
+                                     max(max(Y_mean), ymax)]
+        ystd = max(np.std(Y_mean), self.Yscale['global std'][1])
         self.Yscale['global std'] = [-ystd, ystd]
+        # Main plots
+        mean = p.plot(x=X, y=Y_mean, pen=pg.mkPen((50, 50, 50, min(
+            elem_alpha, 255)), width=1.))
+        semp = p.plot(x=X, y=Y_mean + Y_sem,
+                      pen=pg.mkPen((100, 100, 100, min(elem_alpha, 100)),
+                                   width=.1))
+        semm = p.plot(x=X, y=Y_mean - Y_sem,
+                      pen=pg.mkPen((100, 100, 100, min(elem_alpha, 100)),
+                                   width=.1))
+        fill = pg.FillBetweenItem(semm, semp, pg.mkBrush(100, 100, 100,
+                                                         min(elem_alpha,
+                                                             100)))
+        p.addItem(fill)
+        p.setXRange(X[0], X[-1])
+        yrng = max(abs(Y_mean))
+        p.setYRange(-yrng, yrng)
+        xref = [X[int(len(X) / 2)], X[int(len(X) / 2)]]
+        yref = [-1000 * yrng, 1000 * yrng]
+        p.plot(x=xref, y=yref,
+               pen=(0, 0, 0, min(elem_alpha, 255)))  # reference mark
+        p.plot(x=X, y=np.zeros(len(X)),
+               pen=(0, 0, 0, min(elem_alpha, 255)))  # Zero line
+        # Axis control
+        left = p.getAxis('left')
+        left.setStyle(showValues=False)
+        left.setTicks([])
+        bottom = p.getAxis('bottom')
+        bottom.setStyle(showValues=False)
+        bottom.setTicks([])
+
+    def closeEvent(self, event):
+        self.stop_erp_worker()
+        event.accept()
 
     def areas_select(self):
         # Dialog to choose channels from specific brain regions
@@ -2180,6 +2194,38 @@ class ERPDialog(QMainWindow):
         self.draw_erp()
 
 
+# Calculates ERPs in the background, a block of channels at a time ----------
+class ERPCalcFunction(QtCore.QThread):
+    # key, channels, Y_mean, Y_sem, X
+    block_ready = QtCore.pyqtSignal(object, object, object, object, object)
+
+    def __init__(self, source, rate, tasks, channel_blocks):
+        super().__init__()
+        self.source = source
+        self.rate = rate
+        self.tasks = tasks  # list of (key, ref_times, width)
+        self.channel_blocks = channel_blocks
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self):
+        # One pass over the signals of all channels per task, whose results
+        # are sent by blocks of channels
+        for key, ref_times, width in self.tasks:
+            res = erp(self.source, ref_times, self.rate, width,
+                      stopped=lambda: self.stopped)
+            if res is None:
+                return
+            Y_mean, Y_sem, X = res
+            for channels in self.channel_blocks:
+                if self.stopped:
+                    return
+                self.block_ready.emit(key, channels, Y_mean[channels],
+                                      Y_sem[channels], X)
+
+
 # Gray line for visual separation of buttons --------------------------------
 class QHLine(QtGui.QFrame):
     def __init__(self):
@@ -2301,19 +2347,10 @@ class IndividualERPDialog(QtGui.QDialog):
             ref_times = self.mic_start_times
         if (self.alignment == 'stop_time') and (self.interval_type == 'mic'):
             ref_times = self.mic_stop_times
-        ref_bins = (ref_times * self.fs).astype('int')
-        nBinsTr = int(float(self.qline2.text()) * self.fs / 2)
-        start_bins = ref_bins - nBinsTr
-        stop_bins = ref_bins + nBinsTr
-        nTrials = len(ref_times)
-        Y = np.zeros((nTrials, 2 * nBinsTr)) + np.nan
-        for tr in np.arange(nTrials):
-            Y[tr, :] = self.source[start_bins[tr]:stop_bins[tr], ch]
-        Y_mean = np.nanmean(Y, 0)
-        Y_sem = np.nanstd(Y, 0) / np.sqrt(Y.shape[0])
-        X = np.arange(0, 2 * nBinsTr) / self.fs
+        Y_mean, Y_sem, X = erp(self.source, ref_times, self.fs,
+                               float(self.qline2.text()), channels=[ch])
         X -= X[-1] / 2
-        return Y_mean, Y_sem, X
+        return Y_mean[0], Y_sem[0], X
 
     def draw_erp(self):
         cmap = get_lut()
@@ -2429,12 +2466,14 @@ class AudioEventDetection(QtGui.QDialog):
                               'Typical values: .1 ~ 1')
         labelSpeakerThresh = QLabel('Speaker Threshold:')
         self.qline5 = QLineEdit('0.05')
+        self.qline5.returnPressed.connect(self.run_test)
         labelSpeakerThresh.setToolTip(
             'Threshold on the smoothed signal (standard deviations from the '
             'mean).\n'
             'Typical values: .02 ~ .1')
         labelMicThresh = QLabel('Mic Threshold:')
         self.qline6 = QLineEdit('0.1')
+        self.qline6.returnPressed.connect(self.run_test)
         labelMicThresh.setToolTip(
             'Threshold on the smoothed signal (standard deviations from the '
             'mean).\n'
@@ -2505,6 +2544,10 @@ class AudioEventDetection(QtGui.QDialog):
         self.setLayout(self.hbox)
         self.setWindowTitle('Audio Event Detection')
         self.resize(1100, 300)
+        # Downsampled and filtered signals of the last test, see
+        # detection_signals
+        self.detection_key = None
+        self.detection_cache = {}
         self.find_signals()
         self.reset_draw()
         self.set_detect_interval()
@@ -2678,27 +2721,54 @@ class AudioEventDetection(QtGui.QDialog):
         # Use the full signal based on the interval specified (different
         # from the interval plotted.
         self.set_detect_interval()
-
-        speakerDS, speakerEventDS, speakerFilt, micDS, micEventDS, micFilt =\
-            detect_events(
-            speaker_data=self.source_stim,
-            mic_data=self.source_resp,
-            interval=[self.detectStartBin, self.detectStopBin + 1],
-            dfact=self.fs / float(self.qline3.text()),
-            smooth_width=float(self.qline4.text()),
-            speaker_threshold=self.speakerThresh,
-            mic_threshold=self.micThresh
-        )
-
-        self.stimTimes = speakerEventDS
-        self.respTimes = micEventDS
-        self.timeaxis_filt = self.detectStartTime + np.arange(len(speakerDS)) / float(
-            self.qline3.text())
-        self.signal_stim_filt = speakerFilt
-        self.signal_resp_filt = micFilt
+        cache = self.detection_signals()
+        interval = [self.detectStartBin, self.detectStopBin + 1]
+        ds = cache['ds']
+
+        # The filtered mic signal depends on the speaker threshold
+        if cache.get('speakerThresh') != self.speakerThresh:
+            micDS = cache['micDS'].copy()
+            micDS[cache['speakerFilt'] > self.speakerThresh] = 0
+            cache['micFilt'] = normalized_envelope(
+                micDS, ds, float(self.qline4.text()))
+            cache['speakerThresh'] = self.speakerThresh
+
+        self.stimTimes = event_times(cache['speakerFilt'], self.speakerThresh,
+                                     'both', ds, self.fs, interval)
+        self.respTimes = event_times(cache['micFilt'], self.micThresh,
+                                     'both', ds, self.fs, interval)
+        self.timeaxis_filt = self.detectStartTime + np.arange(
+            len(cache['speakerDS'])) / float(self.qline3.text())
+        self.signal_stim_filt = cache['speakerFilt']
+        self.signal_resp_filt = cache['micFilt']
 
         self.draw_scene()
 
+    def detection_signals(self):
+        """
+        Downsampled signals and filtered speaker signal of the detection
+        interval, as in detect_events. They are cached by signals, interval,
+        downsampling and smoothing width, so that changing only thresholds
+        does not read and filter the audio again.
+        """
+        key = (self.combo0.currentText(), self.combo1.currentText(),
+               self.detectStartBin, self.detectStopBin,
+               float(self.qline3.text()), float(self.qline4.text()))
+        if key != self.detection_key:
+            interval = [self.detectStartBin, self.detectStopBin + 1]
+            dfact = self.fs / float(self.qline3.text())
+            speakerDS, ds, _ = read_downsampled(self.source_stim, interval,
+                                                dfact)
+            micDS, _, _ = read_downsampled(self.source_resp, interval, dfact)
+            self.detection_cache = {
+                'ds': ds,
+                'speakerDS': speakerDS,
+                'speakerFilt': normalized_envelope(
+                    speakerDS, ds, float(self.qline4.text())),
+                'micDS': micDS}
+            self.detection_key = key
+        return self.detection_cache
+
 
     def run_detection(self):
         self.set_detect_interval()
@@ -1,13 +1,25 @@
 import os
+import time
 from scipy import signal
 import numpy as np
 import pandas as pd
 from PyQt5.QtWidgets import QMessageBox
-from PyQt5 import QtGui
+from PyQt5 import QtGui, QtCore
 import pyqtgraph as pg
 import datetime
+import h5py
 import pynwb
 import nwbext_ecog
+from ecogvis.signal_processing.minmax_pyramid import (build_minmax_pyramid,
+                                                      open_minmax_pyramid)
+from .caching import TileCache
+
+# Colors [R, G, B, alpha of the fill] of the intervals
+INTERVAL_COLORS = {'yellow': [250, 250, 150, 180],
+                   'red': [250, 0, 0, 100],
+                   'green': [0, 255, 0, 130],
+                   'blue': [0, 0, 255, 100]}
+
 
 class TimeSeriesPlotter:
     """
@@ -22,155 +34,228 @@ class TimeSeriesPlotter:
         self.fileName = os.path.split(os.path.abspath(par.file))[1] #file
         self.parent.setWindowTitle('ecogVIS - '+self.fileName+' - '+self.parent.current_session)
 
+        # Opens the file without reading its contents, which are read on first
+        # use (see nwb). Signals, electrodes, intervals and stimuli are found
+        # in the HDF5 layout of the file.
+        t_start = time.time()
+        self.startup_times = {}
+        self.open_io()
+        self._source = None
+        self.find_source()
+        self.startup_times['open'] = time.time() - t_start
+
+        # Get Brain regions present in current file
+        electrodes = self.h5['general/extracellular_ephys/electrodes']
+        locations = read_strings(electrodes['location'])
+        self.all_regions = list(set(locations.tolist()))
+        self.all_regions.sort()
+        self.regions_mask = [True]*len(self.all_regions)
+
+        self.channels_mask = np.ones(len(locations))
+        self.channels_mask_ind = np.where(self.channels_mask)[0]
+
+        self.h = []
+        self.text = []
+        self.AnnotationsList = []
+        self.AnnotationsPosAV = np.array([])    #(x, y_va, y_off)
+        self.unsaved_changes_annotation = False
+        self.unsaved_changes_interval = False
+
+        # Channels to show
+        self.firstCh = int(self.parent.qline1.text())
+        self.lastCh = int(self.parent.qline0.text())
+        self.nChToShow = self.lastCh - self.firstCh + 1
+        self.selectedChannels = np.arange(self.firstCh-1, self.lastCh)
+
+        self.badChannels = np.where( electrodes['bad'][:] )[0].tolist()
+
+        # Min/max pyramids of the plotted sources, by dataset name
+        self.lod = {}
+        self.lod_thread = None
+        self.lod_failed = set()
+
+        # Tiles of the plotted signals, see get_tiles and prefetch_pages
+        self.tiles = None
+        self.prefetch_thread = None
+        self.prefetch_next = None
+
+        # Intervals and stimuli are loaded after the first page is shown
+        self.allIntervals = []
+        self.nBI = 0
+        self.stimY = {}
+        self.stimRate = {}
+
+        # Interval rectangles at upper and middle pannels, see interval_items
+        self.intervalIndex = None    #rebuilt when intervals change
+        self.intervalBars = None     #all intervals on the upper bar
+        self.intervalRects = {}      #visible intervals on the signals plot
+
+        # Initiate plots
+        self.init_plot_items()
+        self.updateCurXAxisPosition()
+        self.startup_times['first page'] = time.time() - t_start
+        QtCore.QTimer.singleShot(0, lambda: self.load_intervals_and_stimuli(t_start))
+
+
+    def open_io(self):
+        """Opens the NWB file, and a read-only handle on its HDF5 layout."""
         self.io = pynwb.NWBHDF5IO(self.fullpath, 'r+', load_namespaces=True)
-        self.nwb = self.io.read()      #reads NWB file
+        self._h5 = h5py.File(self.fullpath, 'r')
+        self._nwb = None   #read on first use
+
+
+    def close_io(self):
+        """Closes the NWB file and the handle on its HDF5 layout."""
+        self._h5.close()
+        self.io.close()
+
+
+    @property
+    def h5(self):
+        """HDF5 file of the NWB file, opened read-only in the same process,
+           so that it sees what io writes."""
+        return self._h5
+
+
+    @property
+    def nwb(self):
+        """NWB file contents, read on first use."""
+        if self._nwb is None:
+            t0 = time.time()
+            self._nwb = self.io.read()
+            print('NWB file contents read in {:.2f} s'.format(time.time() - t0))
+        return self._nwb
+
+
+    @nwb.setter
+    def nwb(self, nwb):
+        self._nwb = nwb
+
 
+    @property
+    def source(self):
+        """NWB object of the plotted signals, from the file contents on first use."""
+        if self._source is None:
+            kind, name = self.sourceKind
+            if kind == 'raw':
+                self._source = self.nwb.acquisition[name]
+            elif kind == 'preprocessed':
+                self._source = self.nwb.processing['ecephys'].data_interfaces['LFP'].electrical_series['preprocessed']
+            elif kind == 'high gamma':
+                self._source = self.nwb.processing['ecephys'].data_interfaces['high_gamma']
+        return self._source
+
+
+    @source.setter
+    def source(self, source):
+        self._source = source
+
+
+    def find_source(self):
+        """Finds the signals to plot in the HDF5 layout of the file: high gamma,
+           or else preprocessed, or else raw data."""
+        self._source = None
+        path = None
         #Tries to load Raw data
-        lis = list(self.nwb.acquisition.keys())
         there_is_raw = False
-        for i in lis:  # Check if there is ElectricalSeries in acquisition group
-            if type(self.nwb.acquisition[i]).__name__ == 'ElectricalSeries':
-                self.source = self.nwb.acquisition[i]
+        for i in self.h5.get('acquisition', {}):  # Check if there is ElectricalSeries in acquisition group
+            if read_attr(self.h5['acquisition'][i], 'neurodata_type') == 'ElectricalSeries':
+                path = 'acquisition/' + i
+                self.sourceKind = ('raw', i)
                 self.parent.combo3.setCurrentIndex(self.parent.combo3.findText('raw'))
                 there_is_raw = True
         if not there_is_raw:
             print("No 'ElectricalSeries' object in 'acquisition' group.")
         #Tries to load preprocessed data
-        try:
-            self.source = self.nwb.processing['ecephys'].data_interfaces['LFP'].electrical_series['preprocessed']
+        if 'processing/ecephys/LFP/preprocessed' in self.h5:
+            path = 'processing/ecephys/LFP/preprocessed'
+            self.sourceKind = ('preprocessed', 'preprocessed')
             self.parent.combo3.setCurrentIndex(self.parent.combo3.findText('preprocessed'))
             self.parent.push5_0.setEnabled(True)
             self.parent.push6_0.setEnabled(False)
             self.parent.push7_0.setEnabled(True)
-        except:
+        else:
             print("No 'preprocessed' data in 'processing' group.")
         #Tries to load High Gamma data
-        try:
-            self.source = self.nwb.processing['ecephys'].data_interfaces['high_gamma']
+        if 'processing/ecephys/high_gamma' in self.h5:
+            path = 'processing/ecephys/high_gamma'
+            self.sourceKind = ('high gamma', 'high_gamma')
             self.parent.combo3.setCurrentIndex(self.parent.combo3.findText('high gamma'))
             self.parent.push5_0.setEnabled(False)
             self.parent.push6_0.setEnabled(False)
             self.parent.push7_0.setEnabled(False)
-        except:
+        else:
             print("No 'high_gamma' data in 'processing' group.")
-        self.plotData = self.source.data
-        self.fs_signal = self.source.rate     #sampling frequency [Hz]
+        self.plotData = self.h5[path]['data']
+        if 'starting_time' in self.h5[path]:
+            self.fs_signal = self.h5[path]['starting_time'].attrs['rate']     #sampling frequency [Hz]
+        else:
+            self.fs_signal = self.source.rate
         self.tbin_signal = 1/self.fs_signal #time bin duration [seconds]
-        self.nBins = self.source.data.shape[0]     #total number of bins
-        self.nChTotal = self.source.data.shape[1]     #total number of channels
+        self.nBins = self.plotData.shape[0]     #total number of bins
+        self.nChTotal = self.plotData.shape[1]     #total number of channels
         self.allChannels = np.arange(0, self.nChTotal)  #array with all channels
 
-        # Get Brain regions present in current file
-        self.all_regions = list(set(self.nwb.electrodes['location'][:].tolist()))
-        self.all_regions.sort()
-        self.regions_mask = [True]*len(self.all_regions)
-
-        self.channels_mask = np.ones(len(self.nwb.electrodes['location'][:]))
-        self.channels_mask_ind = np.where(self.channels_mask)[0]
-
-        self.h = []
-        self.text = []
-        self.AnnotationsList = []
-        self.AnnotationsPosAV = np.array([])    #(x, y_va, y_off)
-        self.unsaved_changes_annotation = False
-        self.unsaved_changes_interval = False
-
-        # Channels to show
-        self.firstCh = int(self.parent.qline1.text())
-        self.lastCh = int(self.parent.qline0.text())
-        self.nChToShow = self.lastCh - self.firstCh + 1
-        self.selectedChannels = np.arange(self.firstCh-1, self.lastCh)
-
-        self.current_rect = []
-        self.badChannels = np.where( self.nwb.electrodes['bad'][:] )[0].tolist()
 
+    def load_intervals_and_stimuli(self, t_start):
+        """Loads intervals and stimuli, after the first page is shown, and
+           reports the startup times."""
         # Load invalid intervals from NWB file
-        self.allIntervals = []
-        if self.nwb.invalid_times is not None:
-            self.nBI = self.nwb.invalid_times.columns[0][:].shape[0] #number of BI
-            for ii in np.arange(self.nBI):
-                # create new interval
-                obj = CustomInterval()
-                obj.start = self.nwb.invalid_times.columns[0][ii]
-                obj.stop = self.nwb.invalid_times.columns[1][ii]
-                obj.type = 'invalid'
-                obj.color = 'red'
-                obj.session = ''
-                self.allIntervals.append(obj)
-
-        # Plot interval rectangles at upper and middle pannels
-        self.IntRects1 = np.array([], dtype = 'object')
-        self.IntRects2 = np.array([], dtype = 'object')
-        for i, obj in enumerate(self.allIntervals):
-            start = obj.start
-            stop = obj.stop
-            # on timeline
-            c = pg.QtGui.QGraphicsRectItem(start, -1, max(stop-start, 0.01), 2)
-            self.IntRects1 = np.append(self.IntRects1, c)
-            c.setPen(pg.mkPen(color = 'r'))
-            c.setBrush(QtGui.QColor(255, 0, 0, 120))
-            self.parent.win2.addItem(c)
-            # on signals plot
-            c = pg.QtGui.QGraphicsRectItem(start, -1, max(stop-start, 0.01), 2)
-            self.IntRects2 = np.append(self.IntRects2, c)
-            c.setPen(pg.mkPen(color = 'r'))
-            c.setBrush(QtGui.QColor(255, 0, 0, 120))
-            self.parent.win1.addItem(c)
+        if 'intervals/invalid_times' in self.h5:
+            # one read per column
+            invalid_times = self.h5['intervals/invalid_times']
+            starts = invalid_times['start_time'][:]
+            stops = invalid_times['stop_time'][:]
+            self.allIntervals = make_intervals(starts, stops, 'invalid', 'red', '') + self.allIntervals
+            self.nBI = len(self.allIntervals) #number of BI
+            self.intervalIndex = None
 
         # Add Speaker and Mic Intervals if they exist
         self.SpeakerAndMicIntervalAdd()
 
         # Load stimuli signals (audio)
         self.load_stimuli()
-
-        # Initiate plots
-        self.updateCurXAxisPosition()
         self.refreshScreen()
+        self.startup_times['all'] = time.time() - t_start
+        print('ecogVIS startup: file opened in {open:.2f} s, first page in '
+              '{first page:.2f} s, intervals and stimuli in {all:.2f} s'.format(**self.startup_times))
 
 
     def load_stimuli(self):
-        """Loads stimuli signals (speaker audio)."""
-        self.nStim = len(self.nwb.stimulus)
-        self.stimList = list(self.nwb.stimulus.keys())
-        self.stimX = []
+        """Loads stimuli signals (speaker audio). Their time axes are computed
+           from their rates for the plotted window only."""
+        stimulus = self.h5.get('stimulus/presentation', {})
+        self.stimList = list(stimulus.keys())
+        self.nStim = len(self.stimList)
         self.stimY = {}
+        self.stimRate = {}
         self.parent.combo4.clear()
         for stim in self.stimList:
             self.parent.combo4.addItem(stim)   #add stimulus name to dropdown button
-            dt_stim = 1./self.nwb.stimulus[stim].rate
-            nb_stim = self.nwb.stimulus[stim].data.shape[0]
-            self.stimX = np.linspace(dt_stim, nb_stim*dt_stim, nb_stim)
-            self.stimY[stim] = self.nwb.stimulus[stim].data
+            self.stimRate[stim] = stimulus[stim]['starting_time'].attrs['rate']
+            self.stimY[stim] = stimulus[stim]['data']
         else:
             self.disp_audio = 0
 
 
     def refresh_file(self):
         """Re-opens the current file, for when new data is included"""
-        self.io.close()   #closes current NWB file
-        self.io = pynwb.NWBHDF5IO(self.fullpath, 'r+', load_namespaces=True)
-        self.nwb = self.io.read()      #reads NWB file
+        self.stop_threads()
+        self.close_io()   #closes current NWB file
+        self.open_io()
         # Searches for signal source on file
-        try:   #Tries to load Raw data
-            lis = list(self.nwb.acquisition.keys())
-            for i in lis:  # Check if there is ElectricalSeries in acquisition group
-                if type(self.nwb.acquisition[i]).__name__ == 'ElectricalSeries':
-                    self.source = self.nwb.acquisition[i]
-                    self.parent.combo3.setCurrentIndex(self.parent.combo3.findText('raw'))
-        except: None
-        try:  #Tries to load preprocessed data
-            self.source = self.nwb.processing['ecephys'].data_interfaces['LFP'].electrical_series['preprocessed']
-            self.parent.combo3.setCurrentIndex(self.parent.combo3.findText('preprocessed'))
-        except: None
-        try:  #Tries to load High Gamma data
-            self.source = self.nwb.processing['ecephys'].data_interfaces['high_gamma']
-            self.parent.combo3.setCurrentIndex(self.parent.combo3.findText('high gamma'))
-        except: None
-        self.plotData = self.source.data
-        self.fs_signal = self.source.rate     #sampling frequency [Hz]
-        self.tbin_signal = 1/self.fs_signal #time bin duration [seconds]
-        self.nBins = self.source.data.shape[0]     #total number of bins
+        self.find_source()
+        for lod in self.lod.values():  #pyramids are checked again on use
+            if lod is not None:
+                lod.close()
+        self.lod = {}
+        self.lod_failed = set()
+        self.tiles = None
         self.load_stimuli()  #load stimuli signals (audio)
+        self.stimYRange = {}
+        self.drawnStim = None
+        self.drawnWindow = None   #the data may have changed, draws it again
+        self.drawnSignals = None
         self.updateCurXAxisPosition()
 
 
@@ -179,22 +264,225 @@ class TimeSeriesPlotter:
         self.TimeSeries_plotter()
 
 
+    def lod_file(self, name):
+        """Sidecar file with the min/max pyramid of dataset 'name'."""
+        return os.path.join(self.pathName, os.path.splitext(self.fileName)[0]
+                            + '_lod_' + name.strip('/').replace('/', '_') + '.h5')
+
+
+    def get_lod(self, start, end, channels):
+        """Min/max pyramid of the plotted data, or None if not available.
+           A missing pyramid is built in the background (reading the whole
+           signals once) only when samples [start, end) of channels are too
+           big to be read from the tile cache, as for prefetch_pages, and the
+           screen is refreshed when it is ready."""
+        name = self.plotData.name
+        if name not in self.lod:
+            self.lod[name] = open_minmax_pyramid(self.lod_file(name),
+                                                 self.plotData, name)
+        nbytes = (end - start) * len(channels) * 4
+        if (self.lod[name] is None and self.lod_thread is None and
+                name not in self.lod_failed and
+                nbytes > self.get_tiles().tiles.max_bytes / 4):
+            thread = LODBuildFunction(self.plotData, self.lod_file(name), name)
+            thread.finished.connect(lambda: self.lod_ready(thread))
+            self.lod_thread = thread
+            thread.start()
+        return self.lod[name]
+
+
+    def stop_threads(self):
+        """Stops the threads reading the file (tiles and pyramids), before it
+           is closed. Their pending results are ignored."""
+        self.prefetch_next = None
+        for thread in [self.prefetch_thread, self.lod_thread]:
+            if thread is not None:
+                thread.stop()
+                thread.wait()
+        self.prefetch_thread = None
+        self.lod_thread = None
+
+
+    def lod_ready(self, thread):
+        """Stores a pyramid built by LODBuildFunction and re-draws."""
+        if thread is not self.lod_thread:  #stopped
+            return
+        name = thread.name
+        self.lod[name] = thread.pyramid
+        if self.lod[name] is None:  #not built again on every refresh
+            self.lod_failed.add(name)
+        self.lod_thread = None
+        self.refreshScreen()
+
+
+    def init_plot_items(self):
+        """Creates the plot items, which are kept and updated with setData
+           on every refresh instead of being re-created."""
+        plt1 = self.parent.win2  #upper horizontal bar
+        plt2 = self.parent.win1  #middle signal plot
+        plt3 = self.parent.win3  #lower audio plot
+        # Channels reference lines, as one item of separate segments
+        self.refLines = pg.PlotDataItem(pen='k', connect='pairs')
+        plt2.addItem(self.refLines)
+        # Signals, one path per pen or one item per channel (see set_single_path)
+        self.single_path = True
+        self.pens = {'bad': pg.mkPen((220,0,0), width=1.2),
+                     'even': pg.mkPen((0,0,200), width=1.2),
+                     'odd': pg.mkPen((0,120,0), width=1.2)}
+        self.pathCurves = {}
+        for key, pen in self.pens.items():
+            self.pathCurves[key] = pg.PlotDataItem(pen=pen)
+            plt2.addItem(self.pathCurves[key])
+        self.channelCurves = []
+        self.shownItems = {'win1': set(), 'win2': set()}
+        self.drawnWindow = None     #(source, startSamp, endSamp) on the plots
+        self.drawnSignals = None    #inputs of the signals on the plots
+        self.drawnChannels = None   #(selectedChannels, badChannels) of the pens
+        self.drawnTimes = None      #(first, last) time on the signals plot
+        self.drawnXRange = None
+        self.drawnStim = None       #(stimName, startSamp, endSamp) on the plots
+        self.stimYRange = {}
+        plt2.setLabel('bottom', 'Time', units = 'sec')
+        plt2.setLabel('left', 'Channel #')
+        plt2.getAxis('left').setWidth(w=53)
+        # Upper horizontal bar
+        self.timeline = plt1.plot(pen=pg.mkPen('k', width=2))
+        self.current_rect = CustomBox(self, 0, -1000, 1, 2000)
+        self.current_rect.setPen(pg.mkPen(color=(0,0,0,50)))
+        self.current_rect.setBrush(QtGui.QColor(0,0,0,50))
+        self.current_rect.setFlags(QtGui.QGraphicsItem.ItemIsMovable)
+        plt1.addItem(self.current_rect)
+        plt1.setYRange(-1, 1)
+        plt1.setLabel('left', 'Span')
+        plt1.getAxis('left').setWidth(w=53)
+        plt1.getAxis('left').setStyle(showValues=False)
+        plt1.getAxis('left').setTicks([])
+        # Bottom plot - Stimuli
+        self.stimCurve = plt3.plot(pen='k')
+        plt3.setXLink(plt2)
+        plt3.setLabel('left', 'Stim')
+        plt3.getAxis('left').setWidth(w=53)
+        plt3.getAxis('left').setStyle(showValues=False)
+        plt3.getAxis('left').setTicks([])
+        #set colors
+        plt1.getAxis('left').setPen(pg.mkPen(color=(50,50,50)))
+        plt2.getAxis('left').setPen(pg.mkPen(color=(50,50,50)))
+        plt2.getAxis('bottom').setPen(pg.mkPen(color=(50,50,50)))
+        plt3.getAxis('left').setPen(pg.mkPen(color=(50,50,50)))
+
+
+    def show_items(self, win, items):
+        """Shows exactly 'items' (e.g. interval rectangles) of those managed
+           here on plot 'win', adding and removing only the ones that changed."""
+        plt = getattr(self.parent, win)
+        items = set(items)
+        for item in self.shownItems[win] - items:
+            plt.removeItem(item)
+        for item in items - self.shownItems[win]:
+            plt.addItem(item)
+        self.shownItems[win] = items
+
+
     def TimeSeries_plotter(self):
-        """Plots time series signals"""
+        """Plots time series signals. Only the parts of the plots whose inputs
+           changed since the last call are updated: e.g. the signals are not
+           read nor set again when only intervals or annotations changed."""
         startSamp = self.intervalStartSamples
         endSamp = self.intervalEndSamples
+        new_window = (self.plotData.name, startSamp, endSamp) != self.drawnWindow
 
-        #Bins to plot - subsample for too big arrays
+        #Bins to plot - min/max envelope of each bin for too big arrays
         maxBins = 1000
+        lod = None
+        if endSamp - startSamp > maxBins:
+            lod = self.get_lod(startSamp, endSamp, self.selectedChannels)
+        signals = (self.plotData.name, startSamp, endSamp,
+                   tuple(self.selectedChannels), self.parent.qline4.text(),
+                   tuple(self.badChannels), self.single_path, lod is not None)
+        if signals != self.drawnSignals:
+            self.plot_signals(startSamp, endSamp, lod, maxBins)
+            self.drawnSignals = signals
+        t0, t1 = self.drawnTimes
+        scale_va = self.scaleVec[0]
+
+        # Show Intervals and Annotations
+        intRects = self.interval_items(t0, t1)
+        for i in range(len(self.AnnotationsList)):
+            aux = self.AnnotationsList[i].pg_item
+            x = self.AnnotationsPosAV[i,0]
+            # Y to plot = (Y_va + Channel offset)*scale_variance
+            y_va = self.AnnotationsPosAV[i,1]
+            y = (y_va + self.AnnotationsPosAV[i,2] - self.firstCh) * scale_va
+            aux.setPos(x,y)
+        self.show_items('win1', intRects +
+                        [ann.pg_item for ann in self.AnnotationsList])
+
+        # Upper horizontal bar
+        if new_window:
+            plt1 = self.parent.win2
+            max_dur = self.nBins * self.tbin_signal
+            self.timeline.setData([0, max_dur], [0, 0])
+            plt1.setXRange(0, max_dur)
+
+            ## Rectangle Plot
+            x = float(self.parent.qline2.text())
+            w = float(self.parent.qline3.text())
+            self.current_rect.setPos(0, 0)
+            self.current_rect.setRect(x, -1000, w, 2000)
+
+        # Show Intervals
+        self.show_items('win2', [] if self.intervalBars is None else [self.intervalBars])
+
+        # Bottom plot - Stimuli
+        plt3 = self.parent.win3
+        stimName = self.parent.combo4.currentText()
+        if stimName != '' and (stimName, startSamp, endSamp) != self.drawnStim:
+            stimData = self.stimY[stimName]
+            rate = self.stimRate[stimName]
+            # Samples strictly inside the window, sample i is at (i+1)/rate
+            nStimBins = stimData.shape[0]
+            i0 = min(max(int(np.floor(t0*rate)), 0), nStimBins)
+            i1 = min(max(int(np.ceil(t1*rate)) - 1, i0), nStimBins)
+            self.stimCurve.setData(np.arange(i0+1, i1+1)/rate, stimData[i0:i1])
+            if stimName not in self.stimYRange:
+                self.stimYRange[stimName] = (np.min(stimData), np.max(stimData))
+            plt3.setYRange(*self.stimYRange[stimName])
+            self.drawnStim = (stimName, startSamp, endSamp)
+
+        self.drawnWindow = (self.plotData.name, startSamp, endSamp)
+
+
+    def plot_signals(self, startSamp, endSamp, lod, maxBins):
+        """Plots the signals of samples [startSamp, endSamp), with the min/max
+           envelope of lod (a pyramid, or None) or a decimation of the samples
+           if the window is longer than maxBins, and their reference lines."""
         ratio_to_max = (endSamp-startSamp)/maxBins
-        if ratio_to_max > 1:
-            bins_to_plot = np.linspace(startSamp, endSamp, maxBins, dtype='int')
-        else:
-            bins_to_plot = np.arange(startSamp, endSamp, dtype='int')
+        envelope = None
+        if lod is not None:
+            envelope = lod.read(startSamp, endSamp,
+                                self.selectedChannels-1, maxBins)
 
         # Use the same scaling factor for all channels, to keep things comparable
         self.verticalScaleFactor = float(self.parent.qline4.text())
-        scaleFac = 2*np.std(self.plotData[startSamp:endSamp, self.selectedChannels-1], axis=0)/self.verticalScaleFactor
+        if envelope is not None:
+            samples, Y_min, Y_max, means, stds = envelope
+            scaleFac = 2*stds/self.verticalScaleFactor
+            # Minimum and maximum of each bin, one after the other
+            bins_to_plot = np.repeat(samples, 2)
+            data = np.stack((Y_min, Y_max), axis=2).reshape(len(Y_min), -1)
+            means = np.reshape(means, (-1, 1))
+        else:
+            if ratio_to_max > 1:
+                bins_to_plot = np.linspace(startSamp, endSamp, maxBins, dtype='int')
+            else:
+                bins_to_plot = np.arange(startSamp, endSamp, dtype='int')
+            window = self.read_window(startSamp, endSamp, self.selectedChannels-1)
+            scaleFac = 2*np.std(window, axis=0)/self.verticalScaleFactor
+            # constrains the plotData to the chosen interval (and transpose matix)
+            # plotData dims=[self.nChToShow, plotInterval]
+            data = window.T
+            data = data[:,bins_to_plot-startSamp-1]
+            means = np.reshape(np.mean(data, 1),(-1,1))  #to align each trace around its reference trace
 
         # Scale variance_units, offset for each channel
         scale_va = np.max(scaleFac)
@@ -203,121 +491,114 @@ class TimeSeriesPlotter:
         scaleV = np.zeros([len(self.scaleVec), 1])
         scaleV[:, 0] = self.scaleVec
 
-        # constrains the plotData to the chosen interval (and transpose matix)
-        # plotData dims=[self.nChToShow, plotInterval]
-        data = self.plotData[startSamp:endSamp, self.selectedChannels-1].T
-        data = data[:,bins_to_plot-startSamp-1]
-        means = np.reshape(np.mean(data, 1),(-1,1))  #to align each trace around its reference trace
         plotData = data + scaleV - means  # data + offset
 
         # Middle signals plot
         # A line indicating reference for every channel
         timebaseGuiUnits = bins_to_plot*self.tbin_signal
-        #timebaseGuiUnits = np.arange(startSamp, endSamp)*self.tbin_signal
+        self.drawnTimes = (timebaseGuiUnits[0], timebaseGuiUnits[-1])
         plt2 = self.parent.win1  #middle signal plot
-        plt2.clear()
         #Channels reference lines
-        for l in range(len(self.scaleVec)):
-            plt2.plot([timebaseGuiUnits[0], timebaseGuiUnits[-1]],
-                      [self.scaleVec[l], self.scaleVec[l]],
-                      pen='k')
+        self.refLines.setData(
+            x=np.tile([timebaseGuiUnits[0], timebaseGuiUnits[-1]], len(self.scaleVec)),
+            y=np.repeat(self.scaleVec, 2))
 
-        # Iterate over chosen channels, plot one at a time
+        # Pen and label of each channel, when channels change
         nrows, ncols = np.shape(plotData)
-        for i in range(nrows):
-            if self.selectedChannels[i] in self.badChannels:
-                plt2.plot(timebaseGuiUnits, plotData[i], pen=pg.mkPen((220,0,0), width=1.2))
-            else:
-                c = pg.mkPen((0,120,0), width=1.2)
-                if i%2 == 0:
-                    c = pg.mkPen((0,0,200), width=1.2)
-                plt2.plot(timebaseGuiUnits, plotData[i], pen=c)
-        plt2.setLabel('bottom', 'Time', units = 'sec')
-        plt2.setLabel('left', 'Channel #')
-        labels = [str(ch+1) for ch in self.selectedChannels]
-        ticks = list(zip(self.scaleVec, labels))
+        channels = (tuple(self.selectedChannels), tuple(self.badChannels))
+        if channels != self.drawnChannels:
+            self.rowPens = np.where(np.arange(nrows)%2 == 0, 'even', 'odd')
+            self.rowPens[np.isin(self.selectedChannels[:nrows], self.badChannels)] = 'bad'
+            self.channelLabels = [str(ch+1) for ch in self.selectedChannels]
+            self.drawnChannels = channels
+        pens = self.rowPens
+        if self.single_path:
+            # All channels of a pen as one path, disconnected between channels
+            connect = np.ones(ncols, dtype=bool)
+            connect[-1] = False
+            for key, curve in self.pathCurves.items():
+                rows = np.where(pens == key)[0]
+                curve.setData(x=np.tile(timebaseGuiUnits, len(rows)),
+                              y=plotData[rows].ravel(),
+                              connect=np.tile(connect, len(rows)))
+            for curve in self.channelCurves:
+                curve.setData([], [])
+        else:
+            # One item per channel, created only when more channels are shown
+            while len(self.channelCurves) < nrows:
+                self.channelCurves.append(plt2.plot())
+            for i, curve in enumerate(self.channelCurves):
+                if i < nrows:
+                    curve.setData(timebaseGuiUnits, plotData[i])
+                    curve.setPen(self.pens[pens[i]])
+                else:
+                    curve.setData([], [])
+            for curve in self.pathCurves.values():
+                curve.setData([], [])
+        ticks = list(zip(self.scaleVec, self.channelLabels))
         plt2.getAxis('left').setTicks([ticks])
-        plt2.setXRange(timebaseGuiUnits[0], timebaseGuiUnits[-1], padding = 0.003)
+        if self.drawnTimes != self.drawnXRange:
+            plt2.setXRange(timebaseGuiUnits[0], timebaseGuiUnits[-1], padding = 0.003)
+            self.drawnXRange = self.drawnTimes
         plt2.setYRange(self.scaleVec[0], self.scaleVec[-1], padding = 0.06)
-        plt2.getAxis('left').setWidth(w=53)
+        if envelope is None:
+            self.prefetch_pages(startSamp, endSamp, self.selectedChannels-1)
 
-        # Show Intervals
-        for i in range(len(self.IntRects2)):
-            plt2.removeItem(self.IntRects2[i])
-        for i in range(len(self.IntRects2)):
-            plt2.addItem(self.IntRects2[i])
 
-        # Show Annotations
-        for i in range(len(self.AnnotationsList)):
-            plt2.removeItem(self.AnnotationsList[i])
-        for i in range(len(self.AnnotationsList)):
-            aux = self.AnnotationsList[i].pg_item
-            x = self.AnnotationsPosAV[i,0]
-            # Y to plot = (Y_va + Channel offset)*scale_variance
-            y_va = self.AnnotationsPosAV[i,1]
-            y = (y_va + self.AnnotationsPosAV[i,2] - self.firstCh) * scale_va
-            aux.setPos(x,y)
-            plt2.addItem(aux)
+    def set_single_path(self, single_path):
+        """Draws the signals as one path per pen (single_path=True, default,
+           fastest) or as one item per channel (e.g. to style or pick
+           channels individually), and re-draws them."""
+        self.single_path = single_path
+        self.refreshScreen()
 
-        # Upper horizontal bar
-        plt1 = self.parent.win2
-        plt1.clear()
-        max_dur = self.nBins * self.tbin_signal
-        plt1.plot([0, max_dur], [0, 0], pen=pg.mkPen('k', width=2))
-        plt1.setXRange(0, max_dur)
-        plt1.setYRange(-1, 1)
 
-        if self.current_rect != []:
-            plt1.removeItem(self.current_rect)
+    def get_tiles(self):
+        """Tile cache of the plotted data, which serves all reads of it."""
+        if self.tiles is None or self.tiles.source.name != self.plotData.name:
+            self.tiles = TileCache(self.plotData)
+        return self.tiles
 
-        ## Rectangle Plot
-        x = float(self.parent.qline2.text())
-        w = float(self.parent.qline3.text())
-        self.current_rect = CustomBox(self, x, -1000, w, 2000)
-        self.current_rect.setPen(pg.mkPen(color=(0,0,0,50)))
-        self.current_rect.setBrush(QtGui.QColor(0,0,0,50))
-        self.current_rect.setFlags(QtGui.QGraphicsItem.ItemIsMovable)
-        plt1.addItem(self.current_rect)
-        plt1.setLabel('left', 'Span')
-        plt1.getAxis('left').setWidth(w=53)
-        plt1.getAxis('left').setStyle(showValues=False)
-        plt1.getAxis('left').setTicks([])
 
-        # Show Intervals
-        for i in range(len(self.IntRects1)):
-            plt1.removeItem(self.IntRects1[i])
-        for i in range(len(self.IntRects1)):
-            plt1.addItem(self.IntRects1[i])
+    def read_window(self, start, end, channels):
+        """Samples [start, end) of channels, dims=[samples, channels]."""
+        return self.get_tiles().read(start, end, channels)
 
-        # Bottom plot - Stimuli
-        plt3 = self.parent.win3
-        plt3.clear()
-        if self.parent.combo4.currentText() is not '':
-            try:
-                xmask = (self.stimX > timebaseGuiUnits[0]) * (self.stimX < timebaseGuiUnits[-1])
-                stimName = self.parent.combo4.currentText()
-                stimData = self.stimY[stimName]
-                plt3.plot(self.stimX[xmask], stimData[xmask], pen='k', width=1)
-                plt3.setXLink(plt2)
-            except:  #THIS IS MOMENTARY TO PLOT ARTIFICIAL DATA-- REMOVE LATER
-                stimName = self.parent.combo4.currentText()
-                stimData = self.stimY[stimName]
-                plt3.plot(stimData, pen='k', width=1)
-                # remove this later -------------------------------------------
-        
-        plt3.setLabel('left', 'Stim')
-        plt3.setYRange(np.min(stimData), np.max(stimData))
-        plt3.getAxis('left').setWidth(w=53)
-        plt3.getAxis('left').setStyle(showValues=False)
-        plt3.getAxis('left').setTicks([])
 
-        #set colors
-        plt1.getAxis('left').setPen(pg.mkPen(color=(50,50,50)))
-        plt2.getAxis('left').setPen(pg.mkPen(color=(50,50,50)))
-        plt2.getAxis('bottom').setPen(pg.mkPen(color=(50,50,50)))
-        plt3.getAxis('left').setPen(pg.mkPen(color=(50,50,50)))
+    def prefetch_pages(self, start, end, channels):
+        """Reads, in the background, the tiles of the pages before and after
+           samples [start, end) of channels, so that scrolling renders from
+           memory."""
+        tiles = self.get_tiles()
+        length = end - start
+        keys = tiles.missing(max(start - length, 0), min(end + length, self.nBins), channels)
+        # Pages too big for the cache are not read ahead
+        nbytes = len(keys) * tiles.tile_len * tiles.block_size * 4
+        if len(keys) == 0 or nbytes > tiles.tiles.max_bytes / 4:
+            return
+        if self.prefetch_thread is not None:  #read after the current ones
+            self.prefetch_next = keys
+        else:
+            self.start_prefetch(keys)
 
 
+    def start_prefetch(self, keys):
+        thread = TileReadFunction(self.get_tiles(), keys)
+        thread.tile_ready.connect(self.get_tiles().put)
+        thread.finished.connect(lambda: self.prefetch_done(thread))
+        self.prefetch_thread = thread
+        thread.start()
+
+
+    def prefetch_done(self, thread):
+        """Starts reading the last tiles requested while others were read."""
+        if thread is not self.prefetch_thread:  #stopped
+            return
+        self.prefetch_thread = None
+        keys, self.prefetch_next = self.prefetch_next, None
+        if keys is not None:
+            self.start_prefetch(keys)
+
 
     def drag_window(self, dt):
         """Updates upper visualization window position when dragged by the user."""
@@ -614,35 +895,30 @@ class TimeSeriesPlotter:
         session : str
             Session name.
         """
-        if color=='yellow':
-            bc = [250, 250, 150, 180]
-        elif color=='red':
-            bc = [250, 0, 0, 100]
-        elif color=='green':
-            bc = [0, 255, 0, 130]
-        elif color=='blue':
-            bc = [0, 0, 255, 100]
-        x = interval[0]
-        w = np.diff(np.array(interval))[0]
-        # add rectangle to upper plot
-        c = pg.QtGui.QGraphicsRectItem(x, -1, w, 2)
-        c.setPen(pg.mkPen(color=QtGui.QColor(bc[0], bc[1], bc[2], 255)))
-        c.setBrush(QtGui.QColor(bc[0], bc[1], bc[2], bc[3]))
-        self.IntRects1 = np.append(self.IntRects1, [c])
-        # add rectangle to middle signal plot
-        c = pg.QtGui.QGraphicsRectItem(x, -1, w, 2)
-        c.setPen(pg.mkPen(color=QtGui.QColor(bc[0], bc[1], bc[2], 255)))
-        c.setBrush(QtGui.QColor(bc[0], bc[1], bc[2], bc[3]))
-        self.IntRects2 = np.append(self.IntRects2, [c])
-        # new Interval object
-        obj = CustomInterval()
-        obj.start = interval[0]
-        obj.stop = interval[1]
-        obj.type = int_type
-        obj.color = color
-        obj.session = session
-        self.allIntervals.append(obj)
+        self.IntervalsAdd([interval[0]], [interval[1]], int_type, color, session)
+
+
+    def IntervalsAdd(self, starts, stops, int_type, color, session):
+        """
+        Adds new intervals of the same type to plot scene.
+
+        Parameters
+        ----------
+        starts : array of floats
+            Start times of the intervals.
+        stops : array of floats
+            Stop times of the intervals.
+        int_type : str
+            Type of the intervals (e.g. 'invalid').
+        color :
+            'yellow', 'red', 'green' or 'blue'.
+        session : str
+            Session name.
+        """
+        # new Interval objects, drawn by interval_items
+        self.allIntervals.extend(make_intervals(starts, stops, int_type, color, session))
         self.nBI = len(self.allIntervals)
+        self.intervalIndex = None
         self.unsaved_changes_interval = True
 
 
@@ -657,16 +933,42 @@ class TimeSeriesPlotter:
         """
         for i, obj in enumerate(self.allIntervals):
             if (x >= obj.start) & (x <= obj.stop):   #interval of the click
-                self.parent.win2.removeItem(self.IntRects1[i])
-                self.IntRects1 = np.delete(self.IntRects1, i, axis = 0)
-                self.parent.win1.removeItem(self.IntRects2[i])
-                self.IntRects2 = np.delete(self.IntRects2, i, axis = 0)
                 del self.allIntervals[i]
                 self.nBI = len(self.allIntervals)
+                self.intervalIndex = None
                 self.refreshScreen()
                 self.unsaved_changes_interval = True
 
 
+    def interval_items(self, t0, t1):
+        """Returns the rectangles of the intervals overlapping [t0, t1], for
+           the signals plot. Only those are created, and kept while visible.
+           All intervals are drawn on the upper bar as one item."""
+        if self.intervalIndex is None:  #intervals changed
+            starts = np.array([obj.start for obj in self.allIntervals], dtype='float')
+            stops = np.array([obj.stop for obj in self.allIntervals], dtype='float')
+            self.intervalIndex = IntervalIndex(starts, stops)
+            self.intervalBars = None
+            if len(self.allIntervals) > 0:
+                bcs = [INTERVAL_COLORS[obj.color] for obj in self.allIntervals]
+                self.intervalBars = pg.BarGraphItem(
+                    x0=starts, x1=np.maximum(stops, starts + 0.01), y0=-1, height=2,
+                    pens=[pg.mkPen(color=QtGui.QColor(bc[0], bc[1], bc[2], 255)) for bc in bcs],
+                    brushes=[QtGui.QColor(*bc) for bc in bcs])
+        rects = {}
+        for i in self.intervalIndex.overlapping(t0, t1):
+            obj = self.allIntervals[i]
+            rects[obj] = self.intervalRects.get(obj)
+            if rects[obj] is None:
+                bc = INTERVAL_COLORS[obj.color]
+                c = pg.QtGui.QGraphicsRectItem(obj.start, -1, max(obj.stop-obj.start, 0.01), 2)
+                c.setPen(pg.mkPen(color=QtGui.QColor(bc[0], bc[1], bc[2], 255)))
+                c.setBrush(QtGui.QColor(bc[0], bc[1], bc[2], bc[3]))
+                rects[obj] = c
+        self.intervalRects = rects
+        return list(rects.values())
+
+
     def IntervalSave(self):
         """Saves intervals in an external CSV file."""
         buttonReply = QMessageBox.question(None, ' ', 'Save intervals on external file?',
@@ -691,31 +993,25 @@ class TimeSeriesPlotter:
     def IntervalLoad(self, fname):
         """Loads intervals from an external CSV file."""
         df = pd.read_csv(fname)
-        for index, row in df.iterrows():    # Add loaded intervals to graph
-            interval = [row.start, row.stop]
-            int_type = row.type
-            color = row.color
-            session = row.session
-            self.IntervalAdd(interval, int_type, color, session)
+        # Add loaded intervals to graph
+        for start, stop, int_type, color, session in zip(
+                df['start'], df['stop'], df['type'], df['color'], df['session']):
+            self.IntervalAdd([start, stop], int_type, color, session)
             #Update dictionary of interval types
             # TO-DO
         self.refreshScreen()
 
 
     def SpeakerAndMicIntervalAdd(self):
-        if self.nwb.intervals is not None:
+        if 'intervals' in self.h5:
             keys = ['TimeIntervals_speaker','TimeIntervals_mic']
             colors = ['blue','green']
             for name,color in zip(keys,colors):
-                if name in self.nwb.intervals:
-                    ti = self.nwb.intervals[name]
-                    nI = len(ti)
-                    for ii in np.arange(nI):
-                        interval = [ti['start_time'][ii], ti['stop_time'][ii]]
-                        int_type = name
-                        color = color
-                        session = ''
-                        self.IntervalAdd(interval, int_type, color, session)
+                if name in self.h5['intervals']:
+                    ti = self.h5['intervals'][name]
+                    # one read per column
+                    self.IntervalsAdd(ti['start_time'][:], ti['stop_time'][:],
+                                      name, color, '')
 
 
 
@@ -778,6 +1074,99 @@ class TimeSeriesPlotter:
 
 
 
+# Reads tiles of signals in the background ------------------------------------
+class TileReadFunction(QtCore.QThread):
+    tile_ready = QtCore.pyqtSignal(object, object)   #key, tile
+
+    def __init__(self, tiles, keys):
+        super().__init__()
+        self.tiles = tiles   #TileCache
+        self.keys = keys
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self):
+        for key in self.keys:
+            if self.stopped:
+                return
+            self.tile_ready.emit(key, self.tiles.load(key))
+
+
+# Builds the min/max pyramid of a dataset in the background ------------------
+class LODBuildFunction(QtCore.QThread):
+    def __init__(self, data, path, name):
+        super().__init__()
+        self.data = data
+        self.path = path
+        self.name = name
+        self.pyramid = None
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self):
+        try:
+            self.pyramid = build_minmax_pyramid(self.data, self.path, self.name,
+                                                stopped=lambda: self.stopped)
+        except OSError as e:  #e.g. read-only directory
+            print("Could not build the min/max pyramid of '" + self.name + "': " + str(e))
+
+
+
+class IntervalIndex:
+    """
+    Intervals sorted by start time, to find the ones overlapping a time window
+    in O(log n + overlapping) instead of checking all of them.
+
+    Parameters
+    ----------
+    starts : array
+        Start times of the intervals.
+    stops : array
+        Stop times of the intervals.
+    """
+    def __init__(self, starts, stops):
+        self.order = np.argsort(starts, kind='stable')
+        self.starts = np.asarray(starts, dtype='float')[self.order]
+        self.stops = np.asarray(stops, dtype='float')[self.order]
+        # Intervals overlapping t0 start at most max_len before it
+        self.max_len = max(np.max(self.stops - self.starts, initial=0), 0)
+
+    def overlapping(self, t0, t1):
+        """Indices (in the original order) of the intervals overlapping [t0, t1]."""
+        i0 = np.searchsorted(self.starts, t0 - self.max_len, side='left')
+        i1 = np.searchsorted(self.starts, t1, side='right')
+        return self.order[i0:i1][self.stops[i0:i1] >= t0]
+
+
+def read_attr(obj, name):
+    """HDF5 attribute as str, if it is stored as bytes."""
+    value = obj.attrs.get(name)
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def read_strings(dataset):
+    """HDF5 dataset of strings as an array of str, with one read."""
+    return np.array([v.decode() if isinstance(v, bytes) else v for v in dataset[:]])
+
+
+def make_intervals(starts, stops, int_type, color, session):
+    """Interval objects from arrays of start and stop times."""
+    intervals = []
+    for start, stop in zip(np.asarray(starts).tolist(), np.asarray(stops).tolist()):
+        obj = CustomInterval()
+        obj.start = start
+        obj.stop = stop
+        obj.type = int_type
+        obj.color = color
+        obj.session = session
+        intervals.append(obj)
+    return intervals
+
+
 class CustomInterval:
     """
     Stores information about individual Intervals.
@@ -0,0 +1,110 @@
+import numpy as np
+
+from ecogvis.functions.caching import ArrayCache, TileCache
+
+
+def test_array_cache_lru():
+    """
+    Getting an entry makes it the most recently used, so it is evicted last.
+    """
+    cache = ArrayCache(max_bytes=3 * 800)
+    for key in 'abc':
+        cache.put(key, np.zeros(100))
+    assert cache.get('a') is not None
+    cache.put('d', np.zeros(100))
+    assert 'b' not in cache
+    assert all(key in cache for key in 'acd')
+    assert len(cache) == 3 and cache.nbytes == 3 * 800
+    assert cache.get('b', 'default') == 'default'
+
+
+def test_array_cache_eviction():
+    cache = ArrayCache(max_bytes=1000)
+    cache.put('a', np.zeros(50))
+    cache.put('b', (np.zeros(25), np.zeros(25)))
+    # The least recently used entries are evicted until the new one fits
+    cache.put('c', np.zeros(50))
+    assert list(cache._items) == ['b', 'c']
+    cache.put('d', np.zeros(50))
+    assert list(cache._items) == ['c', 'd']
+    assert cache.nbytes == 800
+    # Entries larger than max_bytes are not stored and evict nothing
+    cache.put('e', np.zeros(126))
+    assert 'e' not in cache
+    assert list(cache._items) == ['c', 'd'] and cache.nbytes == 800
+
+
+def test_array_cache_nbytes():
+    cache = ArrayCache(max_bytes=1000)
+    cache.put('a', np.zeros(50))
+    cache.put('b', np.zeros(10))
+    # Overwriting replaces the size of the previous value
+    cache.put('a', np.zeros(20))
+    assert cache.nbytes == 240
+    assert np.array_equal(cache.pop('a'), np.zeros(20))
+    assert cache.nbytes == 80
+    assert cache.pop('a') is None and cache.nbytes == 80
+    # An overwritten entry that no longer fits is removed
+    cache.put('b', np.zeros(200))
+    assert 'b' not in cache and cache.nbytes == 0
+
+
+def test_array_cache_invalidate():
+    cache = ArrayCache()
+    for key in [('erp', 1), ('erp', 2), ('psd', 1)]:
+        cache.put(key, np.zeros(10))
+    cache.invalidate(lambda key: key[0] == 'erp')
+    assert list(cache._items) == [('psd', 1)]
+    assert cache.nbytes == 80
+    cache.clear()
+    assert len(cache) == 0 and cache.nbytes == 0
+
+
+def test_tile_cache_read():
+    """
+    Windows across tile boundaries, up to the last (partial) tile, of
+    unordered and negative channels of several blocks.
+    """
+    X = np.random.randn(1000, 20)
+    tiles = TileCache(X, tile_len=64, block_size=8)
+    channels = np.array([17, 3, -1, 9, 3, 0])
+    for start, end in [(0, 64), (60, 70), (10, 300), (950, 1000),
+                       (999, 1000), (0, 1000)]:
+        Y = tiles.read(start, end, channels)
+        assert Y.dtype == np.float32
+        assert np.array_equal(Y, X[start:end, channels].astype('float32'))
+    # Last tile is shorter than tile_len
+    assert tiles.tiles.get((15, 0)).shape == (1000 - 15 * 64, 8)
+    assert tiles.keys(60, 70, channels) == [(0, 0), (0, 1), (0, 2),
+                                            (1, 0), (1, 1), (1, 2)]
+
+
+def test_tile_cache_hits():
+    X = np.random.randn(1000, 20)
+    tiles = TileCache(X, tile_len=64, block_size=8)
+    tiles.read(60, 70, [0, 9])
+    assert (tiles.hits, tiles.misses) == (0, 4)
+    # Only the tiles not shared with the previous window are read
+    tiles.read(100, 140, [9, 1, 2])
+    assert (tiles.hits, tiles.misses) == (2, 6)
+    assert tiles.missing(0, 256, [0, 9]) == [(3, 0), (3, 1)]
+    # Prefetched tiles are hits
+    for key in tiles.missing(0, 256, [0, 9]):
+        tiles.put(key, tiles.load(key))
+    tiles.read(0, 256, [0, 9])
+    assert (tiles.hits, tiles.misses) == (10, 6)
+
+
+def test_tile_cache_eviction():
+    """
+    Tiles are evicted to stay within max_bytes, and read again when needed.
+    """
+    X = np.random.randn(1000, 20)
+    tile_bytes = 64 * 8 * 4
+    tiles = TileCache(X, tile_len=64, block_size=8, max_bytes=3 * tile_bytes)
+    Y = tiles.read(0, 320, [0])
+    assert np.array_equal(Y, X[:320, [0]].astype('float32'))
+    assert len(tiles.tiles) == 3 and tiles.tiles.nbytes == 3 * tile_bytes
+    assert tiles.missing(0, 320, [0]) == [(0, 0), (1, 0)]
+    tiles.read(0, 64, [0])
+    assert (tiles.hits, tiles.misses) == (0, 6)
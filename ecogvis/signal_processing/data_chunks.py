@@ -0,0 +1,72 @@
+"""
+Iterative writing of large datasets to NWB files, one computed block at a time.
+"""
+import numpy as np
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk
+
+__all__ = ['BlockDataChunkIterator',
+           'row_chunk_shape']
+
+
+class BlockDataChunkIterator(AbstractDataChunkIterator):
+    """
+    Data chunk iterator that writes a dataset block by block, as the blocks
+    are computed. Used to store processed signals without ever holding the
+    full array in memory.
+
+    Parameters
+    ----------
+    blocks : iterable
+        Yields (selection, data) tuples, where selection is a tuple of slices
+        locating data in the full dataset.
+    shape : tuple
+        Shape of the full dataset.
+    dtype : numpy dtype
+        Data type of the stored dataset.
+    chunk_shape : tuple or None
+        HDF5 chunk shape of the stored dataset.
+    """
+    def __init__(self, blocks, shape, dtype, chunk_shape=None):
+        self.blocks = iter(blocks)
+        self.shape = tuple(int(s) for s in shape)
+        self._dtype = np.dtype(dtype)
+        self.chunk_shape = chunk_shape
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        selection, data = next(self.blocks)
+        return DataChunk(data=np.asarray(data, dtype=self._dtype),
+                         selection=selection)
+
+    def recommended_chunk_shape(self):
+        return self.chunk_shape
+
+    def recommended_data_shape(self):
+        return self.shape
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def maxshape(self):
+        return self.shape
+
+
+def row_chunk_shape(shape, dtype, chunk_bytes=2**20, n_channels=None):
+    """
+    HDF5 chunk shape spanning all columns of a (time, ...) dataset, with
+    about chunk_bytes per chunk. Keeps reads of time windows contiguous.
+
+    If n_channels is given, chunks span only n_channels along the second
+    (channel) dimension, so that datasets written by channel blocks of that
+    size never rewrite a chunk.
+    """
+    shape = tuple(int(s) for s in shape)
+    if n_channels is not None:
+        shape = shape[:1] + (min(n_channels, shape[1]),) + shape[2:]
+    row_bytes = np.dtype(dtype).itemsize * int(np.prod(shape[1:]))
+    n_rows = int(np.clip(chunk_bytes // max(row_bytes, 1), 1, shape[0]))
+    return (n_rows,) + shape[1:]
@@ -5,13 +5,19 @@ Detect CV (consonant-vowel) pair events in speaker and microphone channels.
 
 # Third party libraries
 import numpy as np
+import pandas as pd
 import scipy.signal as sgn
-from ecogvis.signal_processing.resample import resample
+from ecogvis.signal_processing.resample import (PolyphaseResampler,
+                                                rational_ratio, resample)
+
+# Smoothers of detect_events
+SMOOTHERS = ('medfilt', 'median', 'boxcar', 'rms')
 
 
 def detect_events(speaker_data, mic_data=None, interval=None, dfact=30,
                   smooth_width=0.4, speaker_threshold=0.05, mic_threshold=0.05,
-                  direction='both'):
+                  direction='both', resample_kind='polyphase',
+                  smoother='medfilt'):
     """
     Automatically detects events in audio signals.
 
@@ -27,7 +33,7 @@ def detect_events(speaker_data, mic_data=None, interval=None, dfact=30,
     dfact : float
         Downsampling factor. Default 30.
     smooth_width: float
-        Width scale for median smoothing filter (default = .4, decent for CVs).
+        Width scale for smoothing filter (default = .4, decent for CVs).
     speaker_threshold : float
         Sets threshold level for speaker.
     mic_threshold : float
@@ -36,6 +42,12 @@ def detect_events(speaker_data, mic_data=None, interval=None, dfact=30,
         'Up' detects events start times. 'Down' detects events stop times.
         'Both'
         detects both start and stop times.
+    resample_kind : str
+        'polyphase' (default) for polyphase FIR downsampling, 'fft' for FFT
+        resampling of power of 2 padded signals.
+    smoother : str
+        Smoother of the squared derivative of the downsampled signals, one of
+        SMOOTHERS. See smooth_envelope.
 
     Returns
     -------
@@ -58,90 +70,218 @@ def detect_events(speaker_data, mic_data=None, interval=None, dfact=30,
     speakerDS, speakerEventDS, speakerFilt = None, None, None
 
     if speaker_data is not None:
-        if interval is None:
-            X = speaker_data.data[:]
-        else:
-            X = speaker_data.data[interval[0]:interval[1]]
-        fs = speaker_data.rate  # sampling rate
-        ds = fs / dfact
-
-        # Pad zeros to make signal length a power of 2, improves performance
-        nBins = X.shape[0]
-        extraBins = 2 ** (np.ceil(np.log2(nBins)).astype('int')) - nBins
-        extraZeros = np.zeros(extraBins)
-        X = np.append(X, extraZeros)
-        speakerDS = resample(X, ds, fs)
-
-        # Remove excess bins (because of zero padding on previous step)
-        excessBins = int(np.ceil(extraBins * ds / fs))
-        speakerDS = speakerDS[0:-excessBins]
-
-        # Kernel size must be an odd number
-        speakerFilt = sgn.medfilt(
-            volume=np.diff(np.append(speakerDS, speakerDS[-1])) ** 2,
-            kernel_size=int((smooth_width * ds // 2) * 2 + 1))
-
-        # Normalize the filtered signal.
-        speakerFilt /= np.max(np.abs(speakerFilt))
-
-        # Find threshold crossing times
-        stimBinsDS = threshcross(speakerFilt, speaker_threshold, direction)
-
-        # Remove events that have a duration less than 0.1 s.
-        speaker_events = stimBinsDS.reshape((-1, 2))
-        rem_ind = np.where((speaker_events[:, 1] - speaker_events[:, 0]) < ds * 0.1)[0]
-        speaker_events = np.delete(speaker_events, rem_ind, axis=0)
-        stimBinsDS = speaker_events.reshape((-1))
-
-        # Transform bins to time
-        speakerEventDS = (stimBinsDS  / ds) + (interval[0] / fs)
+        speakerDS, ds, fs = read_downsampled(speaker_data, interval, dfact,
+                                             resample_kind)
+        speakerFilt = normalized_envelope(speakerDS, ds, smooth_width,
+                                          smoother)
+
+        # Find threshold crossing times, in seconds
+        speakerEventDS = event_times(speakerFilt, speaker_threshold,
+                                     direction, ds, fs, interval)
 
     # Downsampling Mic -------------------------------------------------------
 
     micDS, micEventDS, micFilt = None, None, None
 
     if mic_data is not None:
+        micDS, ds, fs = read_downsampled(mic_data, interval, dfact,
+                                         resample_kind)
 
-        if interval is None:
-            X = mic_data.data[:]
-        else:
-            X = mic_data.data[interval[0]:interval[1]]
-        fs = mic_data.rate  # sampling rate
-        ds = fs / dfact
+        # Remove mic response to speaker
+        micDS[np.where(speakerFilt > speaker_threshold)[0]] = 0
+        micFilt = normalized_envelope(micDS, ds, smooth_width, smoother)
 
-        # Pad zeros to make signal length a power of 2, improves performance
-        nBins = X.shape[0]
-        extraBins = 2 ** (np.ceil(np.log2(nBins)).astype('int')) - nBins
-        extraZeros = np.zeros(extraBins)
-        X = np.append(X, extraZeros)
-        micDS = resample(X, ds, fs)
+        # Find threshold crossing times, in seconds
+        micEventDS = event_times(micFilt, mic_threshold, direction, ds, fs,
+                                 interval)
 
-        # Remove excess bins (because of zero padding on previous step)
-        excessBins = int(np.ceil(extraBins * ds / fs))
-        micDS = micDS[0:-excessBins]
+    return speakerDS, speakerEventDS, speakerFilt, micDS, micEventDS, micFilt
 
-        # Remove mic response to speaker
-        micDS[np.where(speakerFilt > speaker_threshold)[0]] = 0
-        micFilt = sgn.medfilt(volume=np.diff(np.append(micDS, micDS[-1])) ** 2,
-                              kernel_size=int(
-                                  (smooth_width * ds // 2) * 2 + 1))
 
-        # Normalize the filtered signal.
-        micFilt /= np.max(np.abs(micFilt))
+def read_downsampled(data, interval=None, dfact=30, kind='polyphase'):
+    """
+    Reads an interval of an audio signal and downsamples it by dfact.
 
-        # Find threshold crossing times
-        micBinsDS = threshcross(micFilt, mic_threshold, direction)
+    Parameters
+    ----------
+    data : 'pynwb.base.TimeSeries' object
+        Object containing audio data.
+    interval : list of floats
+        Interval to be used [Start_bin, End_bin]. If 'None', the whole
+        signal is used.
+    dfact : float
+        Downsampling factor.
+    kind : str
+        Resampling method, as in downsample.
 
-        # Remove events that have a duration less than 0.1 s.
-        mic_events = micBinsDS.reshape((-1, 2))
-        rem_ind = np.where((mic_events[:, 1] - mic_events[:, 0]) < ds * 0.1)[0]
-        mic_events = np.delete(mic_events, rem_ind, axis=0)
-        micBinsDS = mic_events.reshape((-1))
+    Returns
+    -------
+    XDS : 1D array of floats
+        Downsampled signal.
+    ds : float
+        Sampling rate of XDS.
+    fs : float
+        Sampling rate of data.
+    """
+    if interval is None:
+        X = data.data[:]
+    else:
+        X = data.data[interval[0]:interval[1]]
+    fs = data.rate  # sampling rate
+    ds = fs / dfact
+    return downsample(X, ds, fs, kind), ds, fs
 
-        # Transform bins to time
-        micEventDS = (micBinsDS / ds) + (interval[0] / fs)
 
-    return speakerDS, speakerEventDS, speakerFilt, micDS, micEventDS, micFilt
+def normalized_envelope(XDS, ds, smooth_width=0.4, smoother='medfilt'):
+    """
+    Smoothed squared derivative of a downsampled signal, normalized by its
+    maximum. This is the signal thresholded by detect_events.
+
+    Parameters
+    ----------
+    XDS : 1D array of floats
+        Downsampled signal.
+    ds : float
+        Sampling rate of XDS.
+    smooth_width : float
+        Width of the smoothing window (seconds).
+    smoother : str
+        One of SMOOTHERS, see smooth_envelope.
+
+    Returns
+    -------
+    filt : 1D array of floats
+        Filtered signal.
+    """
+    filt = smooth_envelope(np.diff(np.append(XDS, XDS[-1])) ** 2,
+                           smooth_width * ds, smoother)
+
+    # Normalize the filtered signal.
+    filt /= np.max(np.abs(filt))
+    return filt
+
+
+def downsample(X, ds, fs, kind='polyphase'):
+    """
+    Downsamples a 1D signal from fs to ds Hz.
+
+    Parameters
+    ----------
+    X : 1D array of floats
+        Signal.
+    ds : float
+        New sampling rate.
+    fs : float
+        Original sampling rate.
+    kind : str
+        'polyphase' for polyphase FIR downsampling, 'fft' for FFT resampling
+        of the signal zero padded to a power of 2 length.
+
+    Returns
+    -------
+    XDS : 1D array of floats
+        Downsampled signal.
+    """
+    if kind == 'polyphase':
+        return resample(X, ds, fs, kind='polyphase')
+
+    # Pad zeros to make signal length a power of 2, improves performance
+    nBins = X.shape[0]
+    extraBins = 2 ** (np.ceil(np.log2(nBins)).astype('int')) - nBins
+    extraZeros = np.zeros(extraBins)
+    X = np.append(X, extraZeros)
+    XDS = resample(X, ds, fs)
+
+    # Remove excess bins (because of zero padding on previous step)
+    excessBins = int(np.ceil(extraBins * ds / fs))
+    return XDS[:XDS.shape[0] - excessBins]
+
+
+def smooth_envelope(X, width, kind='medfilt'):
+    """
+    Smooths a 1D signal with a sliding window centered on each sample. The
+    signal is zero padded at the edges.
+
+    Parameters
+    ----------
+    X : 1D array of floats
+        Signal, e.g. the squared derivative of an audio signal.
+    width : float
+        Window length (samples), rounded to the nearest odd number below.
+    kind : str
+        'medfilt' : running median with scipy.signal.medfilt.
+        'median' : the same running median, computed on a skip list in
+                   O(n log(width)), for scipy versions where medfilt is
+                   O(n width).
+        'boxcar' : running mean, in O(n).
+        'rms' : square root of the running mean, in O(n). The RMS of the
+                signal whose square is X.
+
+    Returns
+    -------
+    Y : 1D array of floats
+        Smoothed signal.
+    """
+    # Kernel size must be an odd number
+    k = int((width // 2) * 2 + 1)
+    X = np.asarray(X, dtype='float64')
+    if kind == 'medfilt':
+        return sgn.medfilt(volume=X, kernel_size=k)
+    pad = np.zeros(k // 2)
+    Xp = np.concatenate((pad, X, pad))
+    if kind == 'median':
+        return pd.Series(Xp).rolling(k).median().to_numpy()[k - 1:]
+    if kind in ('boxcar', 'rms'):
+        cumsum = np.cumsum(np.append(0., Xp))
+        Y = (cumsum[k:] - cumsum[:-k]) / k
+        # Rounding errors of the cumulative sum can go below zero
+        np.maximum(Y, 0, out=Y)
+        return np.sqrt(Y) if kind == 'rms' else Y
+    raise ValueError('Unknown smoother {}, use one of {}.'.format(
+        kind, SMOOTHERS))
+
+
+def event_times(filt, threshold, direction, ds, fs, interval=None,
+                min_duration=0.1):
+    """
+    Times of the threshold crosses of a filtered, downsampled signal, without
+    the events shorter than min_duration.
+
+    Parameters
+    ----------
+    filt : 1D array of floats
+        Filtered signal, sampled at ds Hz.
+    threshold : float
+        Value of threshold.
+    direction : str
+        Direction of crosses, as in threshcross.
+    ds : float
+        Sampling rate of filt.
+    fs : float
+        Sampling rate of the original signal.
+    interval : list of floats
+        Interval [Start_bin, End_bin] of the original signal filt was
+        computed from. If 'None', the whole signal.
+    min_duration : float
+        Minimum event duration (seconds).
+
+    Returns
+    -------
+    times : 1D array of floats
+        Event times (seconds).
+    """
+    bins = threshcross(filt, threshold, direction)
+    return _bins_to_times(bins, ds, fs, interval, min_duration)
+
+
+def _bins_to_times(bins, ds, fs, interval, min_duration):
+    # Remove events that have a duration less than min_duration
+    events = bins.reshape((-1, 2))
+    events = events[(events[:, 1] - events[:, 0]) >= ds * min_duration]
+
+    # Transform bins to time
+    start = 0 if interval is None else interval[0]
+    return events.reshape(-1) / ds + start / fs
 
 
 def threshcross(data, threshold=0, direction='up'):
@@ -157,7 +297,8 @@ def threshcross(data, threshold=0, direction='up'):
     direction : str
         Defines the direction of cross detected: 'up', 'down', or 'both'.
         With 'both', it will check to make sure that up and down crosses are
-        detected. In other words,
+        detected. In other words, only up crosses followed by a down cross
+        are kept, and the output alternates between up and down crosses.
 
     Returns
     -------
@@ -176,18 +317,295 @@ def threshcross(data, threshold=0, direction='up'):
     elif direction == 'both':
         cross_nonzero = np.where(cross != 0)[0]
 
-        events = []
-        for i in range(len(cross_nonzero) - 1):
+        # Up and down crosses alternate, so events are the up crosses
+        # followed by a down cross
+        starts = np.where(cross[cross_nonzero[:-1]] == 1)[0]
+        out = np.column_stack((cross_nonzero[starts],
+                               cross_nonzero[starts + 1])).reshape(-1)
 
-            # Skip to the next ind if this one was already recorded.
-            if cross_nonzero[i] in events:
-                continue
+    return out
 
-            if (cross[cross_nonzero[i]] == 1) and (
-                    cross[cross_nonzero[i + 1]] == -1):
-                events.append(cross_nonzero[i])
-                events.append(cross_nonzero[i + 1])
 
-        out = np.array(events)
+def detect_events_streaming(speaker_data, mic_data=None, interval=None,
+                            dfact=30, smooth_width=0.4,
+                            speaker_threshold=0.05, mic_threshold=0.05,
+                            direction='both', smoother='medfilt',
+                            chunk_len=2**20, speaker_scale=None,
+                            mic_scale=None):
+    """
+    Detects events in audio signals read in chunks of chunk_len samples, with
+    the same results as detect_events with resample_kind='polyphase'. Events
+    are yielded as soon as they end, and memory is bounded by the chunk
+    length.
 
-    return out
+    The resampler, smoother and threshold crossing states are carried across
+    chunks. In detect_events, the smoothed signals are normalized by their
+    maximum before thresholding. Unless these maxima are given (speaker_scale,
+    mic_scale, e.g. from a previous detection), they are found first, in one
+    more pass over the speaker signal and one more over the mic signal.
+
+    Parameters
+    ----------
+    speaker_data, mic_data, interval, dfact, smooth_width, speaker_threshold,
+    mic_threshold, direction, smoother :
+        As in detect_events. Speaker and mic signals must have the same
+        sampling rate.
+    chunk_len : int
+        Number of samples read at a time.
+    speaker_scale : float or None
+        Maximum of the smoothed speaker signal. None finds it first.
+    mic_scale : float or None
+        Maximum of the smoothed mic signal, without its response to the
+        speaker. None finds it first.
+
+    Yields
+    ------
+    speakerEventDS : 1D array of floats
+        New event times for speaker signal.
+    micEventDS : 1D array of floats
+        New event times for microphone signal.
+    """
+    sources = [s for s in (speaker_data, mic_data) if s is not None]
+    fs = sources[0].rate
+    if any(s.rate != fs for s in sources):
+        raise ValueError('Speaker and mic signals must have the same '
+                         'sampling rate.')
+    ds = fs / dfact
+    up, down = rational_ratio(ds, fs)
+    if interval is None:
+        start, stop = 0, sources[0].data.shape[0]
+    else:
+        start, stop = interval[0], min(interval[1], sources[0].data.shape[0])
+    no_events = np.zeros(0)
+
+    def stream(source):
+        resampler = PolyphaseResampler(up, down)
+        for t0 in range(start, stop, chunk_len):
+            yield resampler.update(source.data[t0:min(t0 + chunk_len, stop)])
+        yield resampler.flush()
+
+    def scan(speaker_data, mic_data, speaker_scale, mic_scale, streams):
+        """Events of one pass over the signals. Streams with no scale only
+        find the maximum of their smoothed signal (see _EventStream)."""
+        sources = [s for s in (speaker_data, mic_data) if s is not None]
+        # Speaker envelope, the mask of the mic signal, and events
+        speaker = None
+        if speaker_data is not None:
+            speaker = _EventStream(EnvelopeStream(smooth_width * ds, smoother),
+                                   speaker_threshold, direction, ds, fs,
+                                   interval, speaker_scale)
+        mic = None
+        if mic_data is not None:
+            mic = _EventStream(EnvelopeStream(smooth_width * ds, smoother),
+                               mic_threshold, direction, ds, fs, interval,
+                               mic_scale)
+            mic_pending = np.zeros(0)
+            mask_pending = np.zeros(0, dtype=bool)
+        streams.extend([speaker, mic])
+
+        chunks = zip(*[stream(s) for s in sources])
+        for chunk in chunks:
+            speaker_times, mic_times = no_events, no_events
+            if speaker is not None:
+                speaker_times = speaker.update(chunk[0])
+                if mic is not None:
+                    mask_pending = np.append(mask_pending, speaker.mask)
+            if mic is not None:
+                mic_pending = np.append(mic_pending, chunk[-1])
+                if speaker is None:
+                    mic_times = mic.update(mic_pending)
+                    mic_pending = mic_pending[:0]
+                else:
+                    # Remove mic response to speaker, where the mask is known
+                    n = min(len(mic_pending), len(mask_pending))
+                    X = mic_pending[:n].copy()
+                    X[mask_pending[:n]] = 0
+                    mic_times = mic.update(X)
+                    mic_pending = mic_pending[n:]
+                    mask_pending = mask_pending[n:]
+            if len(speaker_times) or len(mic_times):
+                yield speaker_times, mic_times
+
+        # End of the signals
+        speaker_times, mic_times = no_events, no_events
+        if speaker is not None:
+            speaker_times = speaker.flush()
+            if mic is not None:
+                mask_pending = np.append(mask_pending, speaker.mask)
+        if mic is not None:
+            if speaker is not None:
+                mic_pending[mask_pending[:len(mic_pending)]] = 0
+            mic_times = np.append(mic.update(mic_pending), mic.flush())
+        yield speaker_times, mic_times
+
+    # Maxima of the smoothed signals, the mic one once the speaker mask is
+    # known
+    if speaker_data is not None and speaker_scale is None:
+        streams = []
+        for _ in scan(speaker_data, None, None, None, streams):
+            pass
+        speaker_scale = streams[0].peak
+    if mic_data is not None and mic_scale is None:
+        streams = []
+        for _ in scan(speaker_data, mic_data, speaker_scale, None, streams):
+            pass
+        mic_scale = streams[1].peak
+
+    for times in scan(speaker_data, mic_data, speaker_scale, mic_scale, []):
+        yield times
+
+
+class EnvelopeStream:
+    """
+    Smoothed squared derivative of a signal streamed in chunks, as in
+    detect_events. Keeps the last sample of the signal and the samples of the
+    squared derivative within a half window of the next output.
+
+    Parameters
+    ----------
+    width : float
+        Smoothing window length (samples).
+    kind : str
+        Smoother, as in smooth_envelope.
+    """
+    def __init__(self, width, kind='medfilt'):
+        self.k = int((width // 2) * 2 + 1)
+        self.kind = kind
+        self.n_out = 0
+        self._last = None
+        # Squared derivative from sample n_out - k // 2, zero padded before
+        # the start of the signal
+        self._buffer = np.zeros(self.k // 2)
+
+    def update(self, X):
+        """
+        Adds a chunk of the signal and returns the new smoothed samples.
+        """
+        if self._last is not None:
+            X = np.append(self._last, X)
+        if len(X) == 0:
+            return np.zeros(0)
+        self._last = X[-1]
+        return self._smooth(np.diff(X) ** 2)
+
+    def flush(self):
+        """
+        Returns the last smoothed samples, at the end of the signal.
+        """
+        if self._last is None:
+            return np.zeros(0)
+        self._last = None
+        # Derivative of the last sample, and zero padding
+        return self._smooth(np.zeros(1 + self.k // 2))
+
+    def _smooth(self, D):
+        self._buffer = np.concatenate((self._buffer, D))
+        h = self.k // 2
+        n = len(self._buffer) - 2 * h
+        if n <= 0:
+            return np.zeros(0)
+        Y = smooth_envelope(self._buffer, self.k, self.kind)[h:h + n]
+        self._buffer = self._buffer[n:]
+        self.n_out += n
+        return Y
+
+
+class ThreshcrossStream:
+    """
+    Threshold crosses of a signal streamed in chunks, as in threshcross.
+    Keeps whether the last sample was over the threshold and, with 'both',
+    the last up cross until its down cross arrives.
+
+    Parameters
+    ----------
+    threshold : float
+        Value of threshold.
+    direction : str
+        'up', 'down', or 'both'.
+    """
+    def __init__(self, threshold=0, direction='up'):
+        self.threshold = threshold
+        self.direction = direction
+        self.n_in = 0
+        self._over = None
+        self._up = np.zeros(0, dtype='int')
+
+    def update(self, data):
+        """
+        Adds a chunk of the signal and returns the indices of the new
+        crosses.
+        """
+        if len(data) == 0:
+            return np.zeros(0, dtype='int')
+        over = (np.asarray(data) >= self.threshold).astype('int')
+        first = over[0] if self._over is None else self._over
+        cross = np.diff(np.append(first, over))
+        offset = self.n_in
+        self.n_in += len(data)
+        self._over = over[-1]
+
+        if self.direction == 'up':
+            return np.where(cross == 1)[0] + offset
+        elif self.direction == 'down':
+            return np.where(cross == -1)[0] + offset
+        cross_nonzero = np.where(cross != 0)[0]
+        bins = np.append(self._up, cross_nonzero + offset)
+        signs = np.append(np.ones(len(self._up)), cross[cross_nonzero])
+        # Up and down crosses alternate
+        starts = np.where(signs[:-1] == 1)[0]
+        self._up = bins[-1:] if len(signs) and signs[-1] == 1 else bins[:0]
+        return np.column_stack((bins[starts], bins[starts + 1])).reshape(-1)
+
+    def flush(self):
+        """
+        Returns the crosses left at the end of the signal: none, as a last up
+        cross has no down cross.
+        """
+        self._up = self._up[:0]
+        return np.zeros(0, dtype='int')
+
+
+class _EventStream:
+    """
+    Event times of a signal streamed in chunks: smoothed signal, normalized
+    by scale, threshold crosses, and removal of short events. With no scale,
+    there are no events, and only the maximum of the smoothed signal (peak)
+    is found.
+    """
+    def __init__(self, envelope, threshold, direction, ds, fs, interval,
+                 scale=None, min_duration=0.1):
+        self.envelope = envelope
+        self.threshold = threshold
+        self.crosses = ThreshcrossStream(threshold, direction)
+        self.ds = ds
+        self.fs = fs
+        self.interval = interval
+        self.scale = scale
+        self.min_duration = min_duration
+        # Mask of the new samples over threshold, once scale is known
+        self.mask = np.zeros(0, dtype=bool)
+        self.peak = 0.
+        self._bins = np.zeros(0, dtype='int')
+
+    def update(self, X):
+        return self._events(self.envelope.update(X))
+
+    def flush(self):
+        times = self._events(self.envelope.flush())
+        self.crosses.flush()
+        return times
+
+    def _events(self, filt):
+        if self.scale is None:
+            if len(filt):
+                self.peak = max(self.peak, np.max(np.abs(filt)))
+            self.mask = np.zeros(0, dtype=bool)
+            return np.zeros(0)
+        filt = filt / self.scale
+        self.mask = filt > self.threshold
+        # Pairs of bins, the last one waiting for its pair
+        bins = np.append(self._bins, self.crosses.update(filt))
+        n = len(bins) // 2 * 2
+        self._bins = bins[n:]
+        return _bins_to_times(bins[:n], self.ds, self.fs, self.interval,
+                              self.min_duration)
@@ -0,0 +1,148 @@
+"""
+Event-related potentials: mean and standard error of the trial windows
+(epochs) of all channels, read in a few contiguous blocks.
+"""
+import numpy as np
+
+__all__ = ['epoch_blocks',
+           'erp']
+
+
+def epoch_blocks(start_bins, n_bins, n_total, max_rows=2**18):
+    """
+    Groups trial windows into contiguous blocks of time bins, so that they
+    can be read with a few large reads. Windows closer than n_bins are merged
+    in the same block, as long as blocks span at most max_rows bins.
+
+    Parameters
+    ----------
+    start_bins : array of ints
+        First bin of each trial window.
+    n_bins : int
+        Number of bins of each window.
+    n_total : int
+        Number of bins of the signals. Blocks are clipped to [0, n_total).
+    max_rows : int
+        Maximum number of bins per block (unless a single window is longer).
+
+    Returns
+    -------
+    blocks : list of tuples
+        (first bin, last bin + 1, trials) of each block, where trials are the
+        indices of the windows in the block.
+    """
+    order = np.argsort(start_bins, kind='stable')
+    starts = np.clip(start_bins[order], 0, n_total)
+    stops = np.clip(start_bins[order] + n_bins, 0, n_total)
+    blocks = []
+    first = 0
+    for i in range(1, len(order) + 1):
+        if (i == len(order) or starts[i] - stops[i - 1] > n_bins or
+                stops[i] - starts[first] > max_rows):
+            blocks.append((starts[first], stops[first:i].max(),
+                           order[first:i]))
+            first = i
+    return blocks
+
+
+def erp(source, ref_times, rate, width, channels=None, max_bytes=64 * 2**20,
+        stopped=None):
+    """
+    Event-related potentials of the given channels, for windows of `width`
+    seconds centered on ref_times. Windows are read in a few contiguous
+    blocks of source (see epoch_blocks), with all channels at once, and their
+    sums over trials are accumulated block by block, so that memory does not
+    grow with the number of trials.
+
+    Parameters
+    ----------
+    source : h5py.Dataset or array
+        Signals, dimensions (n_timePoints, n_channels).
+    ref_times : array of floats
+        Reference times (seconds) of each trial.
+    rate : float
+        Sampling rate of source.
+    width : float
+        Window width (seconds).
+    channels : array of ints or None
+        Channels to extract. None extracts all channels.
+    max_bytes : int
+        Memory budget (bytes) of the blocks read at a time, as float64. The
+        number of time bins per block is set from it and the number of
+        channels read.
+    stopped : function or None
+        Called before reading each block. If it returns True, the
+        calculation is abandoned and None is returned.
+
+    Returns
+    -------
+    Y_mean : array
+        Mean over trials, dimensions (n_channels, n_bins). Bins out of the
+        signals in all trials are NaN.
+    Y_sem : array
+        Standard error of the mean over trials, dimensions (n_channels,
+        n_bins).
+    X : array
+        Time (seconds) of each bin from the start of the window.
+    """
+    ref_bins = (np.asarray(ref_times) * rate).astype('int')
+    nBinsTr = int(width * rate / 2)
+    n_bins = 2 * nBinsTr
+    start_bins = ref_bins - nBinsTr
+    if channels is None:
+        channels = np.arange(source.shape[1])
+    # Only the range of the channels is read
+    channels = np.asarray(channels, dtype='int')
+    c0, c1 = channels.min(), channels.max() + 1
+    # The range of channels is read in float64, and copied to the channels
+    # unless they are that range
+    in_range = np.array_equal(channels, np.arange(c0, c1))
+    row_bytes = 8 * ((c1 - c0) + (0 if in_range else len(channels)))
+    max_rows = max(int(max_bytes // row_bytes), 1)
+    # Sums are of the signals minus a shift, for their precision
+    shift = None
+    sums = np.zeros((len(channels), n_bins))
+    sums2 = np.zeros((len(channels), n_bins))
+    counts = np.zeros(n_bins)
+    for b0, b1, trials in epoch_blocks(start_bins, n_bins, source.shape[0],
+                                       max_rows):
+        if stopped is not None and stopped():
+            return None
+        if b1 <= b0:
+            continue
+        X = _read_float64(source, b0, b1, c0, c1).T
+        if not in_range:
+            X = X[channels - c0]
+        if shift is None:
+            shift = X.mean(axis=1, keepdims=True)
+        X -= shift
+        for trial in trials:
+            # Bins of the window in the block
+            i0 = start_bins[trial] - b0
+            lo, hi = max(-i0, 0), min(b1 - b0 - i0, n_bins)
+            if hi > lo:
+                window = X[:, i0 + lo:i0 + hi]
+                sums[:, lo:hi] += window
+                sums2[:, lo:hi] += window**2
+                counts[lo:hi] += 1
+    if shift is None:
+        shift = np.zeros((len(channels), 1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        Y_mean = sums / counts
+        Y_var = np.maximum(sums2 / counts - Y_mean**2, 0)
+    Y_sem = np.sqrt(Y_var) / np.sqrt(len(start_bins))
+    X = np.arange(0, n_bins) / rate
+    return Y_mean + shift, Y_sem, X
+
+
+def _read_float64(source, b0, b1, c0, c1):
+    """
+    Copy of source[b0:b1, c0:c1] as float64. HDF5 datasets are converted
+    while read, without an intermediate copy in their own type.
+    """
+    X = np.empty((b1 - b0, c1 - c0))
+    if hasattr(source, 'read_direct'):
+        source.read_direct(X, np.s_[b0:b1, c0:c1])
+    else:
+        X[:] = source[b0:b1, c0:c1]
+    return X
@@ -1,7 +1,9 @@
 from __future__ import division
+from functools import lru_cache
+
 import numpy as np
 
-from .fft import fftfreq, fft, ifft
+from .fft import fftfreq, fft, ifft, rfft
 try:
     from accelerate.mkl.fftpack import fft, ifft
 except ImportError:
@@ -12,7 +14,8 @@ except ImportError:
 
 
 __authors__ = "Alex Bujan, Jesse Livezey"
-__all__ = ['gaussian', 'hamming', 'hilbert_transform']
+__all__ = ['gaussian', 'hamming', 'hilbert_transform', 'FilterBank',
+           'gaussian_filter_bank', 'decimated_length']
 
 
 def gaussian(X, rate, center, sd):
@@ -68,7 +71,7 @@ def hilbert_transform(X, rate, filters=None, phase=None, X_fft_h=None):
     time = X.shape[-1]
     freq = fftfreq(time, 1. / rate)
 
-    Xh = np.zeros((len(filters),) + X.shape, dtype=np.complex)
+    Xh = np.zeros((len(filters),) + X.shape, dtype=complex)
     if X_fft_h is None:
         # Heavyside filter
         h = np.zeros(len(freq))
@@ -88,3 +91,271 @@ def hilbert_transform(X, rate, filters=None, phase=None, X_fft_h=None):
         return Xh[0], X_fft_h
 
     return Xh, X_fft_h
+
+
+class FilterBank(object):
+    """
+    Bank of bandpass filters for the Hilbert transform of signals with a
+    fixed number of time points, applied to blocks of channels in batches
+    of bands.
+
+    Parameters
+    ----------
+    n_time : int
+        Number of time points of the signals.
+    rate : float
+        Number of samples per second.
+    filters : iterable of arrays
+        Bandpass filters, each with n_time points in the fft frequency order
+        (e.g. from gaussian or hamming). Only the frequency support of each
+        filter, times the Heaviside filter, is stored.
+    max_memory : float
+        Memory cap (MB) of the stored filters and of the complex
+        (bands, channels, time) intermediate. Bands are processed in batches
+        that fit in it.
+    tol : float
+        Relative filter magnitude below which frequency bins are not stored.
+    """
+    def __init__(self, n_time, rate, filters, max_memory=512, tol=1e-12):
+        self.n_time = n_time
+        self.rate = rate
+        self.max_memory = max_memory
+        freq = fftfreq(n_time, 1. / rate)
+
+        # Heavyside filter
+        self.h = np.zeros(len(freq))
+        self.h[freq > 0] = 2.
+        self.h[0] = 1.
+
+        # Kernel (filter times Heaviside filter) of each band on its support,
+        # which only has positive frequencies: bins [0, n_time // 2]
+        self.supports = []
+        self.kernels = []
+        for f in filters:
+            k = f / np.linalg.norm(f) * self.h
+            idx = np.nonzero(np.abs(k) > tol * np.abs(k).max())[0]
+            b = slice(idx[0], idx[-1] + 1)
+            self.supports.append(b)
+            self.kernels.append(k[b])
+
+    @property
+    def n_bands(self):
+        return len(self.kernels)
+
+    @property
+    def nbytes(self):
+        """Memory (bytes) of the stored filters."""
+        return self.h.nbytes + sum(k.nbytes for k in self.kernels)
+
+    def batch_size(self, n_channels):
+        """
+        Number of bands per batch, for blocks of n_channels.
+        """
+        free = max(self.max_memory * 2**20 - self.nbytes, 0)
+        n = int(free // (16 * n_channels * self.n_time))
+        return int(np.clip(n, 1, self.n_bands))
+
+    def batches(self, X):
+        """
+        Bandpassed analytic signals of X in batches of bands.
+
+        Parameters
+        ----------
+        X : ndarray (n_channels, n_time)
+            Input data.
+
+        Yields
+        ------
+        bands : slice
+            Bands of the batch.
+        Xh : ndarray, complex (n_batch_bands, n_channels, n_time)
+            Bandpassed analytic signals.
+        """
+        X = np.atleast_2d(X)
+        X_fft = rfft(X)
+        step = self.batch_size(X.shape[0])
+        for b0 in range(0, self.n_bands, step):
+            bands = slice(b0, min(b0 + step, self.n_bands))
+            Xh = np.zeros((bands.stop - b0,) + X.shape, dtype=complex)
+            for ii, band in enumerate(range(b0, bands.stop)):
+                b = self.supports[band]
+                Xh[ii, :, b] = X_fft[:, b] * self.kernels[band]
+            yield bands, ifft(Xh)
+
+    def transform(self, X):
+        """
+        Bandpassed analytic signals, dimensions (n_bands, n_channels, n_time)
+        """
+        X = np.atleast_2d(X)
+        Xh = np.zeros((self.n_bands,) + X.shape, dtype=complex)
+        for bands, Xh_b in self.batches(X):
+            Xh[bands] = Xh_b
+        return Xh
+
+    def support(self, tol=1e-4):
+        """
+        Frequency bins where the bandpassed analytic signals can be
+        non-negligible: where the kernel, times the Heaviside filter, is
+        above tol times its maximum.
+
+        Returns
+        -------
+        support : list of slices
+            Contiguous range of fft bins of each band.
+        """
+        support = []
+        for b, k in zip(self.supports, self.kernels):
+            idx = np.nonzero(np.abs(k) > tol * np.abs(k).max())[0]
+            support.append(slice(b.start + idx[0], b.start + idx[-1] + 1))
+        return support
+
+    def decimated_amplitude(self, X, out_rate, out=None, tol=1e-4):
+        """
+        Analytic amplitudes at a reduced sampling rate, dimensions
+        (n_bands, n_channels, n_out), with
+        n_out = decimated_length(n_time, rate, out_rate).
+
+        Only the support of each band (see support) is kept. It is shifted
+        to baseband, which leaves the amplitude unchanged, and inverse
+        transformed with n_out points. This gives the exact amplitude of the
+        bandpassed signal at times j*n_time/(n_out*rate), at a fraction
+        n_out/n_time of the cost.
+
+        Parameters
+        ----------
+        X : ndarray (n_channels, n_time)
+            Input data.
+        out_rate : float
+            Output sampling rate. Must be larger than the support width of
+            every band.
+        out : ndarray (optional)
+            Preallocated output, dimensions (n_bands, n_channels, n_out).
+        tol : float
+            Relative kernel magnitude below which frequency bins are ignored.
+        """
+        X = np.atleast_2d(X)
+        n_out = decimated_length(self.n_time, self.rate, out_rate)
+        if out is None:
+            out = np.zeros((self.n_bands, X.shape[0], n_out))
+        for bands, A in self.decimated_batches(X, out_rate, tol):
+            out[bands] = A
+        return out
+
+    def decimated_batches(self, X, out_rate, tol=1e-4):
+        """
+        Decimated analytic amplitudes of X (see decimated_amplitude) in
+        batches of bands.
+
+        Yields
+        ------
+        bands : slice
+            Bands of the batch.
+        A : ndarray (n_batch_bands, n_channels, n_out)
+            Analytic amplitudes.
+        """
+        X = np.atleast_2d(X)
+        n_out = decimated_length(self.n_time, self.rate, out_rate)
+        support = self.support(tol)
+        widths = np.array([b.stop - b.start for b in support])
+        if widths.max() > n_out:
+            raise ValueError(
+                'Output rate of {} Hz is lower than the widest band support '
+                '({} Hz).'.format(out_rate,
+                                  widths.max() * self.rate / self.n_time))
+
+        X_fft = rfft(X)
+        step = max(self.batch_size(X.shape[0]) * (self.n_time // n_out), 1)
+        for b0 in range(0, self.n_bands, step):
+            bands = slice(b0, min(b0 + step, self.n_bands))
+            Y = np.zeros((bands.stop - b0, X.shape[0], n_out), dtype=complex)
+            for ii, band in enumerate(range(b0, bands.stop)):
+                b = support[band]
+                k0 = b.start - self.supports[band].start
+                Y[ii, :, :b.stop - b.start] = (X_fft[:, b] * self.kernels[band]
+                                               [k0:k0 + b.stop - b.start])
+            yield bands, np.abs(ifft(Y)) * n_out / self.n_time
+
+    def mean_amplitude(self, X, out_rate=None, tol=1e-4):
+        """
+        Analytic amplitude averaged over bands, dimensions
+        (n_channels, n_time), or (n_channels, n_out) if out_rate is given
+        (see decimated_amplitude). Accumulated batch by batch, without
+        holding the amplitudes of all bands.
+        """
+        out = 0.
+        for bands, A in self.amplitude_batches(X, out_rate, tol):
+            out = out + A.sum(axis=0)
+        return out / self.n_bands
+
+    def amplitude_batches(self, X, out_rate=None, tol=1e-4):
+        """
+        Analytic amplitudes of X in batches of bands, at the signal rate or,
+        if out_rate is given, decimated (see decimated_batches).
+
+        Yields
+        ------
+        bands : slice
+            Bands of the batch.
+        A : ndarray (n_batch_bands, n_channels, n_time or n_out)
+            Analytic amplitudes.
+        """
+        X = np.atleast_2d(X)
+        if out_rate is not None:
+            for bands, A in self.decimated_batches(X, out_rate, tol):
+                yield bands, A
+        else:
+            for bands, Xh in self.batches(X):
+                yield bands, np.abs(Xh)
+
+    def amplitude(self, X, out=None):
+        """
+        Analytic amplitudes, dimensions (n_bands, n_channels, n_time).
+
+        Parameters
+        ----------
+        X : ndarray (n_channels, n_time)
+            Input data.
+        out : ndarray (optional)
+            Preallocated output, e.g. a (n_bands, n_channels, n_time) view of
+            an array with other dimension order.
+        """
+        X = np.atleast_2d(X)
+        if out is None:
+            out = np.zeros((self.n_bands,) + X.shape)
+        for bands, Xh in self.batches(X):
+            out[bands] = np.abs(Xh)
+        return out
+
+
+def decimated_length(n_time, rate, out_rate):
+    """
+    Number of time points of signals with n_time points at rate, resampled
+    to out_rate. The exact output rate is rate*n_out/n_time.
+    """
+    return int(np.ceil(n_time * out_rate / rate))
+
+
+@lru_cache(maxsize=2)
+def gaussian_filter_bank(n_time, rate, centers, sds, max_memory=512):
+    """
+    FilterBank of Gaussian filters, cached so that it is built once for a
+    given (n_time, rate) and set of bands. Filters are computed one at a
+    time, only their support is kept (see FilterBank).
+
+    Parameters
+    ----------
+    n_time : int
+        Number of time points of the signals.
+    rate : float
+        Number of samples per second.
+    centers : tuple of floats
+        Filter centers (Hz).
+    sds : tuple of floats
+        Filter standard deviations (Hz).
+    max_memory : float
+        Memory cap (MB) of the filters and batched intermediate, see
+        FilterBank.
+    """
+    X = np.empty((1, n_time))
+    filters = (gaussian(X, rate, c, sd) for c, sd in zip(centers, sds))
+    return FilterBank(n_time, rate, filters, max_memory=max_memory)
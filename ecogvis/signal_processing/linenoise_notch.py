@@ -1,38 +1,74 @@
 from __future__ import division
+from functools import lru_cache
+
 import numpy as np
 from scipy.signal import firwin2, filtfilt
 from .fft import rfftfreq, rfft, irfft
 
-__all__ = ['linenoise_notch']
+__all__ = ['linenoise_notch', 'notch_gain']
 __authors__ = "Alex Bujan"
 
-def apply_notches(X, notches, rate, fft=True):
+
+@lru_cache(maxsize=16)
+def notch_gain(n_fft, rate, notches, delta=1.):
+    """
+    Gain of the FFT notch filters at the rfft frequencies of a signal of
+    length n_fft: a Hamming-shaped dip of half-width delta (Hz) around each
+    notch frequency, and 1 elsewhere. Cached, so that it is computed once
+    per (n_fft, rate, notches).
+
+    Parameters
+    ----------
+    n_fft : int
+        Number of time points of the transformed signal.
+    rate : float
+        Number of samples per second
+    notches : tuple of floats
+        Notch frequencies.
+    delta : float
+        Half-width of each notch (Hz).
+
+    Returns
+    -------
+    gain : array
+        Read-only gain, dimensions (n_fft // 2 + 1,)
+    """
+    fs = rfftfreq(n_fft, 1./rate)
+    gain = np.ones(fs.shape)
+    for notch in notches:
+        window_mask = np.logical_and(fs > notch-delta, fs < notch+delta)
+        window_size = window_mask.sum()
+        window = np.hamming(window_size)
+        gain[window_mask] *= 1.-window
+    gain.flags.writeable = False
+    return gain
+
+
+def apply_notches(X, notches, rate, fft=True, n_fft=None, out=None):
     if fft:
-        fs = rfftfreq(X.shape[-1], 1./rate)
-        delta = 1.
-        fd = rfft(X)
+        n_time = X.shape[-1]
+        if n_fft is None:
+            n_fft = n_time
+        gain = notch_gain(n_fft, rate, tuple(notches))
+        fd = rfft(X, n=n_fft)
+        fd *= gain
+        X = irfft(fd, n=n_fft)[..., :n_time]
     else:
         nyquist = rate/2.
         n_taps = 1001
         gain = [1, 1, 0, 0, 1, 1]
-    for notch in notches:
-        if fft:
-            window_mask = np.logical_and(fs > notch-delta, fs < notch+delta)
-            window_size = window_mask.sum()
-            window = np.hamming(window_size)
-            fd[:, window_mask] = (fd[:, window_mask] *
-                                  (1.-window)[np.newaxis, :])
-        else:
+        for notch in notches:
             freq = np.array([0, notch-1, notch-.5,
                              notch+.5, notch+1, nyquist]) / nyquist
             filt = firwin2(n_taps, freq, gain)
             X = filtfilt(filt, np.array([1]), X)
-    if fft:
-        X = irfft(fd)
+    if out is not None:
+        out[...] = X
+        return out
     return X
 
 
-def linenoise_notch(X, rate, notch_freq=None):
+def linenoise_notch(X, rate, notch_freq=None, n_fft=None, out=None):
     """
     Apply Notch filter at 60 Hz (or user chosen notch_freq) and its harmonics
 
@@ -44,6 +80,11 @@ def linenoise_notch(X, rate, notch_freq=None):
         Number of samples per second
     notch_freq : float
         Main frequency of notch filter
+    n_fft : int (optional)
+        FFT length. Signals are zero padded to n_fft time points (a power of
+        2 improves performance) and the result is truncated back.
+    out : array (optional)
+        Preallocated output, dimensions (n_channels, n_timePoints)
 
     Returns
     -------
@@ -57,4 +98,4 @@ def linenoise_notch(X, rate, notch_freq=None):
     else: noise_hz = notch_freq
     notches = np.arange(noise_hz, nyquist, noise_hz)
 
-    return apply_notches(X, notches, rate)
+    return apply_notches(X, notches, rate, n_fft=n_fft, out=out)
@@ -0,0 +1,256 @@
+"""
+Level-of-detail pyramid of signals, for plotting long windows. Each level
+keeps, for consecutive bins of factor**level samples of each channel, the
+minimum, maximum, sum and sum of squares of the samples. Plotting the
+minimum and maximum of the bins shows every transient of the window, and
+reads a few KB per channel whatever the window length.
+"""
+import hashlib
+
+import h5py
+import numpy as np
+
+__all__ = ['build_minmax_pyramid',
+           'open_minmax_pyramid',
+           'MinMaxPyramid']
+
+
+def build_minmax_pyramid(source, path, name, factor=4, max_bins=1024,
+                         chunk_len=None, stopped=None):
+    """
+    Builds the min/max pyramid of source and stores it in group `name` of the
+    HDF5 file `path` (a sidecar file of the NWB file), replacing any previous
+    pyramid with the same name. Levels are added until the coarsest has at
+    most max_bins bins. Source is read once, in chunks of chunk_len samples,
+    and every level is updated from each chunk (bins not yet complete are
+    carried to the next one).
+
+    Parameters
+    ----------
+    source : h5py.Dataset or array
+        Signals, dimensions (n_timePoints, n_channels).
+    path : str
+        Path of the HDF5 file.
+    name : str
+        Name of the group of the pyramid, e.g. the name of source.
+    factor : int
+        Number of bins of each level merged into a bin of the next level.
+    max_bins : int
+        Maximum number of bins of the coarsest level.
+    chunk_len : int or None
+        Number of samples read at a time (rounded to a multiple of factor).
+        None reads about 8 MB of float64 values at a time.
+    stopped : function or None
+        Called before reading each chunk. If it returns True, the build is
+        abandoned, the incomplete pyramid is removed and None is returned.
+
+    Returns
+    -------
+    pyramid : MinMaxPyramid or None
+    """
+    n_total, n_channels = source.shape
+    n_levels = 1
+    while -(-n_total // factor**n_levels) > max_bins:
+        n_levels += 1
+    if chunk_len is None:
+        chunk_len = 2**23 // (8 * n_channels)
+    chunk_len = max(chunk_len // factor, 1) * factor
+    # Sums are of the signals minus an offset, for their precision in float32
+    offset = np.asarray(source[:min(n_total, chunk_len)], dtype='float64'
+                        ).mean(axis=0)
+
+    f = h5py.File(path, 'a')
+    if name in f:
+        del f[name]
+    group = f.create_group(name)
+    group.attrs['factor'] = factor
+    group.attrs['n_samples'] = n_total
+    group.attrs['offset'] = offset
+    levels = []
+    for k in range(1, n_levels + 1):
+        n_bins = -(-n_total // factor**k)
+        levels.append(group.create_dataset(
+            'level_' + str(k), shape=(n_bins, n_channels, 4), dtype='float32',
+            chunks=(min(n_bins, 256), min(n_channels, 16), 4)))
+
+    # Bins written so far, and bins of the previous level not yet merged
+    written = [0] * n_levels
+    carry = [None] * n_levels
+    for t0 in range(0, n_total, chunk_len):
+        if stopped is not None and stopped():
+            del f[name]
+            f.close()
+            return None
+        last = t0 + chunk_len >= n_total
+        X = np.asarray(source[t0:t0 + chunk_len], dtype='float64') - offset
+        # Level 1 from the samples, the other levels from the previous one
+        stats = _sample_bins(X, factor)
+        for k, level in enumerate(levels):
+            if k > 0:
+                if carry[k] is not None:
+                    stats = np.concatenate((carry[k], stats), axis=0)
+                n_merged = stats.shape[0] if last else (
+                    stats.shape[0] // factor * factor)
+                carry[k] = stats[n_merged:]
+                stats = _merge_bins(stats[:n_merged], factor)
+            if stats.shape[0] > 0:
+                level[written[k]:written[k] + stats.shape[0]] = stats
+                written[k] += stats.shape[0]
+    for key, value in _source_identity(source).items():
+        group.attrs[key] = value
+    # Pyramids interrupted while being built are not used
+    group.attrs['complete'] = True
+    f.close()
+    return MinMaxPyramid(h5py.File(path, 'r')[name])
+
+
+def open_minmax_pyramid(path, source, name):
+    """
+    Pyramid of source stored in group `name` of the HDF5 file `path`, or None
+    if there is no complete pyramid or if it was built for a different
+    source (see _source_identity).
+    """
+    try:
+        f = h5py.File(path, 'r')
+    except OSError:
+        return None
+    if name not in f or not f[name].attrs.get('complete', False):
+        f.close()
+        return None
+    attrs = f[name].attrs
+    for key, value in _source_identity(source).items():
+        if key not in attrs or not np.array_equal(attrs[key], value):
+            f.close()
+            return None
+    return MinMaxPyramid(f[name])
+
+
+def _source_identity(source, n_rows=16):
+    """
+    Attributes identifying the source of a pyramid: its shape, a hash of its
+    first and last rows and, for HDF5 datasets, the address of the dataset in its file,
+    which changes when the dataset is written again. File modification
+    times are not used, since opening files for writing updates them.
+    """
+    rows = hashlib.sha1(np.ascontiguousarray(source[:n_rows]).tobytes())
+    rows.update(np.ascontiguousarray(source[-n_rows:]).tobytes())
+    identity = {'source_shape': np.array(source.shape),
+                'source_rows': rows.hexdigest()}
+    if isinstance(source, h5py.Dataset):
+        identity['source_address'] = h5py.h5o.get_info(source.id).addr
+    return identity
+
+
+def _sample_bins(X, factor):
+    """
+    Statistics of groups of `factor` consecutive samples of X, dimensions
+    (n_timePoints, n_channels). The last group can be incomplete.
+    """
+    n_bins = -(-X.shape[0] // factor)
+    pad = n_bins * factor - X.shape[0]
+    # Repeating the last sample keeps the minimum and maximum
+    X_edge = np.concatenate((X, np.repeat(X[-1:], pad, axis=0)), axis=0)
+    X_zero = np.concatenate((X, np.zeros((pad, X.shape[1]))), axis=0)
+    X_edge = X_edge.reshape(n_bins, factor, -1)
+    X_zero = X_zero.reshape(n_bins, factor, -1)
+    return np.stack((X_edge.min(axis=1), X_edge.max(axis=1),
+                     X_zero.sum(axis=1), (X_zero**2).sum(axis=1)), axis=-1)
+
+
+def _merge_bins(stats, factor):
+    """
+    Merges groups of `factor` consecutive bins of stats, dimensions (n_bins,
+    n_channels, 4). The last group can be incomplete.
+    """
+    n_bins = -(-stats.shape[0] // factor)
+    pad = n_bins * factor - stats.shape[0]
+    if pad > 0:
+        fill = np.broadcast_to([np.inf, -np.inf, 0, 0],
+                               (pad,) + stats.shape[1:])
+        stats = np.concatenate((stats, fill), axis=0)
+    stats = stats.reshape((n_bins, factor) + stats.shape[1:])
+    return np.stack((stats[..., 0].min(axis=1), stats[..., 1].max(axis=1),
+                     stats[..., 2].sum(axis=1), stats[..., 3].sum(axis=1)),
+                    axis=-1)
+
+
+class MinMaxPyramid:
+    """
+    Min/max pyramid stored in an HDF5 group (see build_minmax_pyramid).
+
+    Parameters
+    ----------
+    group : h5py.Group
+        Group of the pyramid.
+    """
+    def __init__(self, group):
+        self.group = group
+        self.factor = int(group.attrs['factor'])
+        self.n_samples = int(group.attrs['n_samples'])
+        self.offset = group.attrs['offset']
+        self.levels = [group['level_' + str(k)]
+                       for k in range(1, len(group) + 1)]
+
+    def close(self):
+        self.group.file.close()
+
+    def level_for(self, n_samples, max_points):
+        """
+        Finest level with at most max_points bins in n_samples samples (or
+        the coarsest level), or 0 (the samples themselves) if n_samples <=
+        max_points.
+        """
+        k = 0
+        while (k < len(self.levels) and
+               -(-n_samples // self.factor**k) > max_points):
+            k += 1
+        return k
+
+    def read(self, start, stop, channels, max_points=1000):
+        """
+        Min/max envelope of the samples [start, stop) of channels, with at
+        most max_points bins, and their mean and standard deviation.
+
+        Parameters
+        ----------
+        start, stop : int
+            First sample and last sample + 1 of the window.
+        channels : array of ints
+            Channels to read.
+        max_points : int
+            Maximum number of bins.
+
+        Returns
+        -------
+        None if the window has at most max_points samples (they can be
+        plotted directly), otherwise:
+        samples : array
+            Central sample of each bin.
+        Y_min, Y_max : arrays
+            Minimum and maximum of each bin, dimensions (n_channels, n_bins).
+        means, stds : arrays
+            Mean and standard deviation of each channel over the bins.
+        """
+        k = self.level_for(stop - start, max_points)
+        if k == 0:
+            return None
+        level = self.levels[k - 1]
+        width = self.factor**k
+        b0 = start // width
+        b1 = min(-(-stop // width), level.shape[0])
+        channels = np.asarray(channels, dtype='int') % level.shape[1]
+        # Each run of consecutive channels is read once
+        unique = np.unique(channels)
+        runs = np.split(unique, np.flatnonzero(np.diff(unique) > 1) + 1)
+        stats = np.concatenate([level[b0:b1, run[0]:run[-1] + 1]
+                                for run in runs], axis=1)
+        stats = np.asarray(stats, dtype='float64')
+        stats = stats[:, np.searchsorted(unique, channels)].transpose(1, 0, 2)
+        offset = self.offset[channels, None]
+        # The last bin of the signals can be shorter
+        counts = np.minimum(self.n_samples - np.arange(b0, b1) * width, width)
+        samples = np.arange(b0, b1) * width + counts / 2.
+        mean = stats[..., 2].sum(axis=1) / counts.sum()
+        var = stats[..., 3].sum(axis=1) / counts.sum() - mean**2
+        return (samples, stats[..., 0] + offset, stats[..., 1] + offset,
+                mean + offset[:, 0], np.sqrt(np.maximum(var, 0)))
@@ -0,0 +1,264 @@
+"""
+Execution of per-channel computations over blocks of channels, serially or
+on a pool of worker processes.
+"""
+import collections
+import multiprocessing as mp
+import os
+
+import h5py
+import numpy as np
+
+__all__ = ['CHANNEL_BLOCK_SIZE',
+           'channel_blocks',
+           'channel_block_size',
+           'map_channel_blocks',
+           'imap_channel_blocks']
+
+# Default number of channels per block
+CHANNEL_BLOCK_SIZE = 4
+
+
+# State of each worker process, set by _init_worker
+_worker = {}
+
+
+def channel_blocks(n_channels, block_size):
+    """
+    Splits channels into consecutive blocks.
+
+    Returns
+    -------
+    blocks : list of tuples
+        (first, last + 1) channel of each block.
+    """
+    return [(c0, min(c0 + block_size, n_channels))
+            for c0 in range(0, n_channels, block_size)]
+
+
+def channel_block_size(src, bytes_per_value, max_memory):
+    """
+    Number of channels per block such that processing a block takes at most
+    max_memory (MB), given the bytes used per value of src. For chunked HDF5
+    datasets, blocks are multiples of the chunk width along channels, so
+    that chunks are not read twice by neighboring blocks.
+
+    Parameters
+    ----------
+    src : h5py.Dataset or array
+        Signals, dimensions (n_timePoints, n_channels).
+    bytes_per_value : float
+        Peak memory used per time point and channel while processing.
+    max_memory : float
+        Memory budget (MB).
+    """
+    n_time, n_channels = src.shape[:2]
+    size = int(max_memory * 2**20 // (bytes_per_value * n_time))
+    chunks = getattr(src, 'chunks', None)
+    if chunks is not None and size > chunks[1]:
+        size -= size % chunks[1]
+    return int(np.clip(size, 1, n_channels))
+
+
+def map_channel_blocks(func, src, out_shapes, args=(), workers=None,
+                       block_size=CHANNEL_BLOCK_SIZE, dtype='float64'):
+    """
+    Applies func(X, *args) to blocks of channels and gathers the results.
+
+    With workers > 1, blocks are processed by a pool of processes. Workers
+    read their own slices of src (HDF5 datasets are reopened read-only, and
+    arrays are copied to shared memory) and write their results to shared
+    memory. Datasets of files open for writing are not reopened: HDF5 does
+    not support reading a file while another process writes it, so their
+    blocks are read by the current process and sent to the workers (see
+    imap_channel_blocks). Blocks, and the computations on them, are the
+    same for any number of workers, so results are identical to the serial
+    ones.
+
+    Workers are started with the 'spawn' method, which gives them a clean
+    HDF5 library state (forked processes inherit the parent's open files and
+    cannot reopen them). Scripts using workers must therefore guard their
+    entry point with `if __name__ == '__main__':`.
+
+    Parameters
+    ----------
+    func : function
+        Module-level function taking a block of signals, dimensions
+        (n_block_channels, n_timePoints), and returning an array (or tuple of
+        arrays) with the block channels along the first dimension.
+    src : h5py.Dataset or array
+        Signals, dimensions (n_timePoints, n_channels), as stored in NWB
+        files.
+    out_shapes : tuple or list of tuples
+        Shapes of the outputs of func for all channels, with channels along
+        the first dimension.
+    args : tuple
+        Extra arguments to func.
+    workers : int or None
+        Number of worker processes. None or 1 runs in the current process.
+    block_size : int
+        Number of channels per block.
+    dtype : numpy dtype
+        Data type of the outputs.
+
+    Returns
+    -------
+    out : array or list of arrays
+        Outputs with shapes out_shapes.
+    """
+    single = not isinstance(out_shapes, list)
+    if single:
+        out_shapes = [out_shapes]
+    blocks = channel_blocks(src.shape[1], block_size)
+
+    if workers is None or workers <= 1:
+        out = [np.zeros(shape, dtype=dtype) for shape in out_shapes]
+        for block in blocks:
+            _store_block(func, args, src, out, block)
+    elif _open_for_writing(src):
+        out = [np.zeros(shape, dtype=dtype) for shape in out_shapes]
+        for block, res in imap_channel_blocks(func, src, args, workers,
+                                              block_size):
+            _store_result(out, block, res)
+    else:
+        ctx = mp.get_context('spawn')
+        ctype = np.ctypeslib.as_ctypes_type(np.dtype(dtype))
+        out_buffers = [ctx.RawArray(ctype, int(np.prod(shape)))
+                       for shape in out_shapes]
+        src_info = _shared_src(ctx, src)
+        with ctx.Pool(processes=min(workers, len(blocks)),
+                     initializer=_init_worker,
+                     initargs=(func, args, src_info, out_buffers, out_shapes,
+                               dtype)) as pool:
+            pool.map(_run_worker_block, blocks, chunksize=1)
+        out = [_as_array(buf, shape, dtype)
+               for buf, shape in zip(out_buffers, out_shapes)]
+
+    return out[0] if single else out
+
+
+def imap_channel_blocks(func, src, args=(), workers=None,
+                        block_size=CHANNEL_BLOCK_SIZE):
+    """
+    Applies func(X, *args) to blocks of channels, yielding the results block
+    by block, in channel order, so that they can be written out as they are
+    finished.
+
+    Parameters are as in map_channel_blocks. With workers > 1, results are
+    sent back from the worker processes instead of written to shared memory.
+    Blocks of datasets of files open for writing (e.g. the file the results
+    are written to) are read by the current process, at most two blocks per
+    worker ahead of the results, and sent to the workers.
+
+    Yields
+    ------
+    block : tuple
+        (first, last + 1) channel of the block.
+    res : array or tuple of arrays
+        Output of func for the block.
+    """
+    blocks = channel_blocks(src.shape[1], block_size)
+    if workers is None or workers <= 1:
+        for block in blocks:
+            yield block, func(_read_block(src, block), *args)
+    elif _open_for_writing(src):
+        ctx = mp.get_context('spawn')
+        with ctx.Pool(processes=min(workers, len(blocks)),
+                      initializer=_init_worker,
+                      initargs=(func, args, None, [], [],
+                                'float64')) as pool:
+            pending = collections.deque()
+            for block in blocks:
+                pending.append((block, pool.apply_async(
+                    _compute_block, (_read_block(src, block),))))
+                if len(pending) >= 2 * workers:
+                    block, res = pending.popleft()
+                    yield block, res.get()
+            while pending:
+                block, res = pending.popleft()
+                yield block, res.get()
+    else:
+        ctx = mp.get_context('spawn')
+        with ctx.Pool(processes=min(workers, len(blocks)),
+                      initializer=_init_worker,
+                      initargs=(func, args, _shared_src(ctx, src), [], [],
+                                'float64')) as pool:
+            for block, res in zip(blocks, pool.imap(_compute_worker_block,
+                                                    blocks)):
+                yield block, res
+
+
+def _open_for_writing(src):
+    """Whether src is a dataset of an HDF5 file open for writing."""
+    return isinstance(src, h5py.Dataset) and src.file.mode != 'r'
+
+
+def _shared_src(ctx, src):
+    """
+    What workers need to read src: the file name and dataset name of HDF5
+    datasets, or a shared memory copy of arrays.
+    """
+    if isinstance(src, h5py.Dataset):
+        return (src.file.filename, src.name)
+    # Stored channel-major, so that channel blocks are contiguous
+    src = np.asarray(src)
+    src_buffer = ctx.RawArray(np.ctypeslib.as_ctypes_type(src.dtype),
+                              src.size)
+    _as_array(src_buffer, src.shape[::-1], src.dtype)[:] = src.T
+    return (src_buffer, src.shape[::-1], src.dtype.str)
+
+
+def _as_array(buffer, shape, dtype):
+    return np.frombuffer(buffer, dtype=dtype).reshape(shape)
+
+
+def _read_block(src, block):
+    c0, c1 = block
+    return np.ascontiguousarray(src[:, c0:c1].T)
+
+
+def _store_block(func, args, src, out, block):
+    _store_result(out, block, func(_read_block(src, block), *args))
+
+
+def _store_result(out, block, res):
+    c0, c1 = block
+    if not isinstance(res, tuple):
+        res = (res,)
+    for o, r in zip(out, res):
+        o[c0:c1] = r
+
+
+def _init_worker(func, args, src_info, out_buffers, out_shapes, dtype):
+    if src_info is None:
+        # Blocks are sent with the tasks
+        _worker['src'] = None
+    elif isinstance(src_info[0], str):
+        filename, name = src_info
+        try:
+            f = h5py.File(filename, 'r', locking=False)
+        except TypeError:   # h5py < 3.5
+            os.environ['HDF5_USE_FILE_LOCKING'] = 'FALSE'
+            f = h5py.File(filename, 'r')
+        _worker['file'] = f
+        _worker['src'] = f[name]
+    else:
+        buffer, shape, src_dtype = src_info
+        _worker['src'] = _as_array(buffer, shape, src_dtype).T
+    _worker['func'] = func
+    _worker['args'] = args
+    _worker['out'] = [_as_array(buf, shape, dtype)
+                      for buf, shape in zip(out_buffers, out_shapes)]
+
+
+def _run_worker_block(block):
+    _store_block(_worker['func'], _worker['args'], _worker['src'],
+                 _worker['out'], block)
+
+
+def _compute_worker_block(block):
+    return _compute_block(_read_block(_worker['src'], block))
+
+
+def _compute_block(X):
+    return _worker['func'](X, *_worker['args'])
@@ -1,18 +1,56 @@
+import time
+from contextlib import ExitStack
+
 import numpy as np
 from scipy import signal as sgn
 from pynwb import NWBHDF5IO, ProcessingModule
 from ndx_spectrum import Spectrum
+from ecogvis.signal_processing.parallel import (channel_block_size,
+                                                map_channel_blocks)
+
+#Bytes per value of time chunks streamed through WelchAccumulator: chunk,
+#overlapping detrended segments and their spectra
+STREAMING_BYTES = 40
+#Bytes per value of blocks of channels for the periodogram: block, its
+#detrended copy and spectrum
+PERIODOGRAM_BYTES = 32
+
 
-def psd_estimate(src_file, type):
+def psd_estimate(src_file, type, workers=None, max_memory=1024,
+                 streaming=None, session_files=()):
     """
     Estimates Power Spectral Density from signals.
 
+    By default, Welch's PSD is streamed in time chunks of all channels
+    through WelchAccumulator, in one pass over the file, and the periodogram
+    of the whole signals is computed on blocks of channels (see _psd_blocks).
+    Recordings too long for the periodogram of a single channel to fit in
+    max_memory, or whole sessions spread over several files, are streamed
+    entirely, with memory independent of their duration. The periodogram is
+    then replaced by the average periodogram of the longest power of 2
+    segments that fit in max_memory (Bartlett's method).
+
     Parameters
     ----------
     src_file : str or path
         Full path to the current NWB file.
     type : str
         ElectricalSeries source. 'raw' or 'preprocessed'.
+    workers : int or None
+        Number of processes estimating the periodogram of blocks of channels
+        in parallel. None runs in the current process.
+    max_memory : float
+        Memory budget (MB) of each process. Time chunks, and blocks of
+        channels for the periodogram, are as large as fit in it. Welch's PSD
+        takes one pass over the file, and the periodogram one more pass per
+        block: e.g. with 1024 MB, 1 hour of 256 channels takes 1 + 12 passes
+        at 400 Hz, and 1 + 86 passes at 3 kHz.
+    streaming : bool or None
+        Whether to stream the signals in time chunks. None streams them only
+        if they are too long to be processed by blocks of channels.
+    session_files : list of str
+        Other NWB files of the same session. Their signals (of the same type)
+        are included in the estimate, which is stored in src_file.
     """
 
     #Open file
@@ -20,10 +58,7 @@ def psd_estimate(src_file, type):
         nwb = io.read()
 
         #Source ElectricalSeries
-        if type=='raw':
-            data_obj = nwb.acquisition['ElectricalSeries']
-        elif type=='preprocessed':
-            data_obj = nwb.processing['ecephys'].data_interfaces['LFP'].electrical_series['preprocessed']
+        data_obj = _source_series(nwb, type)
 
         nChannels = data_obj.data.shape[1]
         nSamples = data_obj.data.shape[0]
@@ -34,21 +69,21 @@ def psd_estimate(src_file, type):
         #FFT - using a power of 2 number of samples improves performance
         nfft = int(2**(np.floor(np.log2(nSamples)).astype('int')))
         fx_lim = 200.
-        for ch in np.arange(nChannels):  # Iterate over channels
-            trace = data_obj.data[:, ch]
-            fx_w, py_w = sgn.welch(trace, fs=fs, nperseg=win_len_welch)
-            fx_f, py_f = sgn.periodogram(trace, fs=fs, nfft=nfft)
+        if streaming is None:
+            #the periodogram of a single channel must fit in max_memory
+            streaming = PERIODOGRAM_BYTES * nSamples > max_memory * 2**20
+        start = time.time()
+        if streaming or session_files:
+            fx_w, PY_welch, fx_f, PY_fft = _psd_streaming(
+                data_obj, type, session_files, win_len_welch, fx_lim,
+                max_memory)
+        else:
             #saves PSD up to 200 Hz
-            py_w = py_w[fx_w < fx_lim]
-            fx_w = fx_w[fx_w < fx_lim]
-            py_f = py_f[fx_f < fx_lim]
-            fx_f = fx_f[fx_f < fx_lim]
-            if ch==0:
-                PY_welch = py_w.reshape(-1,1)
-                PY_fft = py_f.reshape(-1,1)
-            else:
-                PY_welch = np.append(PY_welch, py_w.reshape(-1,1), axis=1)
-                PY_fft = np.append(PY_fft, py_f.reshape(-1,1), axis=1)
+            fx_w, PY_welch, fx_f, PY_fft = _psd_blocks(
+                data_obj.data, fs, win_len_welch, nfft, fx_lim, workers,
+                max_memory)
+        print('PSD of {} channels estimated in {} seconds'
+              .format(nChannels, time.time()-start))
 
         #Electrodes
         elecs_region = nwb.electrodes.create_region(name='electrodes',
@@ -83,3 +118,186 @@ def psd_estimate(src_file, type):
         io.write(nwb)
         print('Spectrum_welch_'+type+' added to file.')
         print('Spectrum_fft_'+type+' added to file.')
+
+
+def _psd_blocks(src, fs, win_len_welch, nfft, fx_lim, workers, max_memory):
+    """
+    Welch's PSD of src, dimensions (n_timePoints, n_channels), streamed in
+    one pass of time chunks, and periodogram of its first nfft samples,
+    computed on blocks of channels in one pass over src per block.
+
+    Returns
+    -------
+    fx_w, PY_welch, fx_f, PY_fft : arrays
+        Frequencies and PSD, dimensions (n_frequencies, n_channels), up to
+        fx_lim Hz.
+    """
+    nSamples, nChannels = src.shape
+    welch = WelchAccumulator(fs, nChannels, min(win_len_welch, nSamples),
+                             fx_lim=fx_lim)
+    for X in _time_chunks(src, max_memory):
+        welch.update(X)
+
+    fx_f = np.fft.rfftfreq(nfft, 1./fs)
+    fx_f = fx_f[fx_f < fx_lim]
+    block_size = channel_block_size(src, PERIODOGRAM_BYTES, max_memory)
+    print('Periodogram of {} channels in {} passes of {} channels'.format(
+        nChannels, -(-nChannels // block_size), block_size))
+    PY_fft = map_channel_blocks(_periodogram_channels, src,
+                                (nChannels, len(fx_f)),
+                                args=(fs, nfft, fx_lim), workers=workers,
+                                block_size=block_size)
+    return welch.frequencies, welch.power, fx_f, PY_fft.T
+
+
+def _periodogram_channels(X, fs, nfft, fx_lim):
+    """
+    Periodogram PSD of the first nfft samples of a block of channels,
+    dimensions (n_channels, n_timePoints), up to fx_lim Hz.
+    """
+    fx_f, py_f = sgn.periodogram(X, fs=fs, nfft=nfft)
+    return py_f[:, fx_f < fx_lim]
+
+
+def _time_chunks(src, max_memory):
+    """
+    Consecutive time chunks of all channels of src, as large as fit in
+    max_memory (MB) while streamed through WelchAccumulator.
+    """
+    chunk_len = max(int(max_memory * 2**20 //
+                        (STREAMING_BYTES * src.shape[1])), 1)
+    for t0 in range(0, src.shape[0], chunk_len):
+        yield src[t0:t0 + chunk_len]
+
+
+class WelchAccumulator:
+    """
+    Welch's PSD estimate of signals streamed in time chunks. Keeps the sum of
+    the periodograms of the detrended, windowed segments seen so far, and the
+    samples of the last, incomplete segment. Memory does not depend on the
+    duration of the signals.
+
+    With the default parameters, the estimate equals scipy.signal.welch of
+    the concatenated chunks. A 'boxcar' window with no overlap gives
+    Bartlett's average periodogram.
+
+    Parameters
+    ----------
+    rate : float
+        Sampling rate of the signals.
+    n_channels : int
+        Number of channels.
+    nperseg : int
+        Length of each segment.
+    noverlap : int or None
+        Number of samples overlapping between segments. Defaults to
+        nperseg // 2.
+    window : str or tuple
+        Window applied to each segment, as in scipy.signal.get_window.
+    fx_lim : float or None
+        Only frequencies below fx_lim are kept.
+    """
+    def __init__(self, rate, n_channels, nperseg, noverlap=None,
+                 window='hann', fx_lim=None):
+        self.rate = rate
+        self.n_channels = n_channels
+        self.nperseg = int(nperseg)
+        self.noverlap = self.nperseg // 2 if noverlap is None else noverlap
+        self.step = self.nperseg - self.noverlap
+        self.window = sgn.get_window(window, self.nperseg)
+        frequencies = np.fft.rfftfreq(self.nperseg, 1. / rate)
+        if fx_lim is not None:
+            frequencies = frequencies[frequencies < fx_lim]
+        self.frequencies = frequencies
+        self.power_sum = np.zeros((len(frequencies), n_channels))
+        self.n_segments = 0
+        self._tail = np.zeros((0, n_channels))
+
+    def update(self, X):
+        """
+        Adds a chunk of signals, dimensions (n_timePoints, n_channels),
+        following the previous chunk in time.
+        """
+        X = np.concatenate((self._tail, X), axis=0)
+        n = max((X.shape[0] - self.noverlap) // self.step, 0)
+        if n > 0:
+            stride_t, stride_ch = X.strides
+            segments = np.lib.stride_tricks.as_strided(
+                X, shape=(n, self.nperseg, self.n_channels),
+                strides=(self.step * stride_t, stride_t, stride_ch),
+                writeable=False)
+            segments = segments - segments.mean(axis=1, keepdims=True)
+            segments *= self.window[:, None]
+            spectra = np.fft.rfft(segments, axis=1)[:, :len(self.frequencies)]
+            self.power_sum += (spectra.real**2 + spectra.imag**2).sum(axis=0)
+            self.n_segments += n
+        self._tail = X[n * self.step:].copy()
+
+    def new_recording(self):
+        """
+        Drops the incomplete segment, so that no segment spans the end of a
+        recording and the start of the next one.
+        """
+        self._tail = np.zeros((0, self.n_channels))
+
+    @property
+    def power(self):
+        """PSD, dimensions (n_frequencies, n_channels)."""
+        if self.n_segments == 0:
+            raise ValueError('Signals shorter than a segment of {} samples.'
+                             .format(self.nperseg))
+        scale = 1. / (self.rate * (self.window**2).sum() * self.n_segments)
+        power = self.power_sum * scale
+        #One-sided spectrum: doubles all but the DC and Nyquist frequencies
+        last = len(self.frequencies)
+        if self.nperseg % 2 == 0 and last == self.nperseg // 2 + 1:
+            last -= 1
+        power[1:last] *= 2
+        return power
+
+
+def _source_series(nwb, type):
+    if type=='raw':
+        return nwb.acquisition['ElectricalSeries']
+    elif type=='preprocessed':
+        return nwb.processing['ecephys'].data_interfaces['LFP'].electrical_series['preprocessed']
+
+
+def _psd_streaming(data_obj, type, session_files, win_len_welch, fx_lim,
+                   max_memory):
+    """
+    Welch's PSD and Bartlett's average periodogram of the signals of data_obj
+    and of the same signals in session_files, read in time chunks.
+    """
+    with ExitStack() as stack:
+        sources = [data_obj.data]
+        for session_file in session_files:
+            io = stack.enter_context(NWBHDF5IO(session_file, mode='r',
+                                               load_namespaces=True))
+            series = _source_series(io.read(), type)
+            if series.rate != data_obj.rate:
+                raise ValueError('{} signals of {} are sampled at {} Hz, '
+                                 'instead of {} Hz.'.format(
+                                     type, session_file, series.rate,
+                                     data_obj.rate))
+            sources.append(series.data)
+
+        fs = data_obj.rate
+        nChannels = data_obj.data.shape[1]
+        shortest = min(src.shape[0] for src in sources)
+        #Periodogram segments as long as time chunks
+        chunk_len = max(int(max_memory * 2**20 //
+                            (STREAMING_BYTES * nChannels)), 1)
+        fft_len = 2**int(np.floor(np.log2(min(chunk_len, shortest))))
+        welch = WelchAccumulator(fs, nChannels, min(win_len_welch, shortest),
+                                 fx_lim=fx_lim)
+        bartlett = WelchAccumulator(fs, nChannels, fft_len, noverlap=0,
+                                    window='boxcar', fx_lim=fx_lim)
+        for src in sources:
+            for X in _time_chunks(src, max_memory):
+                welch.update(X)
+                bartlett.update(X)
+            welch.new_recording()
+            bartlett.new_recording()
+
+    return welch.frequencies, welch.power, bartlett.frequencies, bartlett.power
@@ -3,6 +3,8 @@ from __future__ import print_function, division
 import os
 import time
 
+import h5py
+
 import nwbext_ecog
 from hdmf.common.table import DynamicTable, VectorData
 from pynwb import NWBHDF5IO, ProcessingModule
@@ -12,23 +14,63 @@ from pynwb.misc import DecompositionSeries
 from ecogvis.functions.nwb_copy_file import nwb_copy_file
 from ecogvis.signal_processing.bands import *
 from ecogvis.signal_processing.common_referencing import *
+from ecogvis.signal_processing.data_chunks import (BlockDataChunkIterator,
+                                                   row_chunk_shape)
 from ecogvis.signal_processing.hilbert_transform import *
 from ecogvis.signal_processing.linenoise_notch import *
+from ecogvis.signal_processing.parallel import (channel_block_size,
+                                                imap_channel_blocks,
+                                                map_channel_blocks)
 from ecogvis.signal_processing.resample import *
+from ecogvis.signal_processing.resample_clone import resample as resample_func
+
 
+def processing_data(path, subject, blocks, mode=None, config=None, new_file='',
+                    workers=None, out_rate=None):
+    """
+    Runs a processing step on NWB files of several blocks.
 
-def processing_data(path, subject, blocks, mode=None, config=None, new_file=''):
+    Parameters
+    ----------
+    path : str
+        Directory of the NWB files.
+    subject : str
+        Subject code, files are named '{subject}_B{block}.nwb'.
+    blocks : list
+        Block numbers.
+    mode : str
+        'preprocess', 'decomposition', 'high_gamma' or 'spectral_analysis'
+        (decomposition, high gamma and band groups in a single pass).
+    config : dictionary or array
+        Configuration of the processing step, see preprocess_raw_data,
+        spectral_decomposition and high_gamma_estimation.
+    new_file : str
+        Path of a new NWB file to store results in.
+    workers : int or None
+        Number of processes working on blocks of channels in parallel.
+        None runs in the current process.
+    out_rate : float or None
+        Sampling rate (Hz) of the 'decomposition', 'high_gamma' and
+        'spectral_analysis' outputs.
+        None keeps the LFP rate.
+    """
     for block in blocks:
         block_path = os.path.join(path, '{}_B{}.nwb'.format(subject, block))
         if new_file != '':
             make_new_nwb(old_file=block_path, new_file=new_file)
 
         if mode == 'preprocess':
-            preprocess_raw_data(block_path, config=config)
+            preprocess_raw_data(block_path, config=config, workers=workers)
         elif mode == 'decomposition':
-            spectral_decomposition(block_path, bands_vals=config)
+            spectral_decomposition(block_path, bands_vals=config,
+                                   workers=workers, out_rate=out_rate)
         elif mode == 'high_gamma':
-            high_gamma_estimation(block_path, bands_vals=config, new_file=new_file)
+            high_gamma_estimation(block_path, bands_vals=config,
+                                  new_file=new_file, workers=workers,
+                                  out_rate=out_rate)
+        elif mode == 'spectral_analysis':
+            spectral_analysis(block_path, outputs=config, workers=workers,
+                              out_rate=out_rate)
 
 
 def make_new_nwb(old_file, new_file, cp_objs=None):
@@ -92,7 +134,7 @@ def make_new_nwb(old_file, new_file, cp_objs=None):
     nwb_copy_file(old_file, new_file, cp_objs=cp_objs)
 
 
-def preprocess_raw_data(block_path, config):
+def preprocess_raw_data(block_path, config, workers=None):
     """
     Takes raw data and runs:
     1) CAR
@@ -110,6 +152,14 @@ def preprocess_raw_data(block_path, config):
             ('bipolar', INCLUDE_OBLIQUE_NBHD)
         'Notch' - Main frequency (Hz) for notch filters (default=60)
         'Downsample' - Downsampling frequency (Hz, default= 400)
+        'Resample' - (optional) Downsampling method, 'polyphase' (default) or
+            'fft' (FFT resampling of power of 2 padded signals)
+        'MaxMemory' - (optional) Memory budget (MB). If given, signals are
+            processed in overlapping time chunks and written to the file as
+            they are finished, instead of being held in memory.
+    workers : int or None
+        Number of processes downsampling and notch filtering blocks of
+        channels in parallel. None runs in the current process.
 
     Returns
     -------
@@ -153,85 +203,22 @@ def preprocess_raw_data(block_path, config):
                 'Not precisely one ElectricalSeries in acquisition!')
             source = source_list[0]
             nChannels = source.data.shape[1]
-
-            # Downsampling
-            if config['Downsample'] is not None:
-                print("Downsampling signals to "+str(config['Downsample'])+" Hz.")
-                print("Please wait, this might take around 30 minutes.")
-                start = time.time()
-                # zeros to pad to make signal length a power of 2
-                nBins = source.data.shape[0]
-                extraBins0 = 2**(np.ceil(np.log2(nBins)).astype('int')) - nBins
-                extraZeros = np.zeros(extraBins0)
-                rate = config['Downsample']
-
-                # malloc
-                T = int(np.ceil((nBins + extraBins0)*rate/source.rate))
-                X = np.zeros((source.data.shape[1], T))
-
-                # One channel at a time, to improve memory usage for long signals
-                for ch in np.arange(nChannels):
-                    # 1e6 scaling helps with numerical accuracy
-                    Xch = source.data[:, ch]*1e6
-                    # Make length a power of 2, improves performance
-                    Xch = np.append(Xch, extraZeros)
-                    X[ch, :] = resample(Xch, rate, source.rate)
-                print('Downsampling finished in {} seconds'.format(
-                    time.time()-start))
-            else:  # No downsample
-                extraBins0 = 0
-                rate = source.rate
-                X = source.data[()].T*1e6
-
-            # re-reference the (scaled by 1e6!) data
             electrodes = source.electrodes
-            if config['referencing'] is not None:
-                if config['referencing'][0] == 'CAR':
-                    print("Computing and subtracting Common Average Reference in "
-                          + str(config['referencing'][1])+" channel blocks.")
-                    start = time.time()
-                    X = subtract_CAR(X, b_size=config['referencing'][1])
-                    print('CAR subtract time for {}: {} seconds'.format(
-                        block_name, time.time()-start))
-                elif config['referencing'][0] == 'bipolar':
-                    X, bipolarTable, electrodes = get_bipolar_referenced_electrodes(
-                        X, electrodes, rate, grid_step=1)
-
-                    # add data interface for the metadata for saving
-                    ecephys_module.add_data_interface(bipolarTable)
-                    print('bipolarElectrodes stored for saving in '+block_path)
-                else:
-                    print('UNRECOGNIZED REFERENCING SCHEME; ', end='')
-                    print('SKIPPING REFERENCING!')
 
-            # Apply Notch filters
-            if config['Notch'] is not None:
-                print("Applying notch filtering of "+str(config['Notch'])+" Hz")
-                # zeros to pad to make signal lenght a power of 2
-                nBins = X.shape[1]
-                extraBins1 = 2**(np.ceil(np.log2(nBins)).astype('int')) - nBins
-                extraZeros = np.zeros(extraBins1)
-                start = time.time()
-                for ch in np.arange(nChannels):
-                    Xch = np.append(X[ch, :], extraZeros).reshape(1, -1)
-                    Xch = linenoise_notch(Xch, rate, notch_freq=config['Notch'])
-                    if ch == 0:
-                        X2 = Xch.reshape(1, -1)
-                    else:
-                        X2 = np.append(X2, Xch.reshape(1, -1), axis=0)
-                print('Notch filter time for {}: {} seconds'.format(
-                    block_name, time.time()-start))
-
-                X = np.copy(X2)
-                del X2
+            streaming = config.get('MaxMemory') is not None
+            if streaming and config['referencing'] is not None and \
+                    config['referencing'][0] == 'bipolar':
+                print('Bipolar referencing is not available in chunks, '
+                      'processing whole signals in memory.')
+                streaming = False
+
+            if streaming:
+                print("Preprocessing signals in chunks of at most "
+                      + str(config['MaxMemory']) + " MB.")
+                data, rate = preprocessed_chunks(source, config)
             else:
-                extraBins1 = 0
-
-            # Remove excess bins (because of zero padding on previous steps)
-            excessBins = int(np.ceil(extraBins0*rate/source.rate) + extraBins1)
-            X = X[:, 0:-excessBins]
-            X = X.astype('float32')     # signal (nChannels,nSamples)
-            X /= 1e6                    # Scales signals back to volts
+                data, rate, electrodes = _preprocess_in_memory(
+                    source, config, ecephys_module, block_path, workers)
 
             # Add preprocessed downsampled signals as an electrical_series
             referencing = 'None' if config['referencing'] is None else config[
@@ -247,7 +234,7 @@ def preprocess_raw_data(block_path, config):
             # create an electrical series for the LFP and store it in lfp
             lfp_ts = lfp.create_electrical_series(
                 name='preprocessed',
-                data=X.T,
+                data=data,
                 electrodes=electrodes,
                 rate=rate,
                 description='',
@@ -260,6 +247,252 @@ def preprocess_raw_data(block_path, config):
             print('LFP saved in '+block_path)
 
 
+def _preprocess_in_memory(source, config, ecephys_module, block_path,
+                          workers=None, max_memory=1024):
+    """
+    Downsampling, referencing and notch filtering of whole signals, by blocks
+    of channels as wide as fit in max_memory (MB) in each process.
+
+    Returns
+    -------
+    X : array
+        Preprocessed signals, dimensions (n_timePoints, n_channels)
+    rate : float
+        Sampling rate of X.
+    electrodes : DynamicTableRegion
+        Electrodes of X.
+    """
+    block_name = os.path.splitext(block_path)[0]
+    nChannels = source.data.shape[1]
+
+    # Downsampling
+    if config['Downsample'] is not None:
+        print("Downsampling signals to "+str(config['Downsample'])+" Hz.")
+        start = time.time()
+        nBins = source.data.shape[0]
+        rate = config['Downsample']
+        if config.get('Resample', 'polyphase') == 'polyphase':
+            kind = 'polyphase'
+            extraBins0 = 0
+            up, down = rational_ratio(rate, source.rate)
+            T = int(np.ceil(nBins*up/down))
+        else:
+            print("Please wait, this might take around 30 minutes.")
+            kind = 1
+            # zeros to pad to make signal length a power of 2
+            extraBins0 = 2**(np.ceil(np.log2(nBins)).astype('int')) - nBins
+            T = int(np.ceil((nBins + extraBins0)*rate/source.rate))
+
+        # Blocks of channels, to improve memory usage for long signals.
+        # ~48 bytes per input bin and channel: float64 data, its complex
+        # spectrum and the complex inverse transform
+        block_size = channel_block_size(
+            source.data, 48 * (nBins + extraBins0) / nBins, max_memory)
+        X = map_channel_blocks(
+            _downsample_channels, source.data, (nChannels, T),
+            args=(rate, source.rate, kind, extraBins0), workers=workers,
+            block_size=block_size)
+        print('Downsampling finished in {} seconds'.format(
+            time.time()-start))
+    else:  # No downsample
+        extraBins0 = 0
+        rate = source.rate
+        X = source.data[()].T*1e6
+
+    # re-reference the (scaled by 1e6!) data
+    electrodes = source.electrodes
+    if config['referencing'] is not None:
+        if config['referencing'][0] == 'CAR':
+            print("Computing and subtracting Common Average Reference in "
+                  + str(config['referencing'][1])+" channel blocks.")
+            start = time.time()
+            X = subtract_CAR(X, b_size=config['referencing'][1])
+            print('CAR subtract time for {}: {} seconds'.format(
+                block_name, time.time()-start))
+        elif config['referencing'][0] == 'bipolar':
+            X, bipolarTable, electrodes = get_bipolar_referenced_electrodes(
+                X, electrodes, rate, grid_step=1)
+
+            # add data interface for the metadata for saving
+            ecephys_module.add_data_interface(bipolarTable)
+            print('bipolarElectrodes stored for saving in '+block_path)
+        else:
+            print('UNRECOGNIZED REFERENCING SCHEME; ', end='')
+            print('SKIPPING REFERENCING!')
+
+    # Apply Notch filters
+    if config['Notch'] is not None:
+        print("Applying notch filtering of "+str(config['Notch'])+" Hz")
+        # FFT length as a power of 2, improves performance
+        nBins = X.shape[1]
+        n_fft = int(2**(np.ceil(np.log2(nBins)).astype('int')))
+        start = time.time()
+        block_size = channel_block_size(X.T, 48 * n_fft / nBins, max_memory)
+        X = map_channel_blocks(
+            _notch_channels, X.T, X.shape,
+            args=(rate, config['Notch'], n_fft), workers=workers,
+            block_size=block_size)
+        print('Notch filter time for {}: {} seconds'.format(
+            block_name, time.time()-start))
+
+    # Remove excess bins (because of zero padding on previous steps)
+    excessBins = int(np.ceil(extraBins0*rate/source.rate))
+    X = X[:, :X.shape[1]-excessBins]
+    X = X.astype('float32')     # signal (nChannels,nSamples)
+    X /= 1e6                    # Scales signals back to volts
+
+    return X.T, rate, electrodes
+
+
+def _downsample_channels(X, rate, old_rate, kind, extraBins):
+    """
+    Downsampling of a block of channels, dimensions (n_channels, n_timePoints)
+    """
+    # 1e6 scaling helps with numerical accuracy
+    X = X*1e6
+    # Make length a power of 2, improves FFT performance
+    X = np.append(X, np.zeros((X.shape[0], extraBins)), axis=1)
+    return resample(X, rate, old_rate, kind=kind)
+
+
+def _notch_channels(X, rate, notch, n_fft):
+    """
+    Notch filtering of a block of channels, dimensions
+    (n_channels, n_timePoints)
+    """
+    return linenoise_notch(X, rate, notch_freq=notch, n_fft=n_fft, out=X)
+
+
+def _hilbert_channels(X, rate, band_param_0, band_param_1, out_rate=None):
+    """
+    Analytic amplitude of a block of channels, dimensions
+    (n_channels, n_timePoints), in Gaussian bands. Returns an array of
+    dimensions (n_channels, n_bands, n_out), where n_out is n_timePoints or,
+    if out_rate is given, the number of time points at out_rate.
+    """
+    X = X*1e6       # 1e6 scaling helps with numerical accuracy
+    X = X.astype('float32')
+    bank = gaussian_filter_bank(X.shape[1], rate, tuple(band_param_0),
+                                tuple(band_param_1))
+    if out_rate is None:
+        Xp = np.zeros((X.shape[0], bank.n_bands, X.shape[1]), dtype='float32')
+        bank.amplitude(X, out=Xp.transpose(1, 0, 2))
+    else:
+        n_out = decimated_length(X.shape[1], rate, out_rate)
+        Xp = np.zeros((X.shape[0], bank.n_bands, n_out), dtype='float32')
+        bank.decimated_amplitude(X, out_rate, out=Xp.transpose(1, 0, 2))
+    return Xp
+
+
+def _high_gamma_channels(X, rate, band_param_0, band_param_1, out_rate=None):
+    """
+    Analytic amplitude of a block of channels, dimensions
+    (n_channels, n_timePoints), averaged over Gaussian bands. Returns an
+    array of dimensions (n_channels, n_out), as in _hilbert_channels.
+    """
+    X = X*1e6       # 1e6 scaling helps with numerical accuracy
+    X = X.astype('float32')
+    bank = gaussian_filter_bank(X.shape[1], rate, tuple(band_param_0),
+                                tuple(band_param_1))
+    return bank.mean_amplitude(X, out_rate=out_rate).astype('float32')
+
+
+def preprocessed_chunks(source, config, halo=5.):
+    """
+    Downsampling, CAR and notch filtering in overlapping time chunks
+    (overlap-save), so that peak memory is bounded by config['MaxMemory']
+    instead of growing with the recording length.
+
+    Each chunk is read with `halo` seconds of extra signal on both sides,
+    processed, and trimmed back, which keeps the filter edge effects out of
+    the stored signal. Chunk lengths are multiples of the rational
+    approximation p/q of old_rate/new_rate, so that chunks stitch together on
+    the exact new sampling grid.
+
+    Parameters
+    ----------
+    source : ElectricalSeries
+        Raw signals, dimensions (n_timePoints, n_channels)
+    config : dictionary
+        Same as in preprocess_raw_data.
+    halo : float
+        Overlap between chunks (seconds).
+
+    Returns
+    -------
+    data : BlockDataChunkIterator
+        Preprocessed signals in volts, dimensions (n_timePoints, n_channels)
+    rate : float
+        Sampling rate of the preprocessed signals.
+    """
+    nBins, nChannels = source.data.shape
+    polyphase = config.get('Resample', 'polyphase') == 'polyphase'
+    if config['Downsample'] is not None:
+        q, p = rational_ratio(config['Downsample'], source.rate)
+        rate = source.rate * q / p
+    else:
+        p, q = 1, 1
+        rate = source.rate
+
+    # Chunk and halo sizes, in units of p input bins (q output bins).
+    # ~48 bytes per input bin and channel: float64 data, its complex spectrum
+    # and the complex inverse transform
+    h = int(np.ceil(halo * source.rate / p))
+    if polyphase and p != q:
+        # The halo must also cover the anti-aliasing filter
+        h = max(h, polyphase_filter(q, p).size // (2 * q * p) + 1)
+    m = int(config['MaxMemory'] * 2**20 // (48 * nChannels * p)) - 2 * h
+    if m < 1:
+        raise ValueError(
+            'MaxMemory of {} MB is too small for {} channels, use at least '
+            '{} MB.'.format(config['MaxMemory'], nChannels,
+                            int(np.ceil(48 * nChannels * p * (2*h+1) / 2**20))))
+    nOut = int(np.ceil(nBins * q / p))
+    shape = (nOut, nChannels)
+
+    car = config['referencing'] is not None
+    if car and config['referencing'][0] != 'CAR':
+        print('UNRECOGNIZED REFERENCING SCHEME; ', end='')
+        print('SKIPPING REFERENCING!')
+        car = False
+
+    def blocks():
+        start = time.time()
+        nChunks = int(np.ceil(nOut / (m * q)))
+        for k in range(nChunks):
+            # Read chunk with halos, zero-padded at the signal edges
+            a = (k * m - h) * p
+            b = ((k + 1) * m + h) * p
+            X = np.zeros((nChannels, b - a))
+            X[:, max(-a, 0):min(nBins, b) - a] = \
+                source.data[max(a, 0):min(nBins, b), :].T
+            X *= 1e6   # 1e6 scaling helps with numerical accuracy
+
+            if config['Downsample'] is not None:
+                if polyphase:
+                    X = resample_polyphase(X, q, p, axis=-1)
+                else:
+                    X = resample_func(X, (m + 2 * h) * q, axis=-1).real
+            if car:
+                X = subtract_CAR(X, b_size=config['referencing'][1])
+            if config['Notch'] is not None:
+                X = linenoise_notch(X, rate, notch_freq=config['Notch'],
+                                    out=X)
+
+            # Remove halos
+            o0 = k * m * q
+            o1 = min(o0 + m * q, nOut)
+            X = X[:, h * q:h * q + o1 - o0].T / 1e6
+            print('Chunk {}/{} finished ({} seconds)'.format(
+                k + 1, nChunks, time.time() - start))
+            yield np.s_[o0:o1, :], X.astype('float32')
+
+    data = BlockDataChunkIterator(
+        blocks=blocks(), shape=shape, dtype='float32',
+        chunk_shape=row_chunk_shape(shape, 'float32'))
+    return data, rate
+
+
 def get_bipolar_referenced_electrodes(
     X, electrodes, rate, grid_size=None, grid_step=1
 ):
@@ -364,7 +597,8 @@ def get_bipolar_referenced_electrodes(
     return XX, bipolarTable, bipolarTableRegion
 
 
-def spectral_decomposition(block_path, bands_vals):
+def spectral_decomposition(block_path, bands_vals, workers=None,
+                           out_rate=None, max_memory=1024):
     """
     Takes preprocessed LFP data and does the standard Hilbert transform on
     different bands. Takes about 20 minutes to run on 1 10-min block.
@@ -376,6 +610,17 @@ def spectral_decomposition(block_path, bands_vals):
     bands_vals : [2,nBands] numpy array with Gaussian filter parameters, where:
         bands_vals[0,:] = filter centers [Hz]
         bands_vals[1,:] = filter sigmas [Hz]
+    workers : int or None
+        Number of processes filtering blocks of channels in parallel. None
+        runs in the current process.
+    out_rate : float or None
+        Sampling rate (Hz) of the stored amplitudes, e.g. 100. If given, only
+        the frequency support of each band is inverse transformed, directly
+        at this rate. None keeps the LFP rate.
+    max_memory : float
+        Memory budget (MB) of each process. Channels are filtered in blocks
+        as wide as fit in it, besides the batches of bands (see FilterBank),
+        and the output is chunked by blocks of channels of the same width.
 
     Returns
     -------
@@ -395,43 +640,37 @@ def spectral_decomposition(block_path, bands_vals):
         nBands = len(band_param_0)
         nSamples = lfp.data.shape[0]
         nChannels = lfp.data.shape[1]
-        Xp = np.zeros((nBands, nChannels, nSamples))  #power (nBands,nChannels,nSamples)
+        nOut = nSamples
+        if out_rate is not None:
+            nOut = decimated_length(nSamples, lfp.rate, out_rate)
+            rate = lfp.rate * nOut / nSamples
 
         # Apply Hilbert transform ---------------------------------------------
+        # Channel blocks are computed while they are written to the file
         print('Running Spectral Decomposition...')
         start = time.time()
-        for ch in np.arange(nChannels):
-            Xch = lfp.data[:, ch]*1e6       # 1e6 scaling helps with numerical accuracy
-            Xch = Xch.reshape(1, -1)
-            Xch = Xch.astype('float32')     # signal (nChannels,nSamples)
-            X_fft_h = None
-            for ii, (bp0, bp1) in enumerate(zip(band_param_0, band_param_1)):
-                kernel = gaussian(Xch, rate, bp0, bp1)
-                X_analytic, X_fft_h = hilbert_transform(Xch, rate, kernel, phase=None, X_fft_h=X_fft_h)
-                Xp[ii, ch, :] = abs(X_analytic).astype('float32')
-        print('Spectral Decomposition finished in {} seconds'.format(time.time()-start))
 
-        # data: (ndarray) dims: num_times * num_channels * num_bands
-        Xp = np.swapaxes(Xp,0,2)
+        block_size = channel_block_size(
+            lfp.data, _hilbert_bytes(nBands * nOut / nSamples), max_memory)
+
+        def blocks():
+            for (c0, c1), Xp in imap_channel_blocks(
+                    _hilbert_channels, lfp.data,
+                    args=(lfp.rate, band_param_0, band_param_1, out_rate),
+                    workers=workers, block_size=block_size):
+                # power (nChannels,nBands,nOut) to (nOut,nChannels,nBands)
+                yield np.s_[:, c0:c1, :], np.transpose(Xp, (2, 0, 1))
+
+        # data: dims: num_times * num_channels * num_bands
+        shape = (nOut, nChannels, nBands)
+        Xp = BlockDataChunkIterator(
+            blocks=blocks(), shape=shape, dtype='float32',
+            chunk_shape=row_chunk_shape(shape, 'float32',
+                                        n_channels=block_size))
 
         # Spectral band power
         # bands: (DynamicTable) frequency bands that signal was decomposed into
-        band_param_0V = VectorData(
-            name='filter_param_0',
-            description='frequencies for bandpass filters',
-            data=band_param_0
-        )
-        band_param_1V = VectorData(
-            name='filter_param_1',
-            description='frequencies for bandpass filters',
-            data=band_param_1
-        )
-        bandsTable = DynamicTable(
-            name='bands',
-            description='Series of filters used for Hilbert transform.',
-            columns=[band_param_0V, band_param_1V],
-            colnames=['filter_param_0', 'filter_param_1']
-        )
+        bandsTable = _bands_table(band_param_0, band_param_1)
         decs = DecompositionSeries(
             name='DecompositionSeries',
             data=Xp,
@@ -447,10 +686,12 @@ def spectral_decomposition(block_path, bands_vals):
         ecephys_module = nwb.processing['ecephys']
         ecephys_module.add_data_interface(decs)
         io.write(nwb)
+        print('Spectral Decomposition finished in {} seconds'.format(time.time()-start))
         print('Spectral decomposition saved in '+block_path)
 
 
-def high_gamma_estimation(block_path, bands_vals, new_file=''):
+def high_gamma_estimation(block_path, bands_vals, new_file='', workers=None,
+                          out_rate=None, max_memory=1024):
     """
     Takes preprocessed LFP data and calculates High-Gamma power from the
     averaged power of standard Hilbert transform on 70~150 Hz bands.
@@ -466,6 +707,17 @@ def high_gamma_estimation(block_path, bands_vals, new_file=''):
         if this argument is of form 'path/to/new_file.nwb', High Gamma power
         will be saved in a new file. If it is an empty string, '', High Gamma
         power will be saved in the current NWB file.
+    workers : int or None
+        Number of processes filtering blocks of channels in parallel. None
+        runs in the current process.
+    out_rate : float or None
+        Sampling rate (Hz) of the stored amplitudes, e.g. 100. If given, only
+        the frequency support of each band is inverse transformed, directly
+        at this rate. None keeps the LFP rate.
+    max_memory : float
+        Memory budget (MB) of each process. Channels are filtered in blocks
+        as wide as fit in it, besides the batches of bands (see FilterBank),
+        and the output is chunked by blocks of channels of the same width.
 
     Returns
     -------
@@ -483,51 +735,40 @@ def high_gamma_estimation(block_path, bands_vals, new_file=''):
             'LFP'].electrical_series['preprocessed']
         rate = lfp.rate
 
-        nBands = len(band_param_0)
         nSamples = lfp.data.shape[0]
         nChannels = lfp.data.shape[1]
-        Xp = np.zeros((nBands, nChannels, nSamples))  #power (nBands,nChannels,nSamples)
+        nOut = nSamples
+        if out_rate is not None:
+            nOut = decimated_length(nSamples, lfp.rate, out_rate)
+            rate = lfp.rate * nOut / nSamples
 
         # Apply Hilbert transform ---------------------------------------------
+        # Channel blocks are computed while they are written to the file
         print('Running High Gamma estimation...')
         start = time.time()
-        for ch in np.arange(nChannels):
-            Xch = lfp.data[:, ch]*1e6       # 1e6 scaling helps with numerical accuracy
-            Xch = Xch.reshape(1, -1)
-            Xch = Xch.astype('float32')     # signal (nChannels,nSamples)
-            X_fft_h = None
-            for ii, (bp0, bp1) in enumerate(zip(band_param_0, band_param_1)):
-                kernel = gaussian(Xch, rate, bp0, bp1)
-                X_analytic, X_fft_h = hilbert_transform(
-                    Xch, rate, kernel, phase=None, X_fft_h=X_fft_h)
-                Xp[ii, ch, :] = abs(X_analytic).astype('float32')
-        print('High Gamma estimation finished in {} seconds'.format(
-            time.time()-start))
 
-        # data: (ndarray) dims: num_times * num_channels * num_bands
-        Xp = np.swapaxes(Xp, 0, 2)
-        HG = np.mean(Xp, 2)   # average of high gamma bands
+        block_size = channel_block_size(
+            lfp.data, _hilbert_bytes(nOut / nSamples), max_memory)
+
+        def blocks():
+            for (c0, c1), hg_block in imap_channel_blocks(
+                    _high_gamma_channels, lfp.data,
+                    args=(lfp.rate, band_param_0, band_param_1, out_rate),
+                    workers=workers, block_size=block_size):
+                yield np.s_[:, c0:c1], hg_block.T
+
+        # average of high gamma bands, dims: num_times * num_channels
+        shape = (nOut, nChannels)
+        HG = BlockDataChunkIterator(
+            blocks=blocks(), shape=shape, dtype='float32',
+            chunk_shape=row_chunk_shape(shape, 'float32',
+                                        n_channels=block_size))
 
         # Storage of High Gamma on NWB file -----------------------------
         if new_file == '' or new_file is None:  # on current file
             # make electrodes table
-            nElecs = HG.shape[1]
             ecephys_module = nwb.processing['ecephys']
-
-            # first check for a table among the file's data_interfaces
-            ####
-            if lfp.electrodes.table.name in ecephys_module.data_interfaces:
-                LFP_dynamic_table = ecephys_module.data_interfaces[
-                    lfp.electrodes.table.name]
-            else:
-                # othewise use the electrodes as the table
-                LFP_dynamic_table = nwb.electrodes
-            ####
-            elecs_region = LFP_dynamic_table.create_region(
-                name='electrodes',
-                region=[i for i in range(nChannels)],
-                description='all electrodes'
-            )
+            elecs_region = _lfp_electrodes_region(nwb, lfp)
             hg = ElectricalSeries(
                 name='high_gamma',
                 data=HG,
@@ -538,6 +779,8 @@ def high_gamma_estimation(block_path, bands_vals, new_file=''):
 
             ecephys_module.add_data_interface(hg)
             io.write(nwb)
+            print('High Gamma estimation finished in {} seconds'.format(
+                time.time()-start))
             print('High Gamma power saved in '+block_path)
         else:  # on new file
             with NWBHDF5IO(new_file, 'r+', load_namespaces=True) as io_new:
@@ -566,4 +809,223 @@ def high_gamma_estimation(block_path, bands_vals, new_file=''):
 
                 ecephys_module.add_data_interface(hg)
                 io_new.write(nwb_new)
+                print('High Gamma estimation finished in {} seconds'.format(
+                    time.time()-start))
                 print('High Gamma power saved in '+new_file)
+
+
+def spectral_analysis(block_path, outputs, workers=None, out_rate=None,
+                      max_memory=1024):
+    """
+    Computes any combination of spectral decomposition, high gamma and other
+    band group averages in a single pass: the LFP is read once and each
+    channel block gets a single forward FFT. Bands shared by several outputs
+    are filtered only once.
+
+    Parameters
+    ----------
+    block_path : str
+        subject file path
+    outputs : dictionary
+        'decomposition' - (optional) [2,nBands] array with Gaussian filter
+            parameters (centers, sigmas [Hz]) of the DecompositionSeries
+        'high_gamma' - (optional) [2,nBands] array with the Gaussian filter
+            parameters of the bands averaged into 'high_gamma'
+        'band_groups' - (optional) dictionary {name: [2,nBands] array}, the
+            bands of each group are averaged into an ElectricalSeries 'name'
+    workers : int or None
+        Number of processes filtering blocks of channels in parallel. None
+        runs in the current process.
+    out_rate : float or None
+        Sampling rate (Hz) of the stored amplitudes, see
+        spectral_decomposition. None keeps the LFP rate.
+    max_memory : float
+        Memory budget (MB) of each process, see spectral_decomposition.
+
+    Returns
+    -------
+    Saves the outputs in the current NWB file. The datasets are created
+    first and filled in by channel blocks.
+    """
+    # Union of all bands, and indices of the bands of each output
+    groups = []
+    if outputs.get('decomposition') is not None:
+        groups.append(('DecompositionSeries', outputs['decomposition']))
+    if outputs.get('high_gamma') is not None:
+        groups.append(('high_gamma', outputs['high_gamma']))
+    for name, bands_vals in outputs.get('band_groups', {}).items():
+        groups.append((name, bands_vals))
+    bands = {}
+    for _, bands_vals in groups:
+        for band in zip(bands_vals[0, :], bands_vals[1, :]):
+            bands.setdefault((float(band[0]), float(band[1])), len(bands))
+    centers = tuple(b[0] for b in bands)
+    sds = tuple(b[1] for b in bands)
+    indices = [[bands[(float(b0), float(b1))]
+                for b0, b1 in zip(bands_vals[0, :], bands_vals[1, :])]
+               for _, bands_vals in groups]
+    print('Running Spectral Analysis of {} outputs, {} distinct bands...'
+          .format(len(groups), len(bands)))
+    start = time.time()
+
+    # Create the output datasets -----------------------------------------------
+    with NWBHDF5IO(block_path, 'r+', load_namespaces=True) as io:
+        nwb = io.read()
+        ecephys_module = nwb.processing['ecephys']
+        lfp = ecephys_module.data_interfaces['LFP'].electrical_series[
+            'preprocessed']
+        nSamples, nChannels = lfp.data.shape
+        rate = lfp.rate
+        nOut = nSamples
+        if out_rate is not None:
+            nOut = decimated_length(nSamples, lfp.rate, out_rate)
+            rate = lfp.rate * nOut / nSamples
+        full = [name == 'DecompositionSeries' for name, _ in groups]
+        n_out_values = sum(len(idx) if f else 1
+                           for f, idx in zip(full, indices))
+        block_size = channel_block_size(
+            lfp.data, _hilbert_bytes(n_out_values * nOut / nSamples),
+            max_memory)
+
+        for (name, bands_vals), idx in zip(groups, indices):
+            if name == 'DecompositionSeries':
+                shape = (nOut, nChannels, len(idx))
+            else:
+                shape = (nOut, nChannels)
+            # empty iterators only create the datasets
+            data = BlockDataChunkIterator(
+                blocks=[], shape=shape, dtype='float32',
+                chunk_shape=row_chunk_shape(shape, 'float32',
+                                            n_channels=block_size))
+            if name == 'DecompositionSeries':
+                series = DecompositionSeries(
+                    name=name,
+                    data=data,
+                    description=('Analytic amplitude estimated with Hilbert '
+                                 'transform.'),
+                    metric='amplitude',
+                    unit='V',
+                    bands=_bands_table(bands_vals[0, :], bands_vals[1, :]),
+                    rate=rate,
+                    source_timeseries=lfp
+                )
+            else:
+                series = ElectricalSeries(
+                    name=name,
+                    data=data,
+                    electrodes=_lfp_electrodes_region(nwb, lfp),
+                    rate=rate,
+                    description=('Analytic amplitude averaged over bands '
+                                 'centered at {} Hz.'.format(
+                                     np.round(bands_vals[0, :], 1).tolist()))
+                )
+            ecephys_module.add_data_interface(series)
+        io.write(nwb)
+        lfp_path = lfp.data.name
+
+    # Fill them in by channel blocks -------------------------------------------
+    with h5py.File(block_path, 'r+') as f:
+        dsets = [f['processing/ecephys/{}/data'.format(name)]
+                 for name, _ in groups]
+        for (c0, c1), res in imap_channel_blocks(
+                _spectral_analysis_channels, f[lfp_path],
+                args=(lfp.rate, centers, sds, indices,
+                      groups[0][0] == 'DecompositionSeries', out_rate),
+                workers=workers, block_size=block_size):
+            for dset, r in zip(dsets, res):
+                if dset.ndim == 3:
+                    # (nChannels,nBands,nOut) to (nOut,nChannels,nBands)
+                    dset[:, c0:c1, :] = np.transpose(r, (2, 0, 1))
+                else:
+                    dset[:, c0:c1] = r.T
+            print('Channels {}-{} of {} finished ({} seconds)'.format(
+                c0, c1 - 1, nChannels, time.time() - start))
+    print('Spectral Analysis finished in {} seconds'.format(
+        time.time()-start))
+    print('{} saved in {}'.format(', '.join(name for name, _ in groups),
+                                  block_path))
+
+
+def _hilbert_bytes(n_out_values):
+    """
+    Bytes per value of blocks of channels filtered in Gaussian bands, with
+    n_out_values output values per input value: float32 and float64 copies
+    of the block and its spectrum, and float64 and float32 amplitudes.
+    Batches of bands are bounded separately, see FilterBank.
+    """
+    return 20 + 12 * n_out_values
+
+
+def _spectral_analysis_channels(X, rate, centers, sds, indices,
+                                decomposition, out_rate=None):
+    """
+    Analytic amplitudes of a block of channels, dimensions
+    (n_channels, n_timePoints), in the union of bands of several outputs.
+
+    Returns a list with, for each list of band indices, the amplitudes in
+    those bands, dimensions (n_channels, n_bands, n_out), if it is the first
+    one and decomposition is True, or their average over bands, dimensions
+    (n_channels, n_out), otherwise.
+    """
+    X = X*1e6       # 1e6 scaling helps with numerical accuracy
+    X = X.astype('float32')
+    bank = gaussian_filter_bank(X.shape[1], rate, centers, sds)
+    full = [ii == 0 and decomposition for ii in range(len(indices))]
+    out = None
+    for bands, A in bank.amplitude_batches(X, out_rate=out_rate):
+        if out is None:
+            out = [np.zeros((X.shape[0], len(idx), A.shape[-1]))
+                   if full[ii] else np.zeros((X.shape[0], A.shape[-1]))
+                   for ii, idx in enumerate(indices)]
+        for ii, idx in enumerate(indices):
+            for jj, band in enumerate(idx):
+                if bands.start <= band < bands.stop:
+                    if full[ii]:
+                        out[ii][:, jj] = A[band - bands.start]
+                    else:
+                        out[ii] += A[band - bands.start]
+    return [(o if full[ii] else o / len(idx)).astype('float32')
+            for ii, (o, idx) in enumerate(zip(out, indices))]
+
+
+def _bands_table(band_param_0, band_param_1):
+    """
+    DynamicTable with the Gaussian filter parameters of a decomposition.
+    """
+    band_param_0V = VectorData(
+        name='filter_param_0',
+        description='frequencies for bandpass filters',
+        data=band_param_0
+    )
+    band_param_1V = VectorData(
+        name='filter_param_1',
+        description='frequencies for bandpass filters',
+        data=band_param_1
+    )
+    return DynamicTable(
+        name='bands',
+        description='Series of filters used for Hilbert transform.',
+        columns=[band_param_0V, band_param_1V],
+        colnames=['filter_param_0', 'filter_param_1']
+    )
+
+
+def _lfp_electrodes_region(nwb, lfp):
+    """
+    Region with all electrodes of the LFP, in the table of its electrodes
+    (e.g. bipolar-referenced metadata) if it is in the ecephys module, or in
+    the file's electrodes table otherwise.
+    """
+    ecephys_module = nwb.processing['ecephys']
+    # first check for a table among the file's data_interfaces
+    if lfp.electrodes.table.name in ecephys_module.data_interfaces:
+        LFP_dynamic_table = ecephys_module.data_interfaces[
+            lfp.electrodes.table.name]
+    else:
+        # othewise use the electrodes as the table
+        LFP_dynamic_table = nwb.electrodes
+    return LFP_dynamic_table.create_region(
+        name='electrodes',
+        region=[i for i in range(lfp.data.shape[1])],
+        description='all electrodes'
+    )
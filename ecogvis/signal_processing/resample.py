@@ -1,11 +1,181 @@
 from __future__ import division
+from fractions import Fraction
+from functools import lru_cache
+
 import numpy as np
 import scipy as sp
+import scipy.signal as sgn
 from .resample_clone import resample as resample_func
 
 __authors__ = "Alex Bujan"
 
-__all__ = ['resample']
+__all__ = ['resample',
+           'rational_ratio',
+           'polyphase_filter',
+           'resample_polyphase',
+           'PolyphaseResampler']
+
+
+def rational_ratio(new_freq, old_freq, max_denominator=10000):
+    """
+    Rational approximation up/down of new_freq/old_freq, with
+    up <= max_denominator. E.g. 3051.7578125 -> 400 Hz is exactly 2048/15625.
+
+    Returns
+    -------
+    up : int
+        Upsampling factor.
+    down : int
+        Downsampling factor.
+    """
+    ratio = Fraction(float(old_freq) / new_freq).limit_denominator(
+        max_denominator)
+    return ratio.denominator, ratio.numerator
+
+
+@lru_cache(maxsize=8)
+def polyphase_filter(up, down, atten=60., transition=.2):
+    """
+    Kaiser-window anti-aliasing FIR filter for polyphase resampling by
+    up/down.
+
+    The passband extends to (1 - transition) times the new Nyquist frequency
+    and the stopband starts at the new Nyquist frequency, where the
+    attenuation is at least `atten` dB. This bounds both the passband ripple
+    and the aliased energy to about 10**(-atten/20).
+
+    Parameters
+    ----------
+    up : int
+        Upsampling factor.
+    down : int
+        Downsampling factor.
+    atten : float
+        Stopband attenuation (dB).
+    transition : float
+        Transition band width, as a fraction of the new Nyquist frequency.
+
+    Returns
+    -------
+    h : array
+        Filter taps, with unit gain at DC.
+    """
+    nyq = 1. / max(up, down)
+    n_taps, beta = sgn.kaiserord(atten, transition * nyq)
+    h = sgn.firwin(n_taps | 1, (1. - transition / 2.) * nyq,
+                   window=('kaiser', beta))
+    h.flags.writeable = False
+    return h
+
+
+def resample_polyphase(X, up, down, axis=-1, atten=60., transition=.2):
+    """
+    Polyphase FIR resampling of X by the rational factor up/down.
+
+    Output sample n lies at input time n*down/up, so resampling consecutive
+    blocks that start at multiples of `down` input samples, with at least
+    polyphase_filter(up, down).size // (2*up) extra samples on each side,
+    and trimming the extra output samples, gives the same result as
+    resampling the whole signal. Works on any number of dimensions.
+
+    Parameters
+    ----------
+    X : array
+        Input data, dimensions (n_channels, ..., n_timePoints)
+    up : int
+        Upsampling factor.
+    down : int
+        Downsampling factor.
+    axis : int (optional)
+        Axis along which to resample the data
+    atten : float
+        Stopband attenuation (dB) of the anti-aliasing filter.
+    transition : float
+        Transition band width, as a fraction of the new Nyquist frequency.
+
+    Returns
+    -------
+    Xds : array
+        Resampled data, with ceil(n_timePoints*up/down) time points.
+    """
+    if up == down:
+        return np.array(X, dtype='float64')
+    h = polyphase_filter(up, down, atten, transition)
+    return sgn.resample_poly(X, up, down, axis=axis, window=h)
+
+
+class PolyphaseResampler:
+    """
+    Polyphase resampling of a signal streamed in chunks of any length, with
+    the same result as resample_polyphase on the whole signal.
+
+    Samples are resampled in blocks that start at multiples of `down` input
+    samples, with halos covering the filter (see resample_polyphase), so
+    outputs are returned as soon as the input samples they depend on have
+    been received.
+
+    Parameters
+    ----------
+    up : int
+        Upsampling factor.
+    down : int
+        Downsampling factor.
+    atten : float
+        Stopband attenuation (dB) of the anti-aliasing filter.
+    transition : float
+        Transition band width, as a fraction of the new Nyquist frequency.
+    """
+    def __init__(self, up, down, atten=60., transition=.2):
+        self.up = up
+        self.down = down
+        self.atten = atten
+        self.transition = transition
+        if up == down:
+            self.halo = 0
+        else:
+            h = polyphase_filter(up, down, atten, transition)
+            self.halo = (h.size // (2 * up * down) + 1) * down
+        self.n_in = 0
+        self.n_out = 0
+        # Input samples from (n_out * down / up - halo), zero padded before
+        # the start of the signal
+        self._buffer = np.zeros(self.halo)
+
+    def update(self, x):
+        """
+        Adds a chunk of the signal and returns the new output samples.
+        """
+        self._buffer = np.concatenate((self._buffer, x))
+        self.n_in += len(x)
+        start = self.n_out * self.down // self.up
+        stop = (self.n_in - self.halo) // self.down * self.down
+        return self._resample(start, stop)
+
+    def flush(self):
+        """
+        Returns the last output samples, at the end of the signal.
+        """
+        start = self.n_out * self.down // self.up
+        stop = -(-self.n_in // self.down) * self.down
+        self._buffer = np.concatenate(
+            (self._buffer, np.zeros(stop + self.halo - self.n_in)))
+        n_total = -(-self.n_in * self.up // self.down)
+        n_left = n_total - self.n_out
+        y = self._resample(start, stop)[:n_left]
+        self.n_out = n_total
+        return y
+
+    def _resample(self, start, stop):
+        if stop <= start:
+            return np.zeros(0)
+        block = self._buffer[:stop - start + 2 * self.halo]
+        Y = resample_polyphase(block, self.up, self.down,
+                               atten=self.atten, transition=self.transition)
+        h_out = self.halo * self.up // self.down
+        n = (stop - start) * self.up // self.down
+        self._buffer = self._buffer[stop - start:]
+        self.n_out += n
+        return Y[h_out:h_out + n]
 
 
 def resample(X, new_freq, old_freq, kind=1, axis=-1, same_sign=False):
@@ -21,6 +191,11 @@ def resample(X, new_freq, old_freq, kind=1, axis=-1, same_sign=False):
         New sampling frequency
     old_freq : float
         Original sampling frequency
+    kind : int or str (optional)
+        0: median filter and linear interpolation. 1: FFT resampling of the
+        whole signal. 'polyphase': polyphase FIR filtering with the rational
+        approximation of new_freq/old_freq (see resample_polyphase), which
+        needs no power of 2 padding.
     axis : int (optional)
         Axis along which to resample the data
 
@@ -29,6 +204,10 @@ def resample(X, new_freq, old_freq, kind=1, axis=-1, same_sign=False):
     Xds : array
         Downsampled data, dimensions (n_channels, ..., n_timePoints_new)
     """
+    if kind == 'polyphase':
+        up, down = rational_ratio(new_freq, old_freq)
+        return resample_polyphase(X, up, down, axis=axis)
+
     ratio = float(old_freq) / new_freq
     if np.allclose(ratio, int(ratio)) and same_sign:
         ratio = int(ratio)
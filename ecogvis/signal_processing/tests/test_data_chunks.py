@@ -0,0 +1,24 @@
+import numpy as np
+
+from ecogvis.signal_processing.data_chunks import (BlockDataChunkIterator,
+                                                   row_chunk_shape)
+
+
+def test_row_chunk_shape():
+    assert row_chunk_shape((10**6, 256), 'float32') == (1024, 256)
+    assert row_chunk_shape((100, 256), 'float32') == (100, 256)
+    assert row_chunk_shape((10**6, 256, 40), 'float32',
+                           n_channels=4) == (1638, 4, 40)
+
+
+def test_block_data_chunk_iterator():
+    X = np.random.randn(100, 6)
+    blocks = ((np.s_[:, c:c + 2], X[:, c:c + 2]) for c in range(0, 6, 2))
+    it = BlockDataChunkIterator(blocks, X.shape, 'float32')
+    assert it.recommended_data_shape() == X.shape
+    assert it.maxshape == X.shape
+    out = np.zeros(X.shape, dtype='float32')
+    for chunk in it:
+        assert chunk.data.dtype == np.float32
+        out[chunk.selection] = chunk.data
+    assert np.allclose(out, X)
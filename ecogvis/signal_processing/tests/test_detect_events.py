@@ -0,0 +1,144 @@
+import numpy as np
+import scipy.signal as sgn
+
+from ecogvis.signal_processing.detect_events import (SMOOTHERS,
+                                                      ThreshcrossStream,
+                                                      detect_events,
+                                                      detect_events_streaming,
+                                                      event_times,
+                                                      smooth_envelope,
+                                                      threshcross)
+
+
+class Series:
+    def __init__(self, data, rate):
+        self.data = data
+        self.rate = rate
+
+
+class ReadLog:
+    """Array that records the end of each slice read."""
+    def __init__(self, data):
+        self.data = data
+        self.shape = data.shape
+        self.stops = []
+
+    def __getitem__(self, sl):
+        self.stops.append(sl.stop)
+        return self.data[sl]
+
+
+def test_threshcross():
+    data = np.array([0, 1, 1, 0, 0, 1, 0, 1, 1])
+    assert np.array_equal(threshcross(data, .5, 'up'), [1, 5, 7])
+    assert np.array_equal(threshcross(data, .5, 'down'), [3, 6])
+    # The last up cross has no down cross
+    assert np.array_equal(threshcross(data, .5, 'both'), [1, 3, 5, 6])
+    # Starting above threshold, the first down cross has no up cross
+    assert np.array_equal(threshcross(data[2:], .5, 'both'), [3, 4])
+    assert threshcross(np.zeros(10), .5, 'both').shape == (0,)
+
+
+def test_threshcross_both_random():
+    data = np.random.rand(10000)
+    out = threshcross(data, .5, 'both').reshape(-1, 2)
+    assert np.all(data[out[:, 0]] >= .5)
+    assert np.all(data[out[:, 0] - 1] < .5)
+    assert np.all(data[out[:, 1]] < .5)
+    assert np.all(out[:, 1] > out[:, 0])
+    assert np.all(out[1:, 0] > out[:-1, 1])
+
+
+def test_event_times():
+    filt = np.zeros(1000)
+    filt[100:300] = 1.
+    filt[500:505] = 1.
+    times = event_times(filt, .5, 'both', ds=100., fs=1000.,
+                        interval=[2000, 12000])
+    assert np.allclose(times, [1. + 2., 3. + 2.])
+    assert np.allclose(event_times(filt, .5, 'both', 100., 1000.), [1., 3.])
+
+
+def test_detect_events_whole_signal():
+    """
+    interval=None uses the whole signal.
+    """
+    fs = 3000.
+    t = np.arange(int(10 * fs)) / fs
+    speaker = Series(np.sin(2 * np.pi * 440 * t) * ((t > 2) & (t < 4)), fs)
+    whole = detect_events(speaker, dfact=100)
+    full = detect_events(speaker, interval=[0, len(t)], dfact=100)
+    assert len(whole[1]) > 0
+    assert np.array_equal(whole[1], full[1])
+
+
+def test_smooth_envelope():
+    X = np.random.rand(5000) ** 4
+    Y = sgn.medfilt(X, 101)
+    assert np.array_equal(smooth_envelope(X, 101.5, 'medfilt'), Y)
+    assert np.array_equal(smooth_envelope(X, 101.5, 'median'), Y)
+    box = np.convolve(X, np.ones(101) / 101, mode='same')
+    assert np.allclose(smooth_envelope(X, 101, 'boxcar'), box)
+    assert np.allclose(smooth_envelope(X, 101, 'rms'), np.sqrt(box))
+    for kind in SMOOTHERS:
+        assert smooth_envelope(X, 100, kind).shape == X.shape
+
+
+def test_threshcross_stream():
+    data = np.random.rand(10000)
+    for direction in ['up', 'down', 'both']:
+        stream = ThreshcrossStream(.5, direction)
+        out = [stream.update(data[a:a + 333]) for a in range(0, 10000, 333)]
+        out = np.concatenate(out + [stream.flush()])
+        assert np.array_equal(out, threshcross(data, .5, direction))
+
+
+def test_detect_events_streaming():
+    """
+    Same events as detect_events, yielded as they are found, with known
+    or unknown scales.
+    """
+    fs = 3000.
+    t = np.arange(int(30 * fs)) / fs
+    rng = np.random.RandomState(0)
+    speaker = Series(np.sin(2 * np.pi * 50 * t) * ((t % 3) < 1) +
+                     .01 * rng.randn(len(t)), fs)
+    mic = Series(np.sin(2 * np.pi * 70 * t) * (((t + 1.5) % 3) < .8) +
+                 .01 * rng.randn(len(t)), fs)
+    batch = detect_events(speaker, mic, interval=[100, len(t) - 100],
+                          dfact=10)
+    out = list(detect_events_streaming(speaker, mic,
+                                       interval=[100, len(t) - 100],
+                                       dfact=10, chunk_len=5000))
+    assert len(out) > 1
+    assert np.array_equal(np.concatenate([o[0] for o in out]), batch[1])
+    assert np.array_equal(np.concatenate([o[1] for o in out]), batch[4])
+
+    # Scale of the smoothed speaker signal, before normalization
+    speaker_scale = np.max(np.abs(smooth_envelope(
+        np.diff(np.append(batch[0], batch[0][-1])) ** 2, .4 * 300)))
+    out = list(detect_events_streaming(speaker, interval=[100, len(t) - 100],
+                                       dfact=10, chunk_len=5000,
+                                       speaker_scale=speaker_scale))
+    assert len(out) > 1
+    assert np.array_equal(np.concatenate([o[0] for o in out]), batch[1])
+
+
+def test_detect_events_streaming_early():
+    """
+    Events are yielded before the signal is read to the end: in the first
+    pass with a known scale, and in the last one otherwise.
+    """
+    fs = 3000.
+    t = np.arange(int(30 * fs)) / fs
+    x = np.sin(2 * np.pi * 50 * t) * ((t % 3) < 1) + .01 * np.random.randn(
+        len(t))
+    for speaker_scale, n_passes in [(None, 2), (1., 1)]:
+        data = ReadLog(x)
+        events = detect_events_streaming(Series(data, fs), dfact=10,
+                                         chunk_len=5000,
+                                         speaker_scale=speaker_scale)
+        speaker_times, _ = next(events)
+        assert len(speaker_times) > 0
+        assert data.stops.count(len(t)) == n_passes - 1
+        assert data.stops[-1] < len(t)
@@ -0,0 +1,66 @@
+import h5py
+import numpy as np
+
+from ecogvis.signal_processing.erp import epoch_blocks, erp
+
+
+def test_epoch_blocks():
+    starts = np.array([500, 0, 120, 1000])
+    blocks = epoch_blocks(starts, 100, 1050)
+    assert [(b0, b1) for b0, b1, _ in blocks] == [(0, 220), (500, 600),
+                                                  (1000, 1050)]
+    assert [list(trials) for _, _, trials in blocks] == [[1, 2], [0], [3]]
+    # Blocks are split at max_rows
+    blocks = epoch_blocks(starts, 100, 1050, max_rows=150)
+    assert len(blocks) == 4
+
+
+def epochs(X, starts, n_bins, channels=None):
+    """Windows of each trial, dimensions (n_trials, n_channels, n_bins),
+    with NaN out of the signals."""
+    if channels is None:
+        channels = np.arange(X.shape[1])
+    Y = np.full((len(starts), len(channels), n_bins), np.nan)
+    for tr, start in enumerate(starts):
+        b0, b1 = max(start, 0), min(start + n_bins, X.shape[0])
+        Y[tr, :, b0 - start:b1 - start] = X[b0:b1, channels].T
+    return Y
+
+
+def test_erp_file(tmp_path):
+    rate = 100.
+    X = np.random.randn(10000, 8).astype('float32')
+    fname = str(tmp_path / 'data.h5')
+    with h5py.File(fname, 'w') as f:
+        f.create_dataset('data', data=X)
+    ref_times = np.array([5., 20.5, 42., 70.3])
+    Y = np.stack([X[int(t * rate) - 100:int(t * rate) + 100].T
+                  for t in ref_times]).astype('float64')
+    for max_bytes in [64 * 2**20, 2000 * 8 * 8]:
+        with h5py.File(fname, 'r') as f:
+            Y_mean, Y_sem, T = erp(f['data'], ref_times, rate, 2.,
+                                   max_bytes=max_bytes)
+        assert np.allclose(Y_mean, Y.mean(0))
+        assert np.allclose(Y_sem, Y.std(0) / 2)
+        assert np.allclose(T, np.arange(200) / rate)
+
+
+def test_erp_edges():
+    """
+    Same as the mean and standard error of the epochs, with windows out of
+    the signals and signals far from zero.
+    """
+    X = np.random.randn(5000, 12) * 1e-5 + 3e-4
+    X0 = X.copy()
+    ref_times = np.array([0.1, 49.9, 30., 30.01, 12.])
+    for channels in [None, [7, 0, 3], [4, 5, 6]]:
+        # Blocks of ~700 time bins
+        Y_mean, Y_sem, _ = erp(X, ref_times, 100., 1., channels=channels,
+                               max_bytes=700 * 8 * 12)
+        Y = epochs(X, (ref_times * 100).astype('int') - 50, 100, channels)
+        assert np.allclose(Y_mean, np.nanmean(Y, 0), rtol=1e-9, atol=0)
+        assert np.allclose(Y_sem, np.nanstd(Y, 0) / np.sqrt(5), rtol=1e-6,
+                           atol=0)
+    # The signals are not modified
+    assert np.array_equal(X, X0)
+    assert erp(X, ref_times, 100., 1., stopped=lambda: True) is None
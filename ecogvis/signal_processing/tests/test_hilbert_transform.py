@@ -1,7 +1,8 @@
 import numpy as np
+import pytest
 
-from ecog.signal_processing import (hilbert_transform,
-        gaussian, hamming)
+from ecogvis.signal_processing.hilbert_transform import (hilbert_transform,
+        gaussian, hamming, FilterBank, gaussian_filter_bank, decimated_length)
 
 def test_hilbert_return():
     """
@@ -11,10 +12,87 @@ def test_hilbert_return():
     rate = 200
     filters = [gaussian(X, rate, 100, 5),
                hamming(X, rate, 60, 70)]
-    Xh = hilbert_transform(X, rate, filters)
+    Xh, _ = hilbert_transform(X, rate, filters)
     assert Xh.shape == (len(filters), X.shape[0], X.shape[1])
-    assert Xh.dtype == np.complex
+    assert Xh.dtype == complex
 
-    Xh = hilbert_transform(X, rate)
+    Xh, _ = hilbert_transform(X, rate)
     assert Xh.shape == X.shape
-    assert Xh.dtype == np.complex
+    assert Xh.dtype == complex
+
+
+def test_filter_bank():
+    """
+    The filter bank matches hilbert_transform, for any memory cap.
+    """
+    X = np.random.randn(8, 1000)
+    rate = 200
+    filters = [gaussian(X, rate, 10, 2),
+               gaussian(X, rate, 40, 5),
+               hamming(X, rate, 60, 70)]
+    Xh, _ = hilbert_transform(X, rate, filters)
+    for max_memory in [.01, 512]:
+        bank = FilterBank(X.shape[1], rate, filters, max_memory=max_memory)
+        assert np.allclose(bank.transform(X), Xh)
+        assert np.allclose(bank.amplitude(X), np.abs(Xh))
+    assert bank.batch_size(X.shape[0]) == 3
+    assert FilterBank(X.shape[1], rate, filters, .01).batch_size(8) == 1
+
+
+def test_gaussian_filter_bank():
+    X = np.random.randn(4, 1000)
+    rate = 200
+    bank = gaussian_filter_bank(1000, rate, (10., 40.), (2., 5.))
+    assert bank is gaussian_filter_bank(1000, rate, (10., 40.), (2., 5.))
+    out = np.zeros((4, 2, 1000))
+    bank.amplitude(X, out=out.transpose(1, 0, 2))
+    for ii, (c, sd) in enumerate([(10., 2.), (40., 5.)]):
+        Xh, _ = hilbert_transform(X, rate, gaussian(X, rate, c, sd))
+        assert np.allclose(out[:, ii], np.abs(Xh))
+
+
+def test_decimated_amplitude():
+    """
+    Decimated amplitudes are the full rate amplitudes at the output times.
+    """
+    X = np.random.randn(4, 4000)
+    rate = 400.
+    bank = gaussian_filter_bank(4000, rate, (20., 110.), (3., 6.))
+    A = bank.amplitude(X)
+    D = bank.decimated_amplitude(X, 100.)
+    assert D.shape == (2, 4, decimated_length(4000, rate, 100.))
+    assert np.allclose(D, A[:, :, ::4], atol=1e-3 * A.max())
+
+
+def test_decimated_amplitude_rate_too_low():
+    X = np.random.randn(1, 4000)
+    bank = gaussian_filter_bank(4000, 400., (110.,), (6.,))
+    with pytest.raises(ValueError):
+        bank.decimated_amplitude(X, 10.)
+
+
+def test_mean_amplitude():
+    X = np.random.randn(4, 4000)
+    rate = 400.
+    bank = FilterBank(4000, rate, [gaussian(X, rate, c, 5.)
+                                   for c in (80., 100., 120.)], max_memory=.2)
+    assert np.allclose(bank.mean_amplitude(X), bank.amplitude(X).mean(0))
+    assert np.allclose(bank.mean_amplitude(X, out_rate=100.),
+                       bank.decimated_amplitude(X, 100.).mean(0))
+
+
+def test_filter_bank_support():
+    """
+    Only the support of the filters is stored, and counted in the memory cap.
+    """
+    n_time, rate = 60000, 3000.
+    X = np.random.randn(2, n_time)
+    filters = [gaussian(X, rate, 100., 5.), hamming(X, rate, 60, 70)]
+    bank = FilterBank(n_time, rate, filters)
+    assert bank.nbytes < 2 * 8 * n_time
+    Xh, _ = hilbert_transform(X, rate, filters)
+    assert np.allclose(bank.transform(X), Xh)
+    assert np.allclose(bank.decimated_amplitude(X, 300.),
+                       np.abs(Xh[:, :, ::10]), atol=1e-3 * np.abs(Xh).max())
+    assert FilterBank(n_time, rate, filters,
+                      max_memory=bank.nbytes / 2**20).batch_size(1) == 1
@@ -1,6 +1,7 @@
 import numpy as np
 
-from ecog.signal_processing import linenoise_notch
+from ecogvis.signal_processing.linenoise_notch import (linenoise_notch,
+                                                       notch_gain)
 
 def test_linenoise_notch_return():
     """
@@ -10,3 +11,44 @@ def test_linenoise_notch_return():
     rate = 200
     Xh = linenoise_notch(X, rate)
     assert Xh.shape == X.shape
+
+
+def test_linenoise_notch_odd_length():
+    X = np.random.randn(4, 1001)
+    Xh = linenoise_notch(X, 200)
+    assert Xh.shape == X.shape
+
+
+def test_linenoise_notch_padded():
+    """
+    Padding with n_fft is the same as zero padding the signal.
+    """
+    X = np.random.randn(4, 3000)
+    Xp = np.concatenate((X, np.zeros((4, 1096))), axis=1)
+    Xh = linenoise_notch(X, 400., n_fft=4096)
+    assert Xh.shape == X.shape
+    assert np.allclose(Xh, linenoise_notch(Xp, 400.)[:, :3000])
+
+
+def test_linenoise_notch_out():
+    X = np.random.randn(4, 1000)
+    out = np.zeros_like(X)
+    Xh = linenoise_notch(X, 400., out=out)
+    assert Xh is out
+    assert np.allclose(out, linenoise_notch(X, 400.))
+
+
+def test_linenoise_notch_removes_line():
+    rate = 400.
+    t = np.arange(4000) / rate
+    X = np.sin(2 * np.pi * 60 * t).reshape(1, -1)
+    Xh = linenoise_notch(X, rate)
+    assert np.abs(Xh).max() < 1e-6
+
+
+def test_notch_gain_cached():
+    g = notch_gain(1000, 400., (60., 120., 180.))
+    assert g is notch_gain(1000, 400., (60., 120., 180.))
+    assert g.shape == (501,)
+    assert g[150] == 0.
+    assert g[0] == 1.
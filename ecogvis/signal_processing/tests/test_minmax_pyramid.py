@@ -0,0 +1,107 @@
+import itertools
+
+import h5py
+import numpy as np
+
+from ecogvis.signal_processing.minmax_pyramid import (build_minmax_pyramid,
+                                                      open_minmax_pyramid)
+
+
+def test_minmax_pyramid(tmp_path):
+    """
+    Bins of every level, built in chunks, have the extrema and moments of
+    their samples, including the incomplete last bin.
+    """
+    X = np.random.randn(100003, 5) * 10 + 1000.
+    X[54321, 2] = 1e4  # a spike
+    path = str(tmp_path / 'lod.h5')
+    pyramid = build_minmax_pyramid(X, path, '/source/data', max_bins=100,
+                                   chunk_len=5000)
+    assert len(pyramid.levels) == 5
+    for k, level in enumerate(pyramid.levels, 1):
+        width = 4**k
+        stats = level[:]
+        assert stats.shape == (-(-X.shape[0] // width), 5, 4)
+        for b in [0, 13, stats.shape[0] - 1]:
+            Xb = X[b * width:(b + 1) * width]
+            # Stored relative to the offset of each channel
+            assert np.allclose(stats[b, :, 0] + pyramid.offset,
+                               Xb.min(axis=0))
+            assert np.allclose(stats[b, :, 1] + pyramid.offset,
+                               Xb.max(axis=0))
+            assert np.allclose(stats[b, :, 2] + len(Xb) * pyramid.offset,
+                               Xb.sum(axis=0), rtol=1e-4)
+    pyramid.close()
+
+    pyramid = open_minmax_pyramid(path, X, '/source/data')
+    assert pyramid is not None
+    assert open_minmax_pyramid(path, X[:-1], '/source/data') is None
+    assert open_minmax_pyramid(path, X, '/other') is None
+
+    # Whole recording, at most 1000 bins, the spike is kept
+    samples, Y_min, Y_max, means, stds = pyramid.read(0, X.shape[0],
+                                                      [1, 2, 4])
+    assert len(samples) <= 1000 and Y_max.shape == (3, len(samples))
+    assert np.isclose(Y_max[1].max(), 1e4)
+    assert np.allclose(means, X[:, [1, 2, 4]].mean(axis=0))
+    assert np.allclose(stds, X[:, [1, 2, 4]].std(axis=0), rtol=1e-3)
+    # Short windows are plotted from the samples
+    assert pyramid.read(100, 900, [0]) is None
+    pyramid.close()
+
+
+def test_minmax_pyramid_h5_source(tmp_path):
+    X = np.random.randn(20000, 3).astype('float32')
+    with h5py.File(tmp_path / 'data.h5', 'w') as f:
+        src = f.create_dataset('data', data=X)
+        pyramid = build_minmax_pyramid(src, str(tmp_path / 'lod.h5'), 'data')
+    samples, Y_min, Y_max, _, _ = pyramid.read(1000, 19000, [0, 1, 2], 500)
+    k = pyramid.level_for(18000, 500)
+    assert np.allclose(Y_min[:, 0], X[(1000 // 4**k) * 4**k:
+                                      (1000 // 4**k + 1) * 4**k].min(axis=0))
+    assert samples[0] < 1000 < samples[-1] < 19000 + 4**k
+    pyramid.close()
+
+
+def test_minmax_pyramid_source_identity(tmp_path):
+    """
+    Pyramids of rewritten or interrupted sources are not opened.
+    """
+    X = np.random.randn(20000, 3).astype('float32')
+    path = str(tmp_path / 'lod.h5')
+    with h5py.File(tmp_path / 'data.h5', 'w') as f:
+        src = f.create_dataset('data', data=X)
+        build_minmax_pyramid(src, path, 'data').close()
+        pyramid = open_minmax_pyramid(path, src, 'data')
+        assert pyramid is not None
+        pyramid.close()
+        # Same shape, other signals
+        Y = X.copy()
+        Y[-1, 0] += 1
+        assert open_minmax_pyramid(path, Y, 'data') is None
+        # Same signals, written again
+        del f['data']
+        src = f.create_dataset('data', data=X)
+        assert open_minmax_pyramid(path, src, 'data') is None
+
+    # Builds stopped after 3 chunks are removed
+    chunks = itertools.count()
+    assert build_minmax_pyramid(X, path, 'data', chunk_len=1000,
+                                stopped=lambda: next(chunks) == 3) is None
+    assert open_minmax_pyramid(path, X, 'data') is None
+    with h5py.File(path, 'r') as f:
+        assert 'data' not in f
+
+
+def test_minmax_pyramid_read_channels(tmp_path):
+    """
+    Unordered and negative channels, read by runs of consecutive channels.
+    """
+    X = np.random.randn(50000, 40)
+    pyramid = build_minmax_pyramid(X, str(tmp_path / 'lod.h5'), 'data')
+    channels = np.array([-1, 0, 1, 2, 20, 2])
+    samples, Y_min, Y_max, means, _ = pyramid.read(0, X.shape[0], channels)
+    assert np.allclose(Y_min.min(axis=1), X[:, channels].min(axis=0))
+    assert np.allclose(Y_max.max(axis=1), X[:, channels].max(axis=0))
+    assert np.allclose(means, X[:, channels].mean(axis=0))
+    pyramid.close()
@@ -0,0 +1,84 @@
+import h5py
+import numpy as np
+
+from ecogvis.signal_processing.linenoise_notch import linenoise_notch
+from ecogvis.signal_processing.parallel import (channel_block_size,
+                                                channel_blocks,
+                                                imap_channel_blocks,
+                                                map_channel_blocks)
+
+
+def test_channel_blocks():
+    assert channel_blocks(10, 4) == [(0, 4), (4, 8), (8, 10)]
+
+
+def test_channel_block_size(tmp_path):
+    X = np.zeros((2**17, 64), dtype='float32')
+    # 1 MB per channel at 8 bytes per value
+    assert channel_block_size(X, 8, 10) == 10
+    assert channel_block_size(X, 8, .1) == 1
+    assert channel_block_size(X, 8, 1e4) == 64
+    fname = str(tmp_path / 'data.h5')
+    with h5py.File(fname, 'w') as f:
+        f.create_dataset('data', data=X, chunks=(1024, 4))
+        assert channel_block_size(f['data'], 8, 10) == 8
+        assert channel_block_size(f['data'], 8, 3) == 3
+
+
+def test_map_channel_blocks_array():
+    """
+    Serial and parallel results are identical.
+    """
+    X = np.random.randn(1000, 10)
+    rate = 400.
+    Xs = map_channel_blocks(linenoise_notch, X, (10, 1000), args=(rate,),
+                            block_size=3)
+    Xp = map_channel_blocks(linenoise_notch, X, (10, 1000), args=(rate,),
+                            workers=2, block_size=3)
+    assert np.array_equal(Xs, Xp)
+    assert np.allclose(Xs, linenoise_notch(X.T, rate))
+
+
+def test_map_channel_blocks_file(tmp_path):
+    X = np.random.randn(1000, 10).astype('float32')
+    fname = str(tmp_path / 'data.h5')
+    with h5py.File(fname, 'w') as f:
+        f.create_dataset('data', data=X)
+    with h5py.File(fname, 'r') as f:
+        Xs = map_channel_blocks(linenoise_notch, f['data'], (10, 1000),
+                                args=(400.,))
+        Xp = map_channel_blocks(linenoise_notch, f['data'], (10, 1000),
+                                args=(400.,), workers=3)
+    assert np.array_equal(Xs, Xp)
+
+
+def test_imap_channel_blocks():
+    X = np.random.randn(1000, 10)
+    for workers in [None, 2]:
+        blocks = list(imap_channel_blocks(linenoise_notch, X, args=(400.,),
+                                          workers=workers, block_size=4))
+        assert [b for b, _ in blocks] == [(0, 4), (4, 8), (8, 10)]
+        Xh = np.concatenate([res for _, res in blocks])
+        assert np.allclose(Xh, linenoise_notch(X.T, 400.))
+
+
+def test_channel_blocks_file_open_for_writing(tmp_path):
+    """
+    Results can be written to the file of the source while workers compute.
+    """
+    X = np.random.randn(1000, 10).astype('float32')
+    fname = str(tmp_path / 'data.h5')
+    with h5py.File(fname, 'w') as f:
+        f.create_dataset('data', data=X)
+    with h5py.File(fname, 'r+') as f:
+        out = f.create_dataset('out', shape=(1000, 10), dtype='float64')
+        for block, res in imap_channel_blocks(linenoise_notch, f['data'],
+                                              args=(400.,), workers=2,
+                                              block_size=3):
+            out[:, block[0]:block[1]] = res.T
+        Xp = map_channel_blocks(linenoise_notch, f['data'], (10, 1000),
+                                args=(400.,), workers=2, block_size=3)
+        Xs = map_channel_blocks(linenoise_notch, f['data'], (10, 1000),
+                                args=(400.,), block_size=3)
+        assert np.array_equal(out[:], Xs.T)
+    assert np.array_equal(Xp, Xs)
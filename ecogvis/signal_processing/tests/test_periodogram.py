@@ -0,0 +1,78 @@
+import numpy as np
+from scipy import signal as sgn
+
+from ecogvis.signal_processing.periodogram import WelchAccumulator, _psd_blocks
+
+
+def test_welch_accumulator():
+    """
+    Streaming in chunks of any length gives scipy's Welch estimate.
+    """
+    rate = 400.
+    X = np.random.randn(10000, 3)
+    fx, py = sgn.welch(X, fs=rate, nperseg=512, axis=0)
+    for chunk_len in [100, 512, 3333, 10000]:
+        acc = WelchAccumulator(rate, 3, 512)
+        for t0 in range(0, X.shape[0], chunk_len):
+            acc.update(X[t0:t0 + chunk_len])
+        assert np.allclose(acc.frequencies, fx)
+        assert np.allclose(acc.power, py)
+
+
+def test_welch_accumulator_fx_lim():
+    rate = 400.
+    X = np.random.randn(4096, 2)
+    fx, py = sgn.welch(X, fs=rate, nperseg=256, axis=0)
+    acc = WelchAccumulator(rate, 2, 256, fx_lim=100.)
+    acc.update(X)
+    assert np.allclose(acc.frequencies, fx[fx < 100.])
+    assert np.allclose(acc.power, py[fx < 100.])
+
+
+def test_welch_accumulator_bartlett():
+    """
+    A single boxcar segment is the periodogram.
+    """
+    rate = 400.
+    X = np.random.randn(1024, 2)
+    fx, py = sgn.periodogram(X, fs=rate, axis=0)
+    acc = WelchAccumulator(rate, 2, 1024, noverlap=0, window='boxcar')
+    acc.update(X[:600])
+    acc.update(X[600:])
+    assert np.allclose(acc.power, py)
+
+
+def test_welch_accumulator_recordings():
+    """
+    Segments do not span recordings.
+    """
+    rate = 400.
+    X = np.random.randn(2000, 2)
+    Y = np.random.randn(3000, 2)
+    acc = WelchAccumulator(rate, 2, 256)
+    acc.update(X)
+    acc.new_recording()
+    acc.update(Y)
+    _, px = sgn.welch(X, fs=rate, nperseg=256, axis=0)
+    _, py = sgn.welch(Y, fs=rate, nperseg=256, axis=0)
+    nx, ny = (2000 - 128) // 128, (3000 - 128) // 128
+    assert acc.n_segments == nx + ny
+    assert np.allclose(acc.power, (px * nx + py * ny) / (nx + ny))
+
+
+def test_psd_blocks():
+    """
+    Welch's PSD streamed in time chunks and periodogram by blocks of
+    channels match scipy's, for any memory budget and number of workers.
+    """
+    rate = 400.
+    X = np.random.randn(20000, 5)
+    fx_w, py_w = sgn.welch(X, fs=rate, nperseg=1024, axis=0)
+    fx_f, py_f = sgn.periodogram(X, fs=rate, nfft=16384, axis=0)
+    for max_memory, workers in [(.5, None), (.5, 2), (100, None)]:
+        fw, pw, ff, pf = _psd_blocks(X, rate, 1024, 16384, 150., workers,
+                                     max_memory)
+        assert np.allclose(fw, fx_w[fx_w < 150.])
+        assert np.allclose(pw, py_w[fx_w < 150.])
+        assert np.allclose(ff, fx_f[fx_f < 150.])
+        assert np.allclose(pf, py_f[fx_f < 150.])
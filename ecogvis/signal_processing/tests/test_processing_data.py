@@ -0,0 +1,225 @@
+import shutil
+from datetime import datetime
+from types import SimpleNamespace
+
+import h5py
+import numpy as np
+import pynwb.misc
+import pytest
+from dateutil.tz import tzlocal
+from pynwb import NWBFile, NWBHDF5IO
+from pynwb.ecephys import ElectricalSeries
+
+from ecogvis.signal_processing.bands import chang_lab
+from ecogvis.signal_processing.processing_data import (_preprocess_in_memory,
+                                                       high_gamma_estimation,
+                                                       preprocess_raw_data,
+                                                       preprocessed_chunks,
+                                                       spectral_analysis,
+                                                       spectral_decomposition)
+
+
+def make_nwb(path, n_channels=8, n_samples=30017, rate=1000.):
+    """
+    NWB file with raw signals (noise and 60 Hz line noise) in acquisition.
+    """
+    nwb = NWBFile(session_description='test', identifier='test',
+                  session_start_time=datetime(2020, 1, 1, tzinfo=tzlocal()))
+    device = nwb.create_device(name='device')
+    group = nwb.create_electrode_group(name='grid', description='',
+                                       location='', device=device)
+    nwb.add_electrode_column('label', 'label')
+    nwb.add_electrode_column('bad', 'bad')
+    for ch in range(n_channels):
+        nwb.add_electrode(x=0., y=0., z=0., imp=0., location='ctx',
+                          filtering='none', group=group, label=str(ch),
+                          bad=False)
+    region = nwb.create_electrode_table_region(list(range(n_channels)), 'all')
+    tt = np.arange(n_samples) / rate
+    data = (np.random.randn(n_samples, n_channels) * 1e-5 +
+            1e-4 * np.sin(2 * np.pi * 60 * tt)[:, None]).astype('float32')
+    nwb.add_acquisition(ElectricalSeries(name='ElectricalSeries', data=data,
+                                         electrodes=region, rate=rate))
+    with NWBHDF5IO(path, 'w') as io:
+        io.write(nwb)
+    return data
+
+
+def read_chunks(data):
+    """Array written by a data chunk iterator, and its number of chunks."""
+    Y = np.zeros(data.shape, dtype=data.dtype)
+    n_chunks = 0
+    for chunk in data:
+        Y[chunk.selection] = chunk.data
+        n_chunks += 1
+    return Y, n_chunks
+
+
+def test_preprocessed_chunks(tmp_path):
+    """
+    Same signals as processing them whole, for a length that is not a
+    multiple of the chunk length.
+    """
+    rate = 1000.
+    X = (np.random.randn(30017, 8) * 1e-5 + 1e-4 * np.sin(
+        2 * np.pi * 60 * np.arange(30017) / rate)[:, None]).astype('float32')
+    with h5py.File(tmp_path / 'data.h5', 'w') as f:
+        f.create_dataset('data', data=X)
+    configs = [
+        # Downsampling only: same polyphase filter on the exact same grid
+        ({'referencing': None, 'Notch': None, 'Downsample': 400.}, 1e-5),
+        # The notch filter FFT length differs between chunks and signals
+        ({'referencing': ('CAR', 4), 'Notch': 60, 'Downsample': 400.}, 1e-2),
+        ({'referencing': ('CAR', 4), 'Notch': 60, 'Downsample': None}, 1e-2)]
+    with h5py.File(tmp_path / 'data.h5', 'r') as f:
+        source = SimpleNamespace(data=f['data'], rate=rate, electrodes=None)
+        for config, tol in configs:
+            config['MaxMemory'] = 5
+            data, new_rate = preprocessed_chunks(source, config)
+            Y, n_chunks = read_chunks(data)
+            assert n_chunks > 1
+            Z, rate_whole, _ = _preprocess_in_memory(source, config, None,
+                                                     'test.nwb')
+            assert new_rate == rate_whole
+            assert Y.shape == Z.shape
+            assert np.abs(Y - Z).max() <= tol * np.abs(Z).max()
+
+
+def test_preprocess_raw_data_chunks(tmp_path):
+    """
+    Signals written in chunks are the signals processed whole.
+    """
+    config = {'referencing': ('CAR', 4), 'Notch': 60, 'Downsample': 400.}
+    lfp = {}
+    for max_memory in [None, 5]:
+        path = str(tmp_path / 'block_{}.nwb'.format(max_memory))
+        np.random.seed(0)
+        make_nwb(path)
+        preprocess_raw_data(path, dict(config, MaxMemory=max_memory))
+        with NWBHDF5IO(path, 'r') as io:
+            series = io.read().processing['ecephys']['LFP']['preprocessed']
+            assert series.rate == 400.
+            lfp[max_memory] = series.data[:]
+    assert lfp[5].shape == lfp[None].shape == (12007, 8)
+    assert np.abs(lfp[5] - lfp[None]).max() <= 1e-2 * np.abs(lfp[None]).max()
+
+
+def test_preprocess_raw_data_bipolar_chunks(tmp_path):
+    """
+    Bipolar referencing is not done in chunks, whole signals are processed.
+    """
+    path = str(tmp_path / 'block.nwb')
+    make_nwb(path, n_channels=256, n_samples=500)
+    config = {'referencing': ('bipolar', False), 'Notch': None,
+              'Downsample': 400., 'MaxMemory': 5}
+    preprocess_raw_data(path, config)
+    with NWBHDF5IO(path, 'r') as io:
+        ecephys = io.read().processing['ecephys']
+        assert ecephys['LFP']['preprocessed'].data.shape == (200, 480)
+        assert 'bipolar-referenced metadata' in ecephys.data_interfaces
+
+
+def chang_lab_bands(first, last):
+    return np.array([chang_lab['cfs'][first:last],
+                     chang_lab['sds'][first:last]])
+
+
+def make_lfp_nwb(path):
+    """
+    NWB file with preprocessed signals (LFP at 400 Hz).
+    """
+    make_nwb(path, n_samples=10000)
+    preprocess_raw_data(path, {'referencing': None, 'Notch': None,
+                               'Downsample': 400.})
+
+
+def read_ecephys(path, names):
+    with NWBHDF5IO(path, 'r') as io:
+        ecephys = io.read().processing['ecephys']
+        return [(ecephys[name].data[:], ecephys[name].rate)
+                for name in names]
+
+
+def test_spectral_analysis(tmp_path):
+    """
+    Same band group averages as high_gamma_estimation of each group, serial
+    and parallel, at the LFP rate and decimated.
+    """
+    lfp_path = str(tmp_path / 'lfp.nwb')
+    make_lfp_nwb(lfp_path)
+    # Overlapping groups, shared bands are filtered once
+    high_gamma = chang_lab_bands(24, 37)
+    beta = chang_lab_bands(20, 26)
+    for workers in [None, 2]:
+        for out_rate in [None, 100.]:
+            paths = [str(tmp_path / '{}.nwb'.format(name))
+                     for name in ['all', 'high_gamma', 'beta']]
+            for path in paths:
+                shutil.copy(lfp_path, path)
+            spectral_analysis(paths[0], {'high_gamma': high_gamma,
+                                         'band_groups': {'beta': beta}},
+                              workers=workers, out_rate=out_rate)
+            high_gamma_estimation(paths[1], high_gamma, workers=workers,
+                                  out_rate=out_rate)
+            high_gamma_estimation(paths[2], beta, workers=workers,
+                                  out_rate=out_rate)
+            results = read_ecephys(paths[0], ['high_gamma', 'beta'])
+            expected = (read_ecephys(paths[1], ['high_gamma']) +
+                        read_ecephys(paths[2], ['high_gamma']))
+            for (data, rate), (data_exp, rate_exp) in zip(results, expected):
+                assert rate == rate_exp == (out_rate or 400.)
+                assert data.shape == data_exp.shape
+                assert np.allclose(data, data_exp)
+
+
+def test_spectral_analysis_block_size(tmp_path):
+    """
+    Channel blocks as wide as fit in max_memory, and output chunks as wide
+    as the blocks. Results do not depend on the block width.
+    """
+    lfp_path = str(tmp_path / 'lfp.nwb')
+    make_lfp_nwb(lfp_path)
+    high_gamma = chang_lab_bands(24, 37)
+    widths = []
+    results = []
+    for max_memory in [1024, .3]:
+        path = str(tmp_path / '{}.nwb'.format(max_memory))
+        shutil.copy(lfp_path, path)
+        spectral_analysis(path, {'high_gamma': high_gamma},
+                          max_memory=max_memory)
+        with h5py.File(path, 'r') as f:
+            widths.append(f['processing/ecephys/high_gamma/data'].chunks[1])
+        results.append(read_ecephys(path, ['high_gamma'])[0][0])
+    assert widths[0] == 8 and 1 <= widths[1] < 4
+    assert np.allclose(results[0], results[1])
+
+
+@pytest.mark.skipif(hasattr(pynwb.misc, 'FrequencyBandsTable'),
+                    reason='DecompositionSeries bands must be a '
+                           'FrequencyBandsTable in this pynwb version')
+def test_spectral_analysis_decomposition(tmp_path):
+    """
+    Same outputs as spectral_decomposition and high_gamma_estimation.
+    """
+    lfp_path = str(tmp_path / 'lfp.nwb')
+    make_lfp_nwb(lfp_path)
+    decomposition = chang_lab_bands(0, 30)
+    high_gamma = chang_lab_bands(24, 37)
+    for workers in [None, 2]:
+        paths = [str(tmp_path / '{}.nwb'.format(name))
+                 for name in ['all', 'separate']]
+        for path in paths:
+            shutil.copy(lfp_path, path)
+        spectral_analysis(paths[0], {'decomposition': decomposition,
+                                     'high_gamma': high_gamma},
+                          workers=workers, out_rate=100.)
+        spectral_decomposition(paths[1], decomposition, workers=workers,
+                               out_rate=100.)
+        high_gamma_estimation(paths[1], high_gamma, workers=workers,
+                              out_rate=100.)
+        names = ['DecompositionSeries', 'high_gamma']
+        for (data, rate), (data_exp, rate_exp) in zip(
+                read_ecephys(paths[0], names), read_ecephys(paths[1], names)):
+            assert rate == rate_exp == 100.
+            assert data.shape == data_exp.shape
+            assert np.allclose(data, data_exp)
@@ -1,6 +1,9 @@
 import numpy as np
 
-from ecog.signal_processing import resample
+from ecogvis.signal_processing.resample import (resample, rational_ratio,
+                                                polyphase_filter,
+                                                resample_polyphase,
+                                                PolyphaseResampler)
 
 def test_resample_shape():
     X = np.random.randn(32, 2000)
@@ -19,3 +22,64 @@ def test_resample_ones():
 
             Xp = resample(X, 100, 200)
             assert np.allclose(Xp, 1.)
+
+
+def test_rational_ratio():
+    assert rational_ratio(400., 3051.7578125) == (2048, 15625)
+    assert rational_ratio(100, 200) == (1, 2)
+
+
+def test_resample_polyphase_shape():
+    fs = 3051.7578125
+    for t in [50, 1001, 5077]:
+        X = np.random.randn(4, t)
+        Xp = resample(X, 400., fs, kind='polyphase')
+        assert Xp.shape == (4, int(np.ceil(t * 2048 / 15625)))
+
+
+def test_resample_polyphase_sine():
+    """
+    In-band signals are kept and out-of-band signals are not aliased.
+    """
+    fs = 3051.7578125
+    t = np.arange(int(20 * fs)) / fs
+    X = np.sin(2 * np.pi * 37 * t) + np.sin(2 * np.pi * 300 * t)
+    Xp = resample(X, 400., fs, kind='polyphase')
+    tp = np.arange(Xp.size) / 400.
+    err = Xp - np.sin(2 * np.pi * 37 * tp)
+    assert np.abs(err[400:-400]).max() < 1e-3
+
+
+def test_resample_polyphase_chunks():
+    """
+    Resampling in blocks aligned to the downsampling factor, with halos,
+    matches resampling the whole signal.
+    """
+    up, down = 3, 10
+    X = np.random.randn(2, 4000)
+    Xp = resample_polyphase(X, up, down)
+    h = polyphase_filter(up, down).size // (2 * up * down) + 1
+    m = 7
+    chunks = []
+    for a in range(0, X.shape[1], m * down):
+        Xc = np.zeros((2, (m + 2 * h) * down))
+        lo, hi = max(a - h * down, 0), min(a + (m + h) * down, X.shape[1])
+        Xc[:, lo - a + h * down:hi - a + h * down] = X[:, lo:hi]
+        chunks.append(resample_polyphase(Xc, up, down)[:, h * up:(h + m) * up])
+    Xc = np.concatenate(chunks, axis=1)[:, :Xp.shape[1]]
+    assert np.allclose(Xc, Xp)
+
+
+def test_polyphase_resampler():
+    """
+    Streaming in chunks of any length matches resampling the whole signal.
+    """
+    X = np.random.randn(20000)
+    for up, down in [(3, 10), (1, 1), (5, 2)]:
+        Xp = resample_polyphase(X, up, down)
+        for chunk_len in [7, 1000, 30000]:
+            resampler = PolyphaseResampler(up, down)
+            Xs = [resampler.update(X[a:a + chunk_len])
+                  for a in range(0, len(X), chunk_len)]
+            Xs = np.concatenate(Xs + [resampler.flush()])
+            assert np.array_equal(Xs, Xp)
@@ -0,0 +1,100 @@
+import h5py
+import pytest
+import numpy as np
+
+from ecogvis.signal_processing.zscore import (BaselineAccumulator,
+                                              baseline_mask, interval_mask,
+                                              merge_intervals, zscore,
+                                              zscore_streaming)
+
+
+def is_in(tt, interval):
+    return (tt >= interval[0]) & (tt <= interval[1])
+
+
+def test_merge_intervals():
+    starts, stops = merge_intervals([[5, 6], [0, 2], [1, 3], [3, 4], [8, 7]])
+    assert np.array_equal(starts, [0, 5])
+    assert np.array_equal(stops, [4, 6])
+    starts, stops = merge_intervals(np.zeros((0, 2)))
+    assert len(starts) == len(stops) == 0
+
+
+def test_interval_mask():
+    """
+    Same mask as checking the times against each interval.
+    """
+    tt = np.arange(5000) / 100.
+    intervals = np.sort(np.random.rand(40, 2) * 55 - 2, axis=1)
+    expected = np.zeros(len(tt), dtype=bool)
+    for interval in intervals:
+        expected |= is_in(tt, interval)
+    assert np.array_equal(interval_mask(tt, intervals), expected)
+    # Closed intervals
+    assert np.array_equal(np.flatnonzero(interval_mask(tt, [[1., 1.02]])),
+                          [100, 101, 102])
+
+
+def test_baseline_mask():
+    tt = np.arange(6000) / 100.
+    event_times = np.array([12., 20., 31.5, 45.])
+    align_window = np.array([-.5, 1.])
+    bad_times = np.array([[25., 27.], [44., 44.8]])
+    in_range = is_in(tt, [event_times.min() + align_window[0],
+                          event_times.max() + align_window[1]])
+    in_events = np.zeros(len(tt), dtype=bool)
+    for et in event_times:
+        in_events |= is_in(tt, et + align_window)
+    in_bad = is_in(tt, bad_times[0]) | is_in(tt, bad_times[1])
+    expected = {'data': in_range & ~in_bad,
+                'between_data': in_range & ~in_bad & ~in_events,
+                'events': in_events & ~in_bad}
+    for mode, mask in expected.items():
+        assert np.array_equal(baseline_mask(tt, mode, bad_times, align_window,
+                                            event_times), mask)
+
+
+def test_baseline_accumulator():
+    """
+    Statistics of chunks of any length equal those of the whole baseline.
+    """
+    X = np.random.randn(3, 10000) * 2 + 1
+    mask = np.random.rand(10000) > .3
+    for chunk_len in [1, 999, 10000]:
+        acc = BaselineAccumulator()
+        for t0 in range(0, X.shape[1], chunk_len):
+            acc.update(X[:, t0:t0 + chunk_len], mask[t0:t0 + chunk_len])
+        assert np.allclose(acc.mean, X[:, mask].mean(-1, keepdims=True))
+        assert np.allclose(acc.std, X[:, mask].std(-1, keepdims=True))
+
+
+def test_baseline_accumulator_empty():
+    """
+    Baselines without samples (e.g. silence out of the data) raise a
+    ValueError.
+    """
+    X = np.random.randn(3, 100)
+    with pytest.raises(ValueError):
+        zscore_streaming(X, np.zeros(100, dtype=bool))
+
+
+def test_zscore_streaming(tmp_path):
+    """
+    Same as zscore, for time along either axis and from HDF5 datasets.
+    """
+    fs = 100.
+    X = np.random.randn(4, 6000) * 3 + 2
+    silence_time = np.array([10., 20.])
+    Z, means, stds, _ = zscore(X, mode='silence', sampling_freq=fs,
+                               silence_time=silence_time)
+    mask = baseline_mask(np.arange(X.shape[1]) / fs, 'silence',
+                         silence_time=silence_time)
+    out, m, s = zscore_streaming(X, mask, chunk_len=1000)
+    assert np.allclose(out, Z)
+    assert np.allclose(m, means) and np.allclose(s, stds)
+
+    with h5py.File(tmp_path / 'data.h5', 'w') as f:
+        src = f.create_dataset('src', data=X.T)
+        dst = f.create_dataset('dst', shape=src.shape, dtype='float32')
+        zscore_streaming(src, mask, out=dst, axis=0, chunk_len=777)
+        assert np.allclose(dst[:], Z.T, atol=1e-5)
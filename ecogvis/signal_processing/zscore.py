@@ -4,12 +4,16 @@ import numpy as np
 
 from scipy.io import loadmat
 
-from .. import utils
-
 
 __all__ = ['load_silence_time',
+           'merge_intervals',
+           'interval_mask',
+           'baseline_mask',
            'compute_baseline',
-           'zscore']
+           'zscore',
+           'BaselineAccumulator',
+           'baseline_stats',
+           'zscore_streaming']
 
 def load_silence_time(nwb):
     start = nwb.epochs['start_time'][0]
@@ -17,8 +21,101 @@ def load_silence_time(nwb):
     return np.array([start, stop])
 
 
+def merge_intervals(intervals):
+    """
+    Sorts intervals and merges the overlapping ones. Empty intervals (stop
+    before start) are dropped.
+
+    Parameters
+    ----------
+    intervals : array
+        Intervals [start, stop], dimensions (n_intervals, 2).
+
+    Returns
+    -------
+    starts, stops : arrays
+        Sorted starts and stops of the disjoint, merged intervals.
+    """
+    intervals = np.asarray(intervals, dtype='float').reshape(-1, 2)
+    intervals = intervals[intervals[:, 1] >= intervals[:, 0]]
+    if len(intervals) == 0:
+        return np.zeros(0), np.zeros(0)
+    order = np.argsort(intervals[:, 0], kind='stable')
+    starts = intervals[order, 0]
+    stops = np.maximum.accumulate(intervals[order, 1])
+    # An interval starting after all previous ones stopped starts a new group
+    first = np.flatnonzero(np.r_[True, starts[1:] > stops[:-1]])
+    last = np.r_[first[1:] - 1, len(stops) - 1]
+    return starts[first], stops[last]
+
+
+def interval_mask(tt, intervals):
+    """
+    Boolean mask of the times in any of the closed intervals [start, stop].
+    Intervals are merged and located with searchsorted, so that the cost is
+    O(n_times + n_intervals log n_intervals) instead of one pass over the
+    times per interval.
+
+    Parameters
+    ----------
+    tt : array
+        Sorted times.
+    intervals : array
+        Intervals [start, stop], dimensions (n_intervals, 2).
+    """
+    starts, stops = merge_intervals(intervals)
+    counts = np.zeros(len(tt) + 1, dtype='int')
+    np.add.at(counts, np.searchsorted(tt, starts, side='left'), 1)
+    np.add.at(counts, np.searchsorted(tt, stops, side='right'), -1)
+    return np.cumsum(counts[:-1]) > 0
+
+
+def baseline_mask(tt_data, mode='silence', bad_times=None, align_window=None,
+                  event_times=None, silence_time=None):
+    """
+    Boolean mask of the baseline times of zscore `mode`.
+
+    Parameters
+    ----------
+    tt_data : array
+        Sorted times of the data.
+    mode : str
+        'whole', 'between_data', 'data', 'events', 'silence' or
+        'ratio_silence'. See zscore.
+    bad_times : array or None
+        Intervals excluded from the baseline, dimensions (n_intervals, 2).
+    align_window : array
+        Window [start, stop] around the events, relative to event_times.
+    event_times : array
+        Times of the events.
+    silence_time : array
+        Interval [start, stop] of silence.
+    """
+    if bad_times is None:
+        bad_times = np.zeros((0, 2))
+    if mode == 'whole':
+        return np.ones(len(tt_data), dtype=bool)
+    elif mode in ['between_data', 'data', 'events']:
+        event_times = np.asarray(event_times)
+        align_window = np.asarray(align_window)
+        windows = event_times[:, None] + align_window
+        if mode == 'events':
+            data_time = interval_mask(tt_data, windows)
+        else:
+            data_start = event_times.min() + align_window[0]
+            data_stop = event_times.max() + align_window[1]
+            data_time = interval_mask(tt_data, [[data_start, data_stop]])
+            if mode == 'between_data':
+                data_time &= ~interval_mask(tt_data, windows)
+        return data_time & ~interval_mask(tt_data, bad_times)
+    elif mode in ['silence', 'ratio_silence']:
+        return interval_mask(tt_data, [silence_time])
+    else:
+        raise ValueError('zscore_mode type {} not recognized.'.format(mode))
+
+
 def compute_baseline(data, tt_data, baseline_time):
-    data_time = utils.is_in(tt_data, baseline_time)
+    data_time = interval_mask(tt_data, [baseline_time])
     return data[..., data_time]
 
 
@@ -30,31 +127,12 @@ def zscore(data, axis=-1, mode=None, sampling_freq=None, bad_times=None,
 
     if mode == 'whole':
         baseline = data
-    elif mode == 'between_data':
-        tt_data = np.arange(data.shape[axis]) / sampling_freq
-        data_start = event_times.min() + align_window[0]
-        data_stop = event_times.max() + align_window[1]
-        data_time = utils.is_in(tt_data, np.array([data_start, data_stop]))
-        for bt in bad_times:
-            data_time = data_time & ~utils.is_in(tt_data, bt)
-        for et in event_times:
-            data_time = data_time & ~utils.is_in(tt_data, et + align_window)
-        baseline = data[..., data_time]
-    elif mode == 'data':
-        tt_data = np.arange(data.shape[-1]) / sampling_freq
-        data_start = event_times.min() + align_window[0]
-        data_stop = event_times.max() + align_window[1]
-        data_time = utils.is_in(tt_data, np.array([data_start, data_stop]))
-        for bt in bad_times:
-            data_time = data_time & ~utils.is_in(tt_data, bt)
-        baseline = data[..., data_time]
-    elif mode == 'events':
-        tt_data = np.arange(data.shape[-1]) / sampling_freq
-        data_time = np.zeros_like(tt_data, dtype=bool)
-        for et in event_times:
-            data_time = data_time | utils.is_in(tt_data, et + align_window)
-        for bt in bad_times:
-            data_time = data_time & ~utils.is_in(tt_data, bt)
+    elif mode in ['between_data', 'data', 'events']:
+        # 'between_data' times are along axis, the others along the last one
+        n_time = data.shape[axis if mode == 'between_data' else -1]
+        tt_data = np.arange(n_time) / sampling_freq
+        data_time = baseline_mask(tt_data, mode, bad_times, align_window,
+                                  event_times)
         baseline = data[..., data_time]
     elif mode == 'silence':
         tt_data = np.arange(data.shape[axis]) / sampling_freq
@@ -80,3 +158,133 @@ def zscore(data, axis=-1, mode=None, sampling_freq=None, bad_times=None,
     data = (data - means) / stds
 
     return data, means, stds, baseline
+
+
+class BaselineAccumulator:
+    """
+    Mean and standard deviation of the baseline samples of signals streamed
+    in time chunks. The statistics of each chunk are merged with those of the
+    previous ones (Chan et al.'s parallel form of Welford's algorithm), so
+    memory does not depend on the duration of the signals.
+
+    Parameters
+    ----------
+    axis : int
+        Time axis of the chunks.
+    """
+    def __init__(self, axis=-1):
+        self.axis = axis
+        self.count = 0
+        self._mean = None
+        self._m2 = None
+
+    def update(self, X, mask=None):
+        """
+        Adds a chunk of signals. Only the samples where mask (boolean, along
+        the time axis) is True are part of the baseline.
+        """
+        if mask is not None:
+            X = np.compress(mask, X, axis=self.axis)
+        n = X.shape[self.axis]
+        if n == 0:
+            return
+        mean = X.mean(axis=self.axis, keepdims=True)
+        m2 = ((X - mean)**2).sum(axis=self.axis, keepdims=True)
+        if self.count == 0:
+            self._mean, self._m2 = mean, m2
+        else:
+            total = self.count + n
+            delta = mean - self._mean
+            self._mean = self._mean + delta * n / total
+            self._m2 = self._m2 + m2 + delta**2 * self.count * n / total
+        self.count += n
+
+    @property
+    def mean(self):
+        """Baseline mean, with the time axis kept (length 1)."""
+        self._check_count()
+        return self._mean
+
+    @property
+    def std(self):
+        """Baseline standard deviation, with the time axis kept (length 1)."""
+        self._check_count()
+        return np.sqrt(self._m2 / self.count)
+
+    def _check_count(self):
+        if self.count == 0:
+            raise ValueError('No baseline samples: the baseline mask does '
+                             'not select any time point of the signals.')
+
+
+def baseline_stats(data, mask, axis=-1, chunk_len=2**16):
+    """
+    Baseline mean and standard deviation of data, read in chunks of
+    chunk_len samples.
+
+    Parameters
+    ----------
+    data : h5py.Dataset or array
+        Signals.
+    mask : array
+        Boolean mask of the baseline samples (see baseline_mask).
+    axis : int
+        Time axis of data.
+    chunk_len : int
+        Number of samples read at a time.
+
+    Returns
+    -------
+    means, stds : arrays
+        Baseline mean and standard deviation, with the time axis kept.
+    """
+    acc = BaselineAccumulator(axis=axis)
+    for sl, t0, t1 in _time_chunks(data.shape, axis, chunk_len):
+        if mask[t0:t1].any():
+            acc.update(np.asarray(data[sl]), mask[t0:t1])
+    return acc.mean, acc.std
+
+
+def zscore_streaming(data, mask, out=None, axis=-1, chunk_len=2**16):
+    """
+    Z-scores data with respect to the baseline samples in mask, reading and
+    writing chunks of chunk_len samples, so that signals of any duration can
+    be z-scored (e.g. the high gamma of a whole block, from and to NWB
+    files).
+
+    Parameters
+    ----------
+    data : h5py.Dataset or array
+        Signals.
+    mask : array
+        Boolean mask of the baseline samples (see baseline_mask).
+    out : h5py.Dataset, array or None
+        Output, same shape as data. If None, a new array is returned.
+    axis : int
+        Time axis of data.
+    chunk_len : int
+        Number of samples read at a time.
+
+    Returns
+    -------
+    out : h5py.Dataset or array
+        Z-scored data.
+    means, stds : arrays
+        Baseline mean and standard deviation, with the time axis kept.
+    """
+    means, stds = baseline_stats(data, mask, axis, chunk_len)
+    if out is None:
+        out = np.empty(data.shape)
+    for sl, _, _ in _time_chunks(data.shape, axis, chunk_len):
+        out[sl] = (np.asarray(data[sl]) - means) / stds
+    return out, means, stds
+
+
+def _time_chunks(shape, axis, chunk_len):
+    """Slices of consecutive chunks along the time axis."""
+    axis = axis % len(shape)
+    for t0 in range(0, shape[axis], chunk_len):
+        t1 = min(t0 + chunk_len, shape[axis])
+        sl = [slice(None)] * len(shape)
+        sl[axis] = slice(t0, t1)
+        yield tuple(sl), t0, t1